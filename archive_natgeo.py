@@ -0,0 +1,110 @@
+# -*- encoding: utf-8 -*-
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from log_overheard import log_setting
+
+
+class HtmlArchiver:
+    def __init__(self, directory, workers=1):
+        """
+        Func: 在后台线程中保存网页的原始内容，不阻塞请求和解析
+        :param directory: 保存HTML文件的目录，不存在时自动创建
+        :param workers: 写文件的线程数
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.__executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='archive')
+        self.__pending = set()
+        self.__lock = threading.Lock()
+
+    def __write(self, name, content, callback):
+        path = os.path.join(self.directory, name)
+        try:
+            with open(path, 'wb') as f:
+                f.write(content)
+            logger.info(f'网页的html文件【{path}】保存完成。\n')
+        except Exception as e:
+            logger.error(f'保存网页的html文件【{path}】出现错误，请检查：{e}\n')
+            path = None
+
+        if callback is not None:
+            try:
+                callback(path)
+            except Exception as e:
+                logger.error(f'处理网页的html文件【{name}】的保存结果出现错误，请检查：{e}\n')
+        return path
+
+    def save(self, name, content, callback=None):
+        """
+        Func: 提交一个保存任务后立即返回
+        :param name: 文件名
+        :param content: 网页的原始内容（bytes）
+        :param callback: 保存结束后在后台线程中调用 callback(path)，保存失败时 path 为 None；wait() 会等待其完成
+        :return: Future，结果为保存的路径；保存失败时为 None
+        """
+        future = self.__executor.submit(self.__write, name, content, callback)
+        with self.__lock:
+            self.__pending.add(future)
+        future.add_done_callback(self.__done)
+        return future
+
+    def __done(self, future):
+        with self.__lock:
+            self.__pending.discard(future)
+
+    def wait(self):
+        """
+        Func: 等待已经提交的保存任务完成，之后仍然可以继续提交
+        """
+        with self.__lock:
+            pending = list(self.__pending)
+        wait(pending)
+
+    def close(self):
+        """
+        Func: 等待所有保存任务完成
+        """
+        self.__executor.shutdown(wait=True)
+
+
+_archiver = None
+_archiver_lock = threading.Lock()
+
+
+def configure_archive(directory=None, workers=1):
+    """
+    Func: 开启或关闭网页原始内容的保存；directory 为 None 时关闭（默认关闭）
+    """
+    global _archiver
+    with _archiver_lock:
+        if _archiver is not None:
+            _archiver.close()
+        _archiver = HtmlArchiver(directory, workers) if directory else None
+        return _archiver
+
+
+def archive_html(name, content, callback=None):
+    """
+    Func: 如果开启了网页保存，则在后台保存网页的原始内容；没有开启时什么也不做
+    :param callback: 见 HtmlArchiver.save()
+    :return: 开启了网页保存时返回 Future，见 HtmlArchiver.save()；否则返回 None
+    """
+    archiver = _archiver
+    if archiver is not None:
+        return archiver.save(name, content, callback)
+    return None
+
+
+def wait_archive():
+    """
+    Func: 开启了网页保存时，等待已经提交的保存任务完成
+    """
+    archiver = _archiver
+    if archiver is not None:
+        archiver.wait()
+
+
+logger = log_setting('Overheard_archive', '../Logs')
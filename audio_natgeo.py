@@ -0,0 +1,89 @@
+# -*- encoding: utf-8 -*-
+
+import json
+import re
+
+from log_overheard import log_setting
+from session_natgeo import http_get
+
+
+# 节目网页中嵌入的是 iHeart 的播放器，通过其公开的接口可以直接获取音频链接
+IHEART_API = 'https://us.api.iheart.com'
+
+# 播放器链接中的节目编号，例如 .../episode/farming-for-the-planet-12345678/?embed=true
+EPISODE_ID = re.compile(r'/episode/(?:[^/?#]*-)?(\d+)')
+
+# 播放器页面中的音频链接
+MEDIA_URL = re.compile(r'"mediaUrl"\s*:\s*("(?:[^"\\]|\\.)*")')
+MP3_URL = re.compile(r'https?:(?:\\?/){2}[^"\'\s<>]+?\.mp3[^"\'\s<>]*')
+
+
+def episode_id(player_url):
+    """
+    Func: 从播放器的链接中获取节目编号
+    :return: 节目编号；获取失败返回 None
+    """
+    match = EPISODE_ID.search(player_url or '')
+    return match.group(1) if match else None
+
+
+def audio_url_from_api(player_url, api_base=None):
+    """
+    Func: 通过播放器的接口获取音频链接
+    :param player_url: 网页中嵌入的播放器的链接（iframe 的 src）
+    :param api_base: 接口的地址，默认为 IHEART_API；测试时可以替换为本地的模拟服务
+    :return: 音频链接；获取失败返回 None
+    """
+    number = episode_id(player_url)
+    if number is None:
+        return None
+
+    response = http_get(f'{api_base or IHEART_API}/api/v3/podcast/episodes/{number}')
+    if response.status_code != 200:
+        logger.warning(f'播放器接口返回码为【{response.status_code}】。')
+        return None
+    return response.json().get('episode', {}).get('mediaUrl') or None
+
+
+def audio_url_from_player(player_url):
+    """
+    Func: 请求播放器的页面，从页面内嵌的数据中获取音频链接
+    :return: 音频链接；获取失败返回 None
+    """
+    response = http_get(player_url)
+    if response.status_code != 200:
+        logger.warning(f'播放器页面返回码为【{response.status_code}】。')
+        return None
+
+    match = MEDIA_URL.search(response.text)
+    if match:
+        # 页面中的数据是 JSON 字符串，其中的 / 可能被转义为 \/ 或 /
+        return json.loads(match.group(1)) or None
+
+    match = MP3_URL.search(response.text)
+    if match:
+        return match.group(0).replace('\\/', '/')
+    return None
+
+
+def resolve_audio_url(player_url, api_base=None):
+    """
+    Func: 不启动浏览器，只通过HTTP请求获取音频链接：先尝试播放器的接口，再尝试播放器的页面
+    :param player_url: 网页中嵌入的播放器的链接（iframe 的 src）
+    :param api_base: 播放器接口的地址，默认为 IHEART_API
+    :return: 音频链接；获取失败返回 None，由调用者决定是否使用浏览器获取
+    """
+    if not player_url:
+        return None
+
+    for resolver in (lambda: audio_url_from_api(player_url, api_base), lambda: audio_url_from_player(player_url)):
+        try:
+            url = resolver()
+            if url:
+                return url
+        except Exception as e:
+            logger.warning(f'通过HTTP获取音频链接出现错误：{e}')
+    return None
+
+
+logger = log_setting('Overheard_audio', '../Logs')
@@ -0,0 +1,255 @@
+# -*- encoding: utf-8 -*-
+
+"""
+基准测试：在本地的模拟网站（fixture_natgeo）上，按 10/100/1000 期节目的规模，分别测量
+节目信息的获取、网页的解析、图片和音频的下载、完整的下载流程以及数据库操作的耗时，
+结果保存为 JSON 报告，可以与其他版本的报告进行对比。
+
+用法（在项目目录中运行，日志保存在 ../Logs）：
+    python benchmark_natgeo.py --scales 10 100 --output ../benchmark.json
+    python benchmark_natgeo.py --latency 0.02 --bandwidth 1048576 --compare ../benchmark_old.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from download_natgeo import create_table_sqls
+from fixture_natgeo import FixtureSite
+from get_all_basic_natgeo import Sniffer
+from get_all_specific_natgeo import Downloader, get_files
+from log_overheard import log_setting
+from save_natgeo_data import create_processor
+from session_natgeo import load_aiohttp
+from transfer_natgeo import configure_segments
+
+
+# 各项测试的名称
+BENCHMARKS = ('discovery', 'fetch', 'parse', 'audio_url', 'picture', 'audio', 'database')
+
+# 完整下载流程的几种模式
+MODES = ('sequential', 'pipeline', 'async')
+
+
+def git_version():
+    """
+    Func: 当前代码的版本（git 提交号），不在 git 仓库中时返回 None
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Benchmark:
+    def __init__(self, args):
+        """
+        Func: 依次在各个规模上运行基准测试，并记录结果
+        :param args: 命令行参数
+        """
+        self.args = args
+        self.results = []
+
+    def record(self, name, scale, seconds, items, nbytes=None):
+        result = {'name': name, 'scale': scale, 'seconds': round(seconds, 6), 'items': items,
+                  'per_item_ms': round(seconds * 1000 / items, 3) if items else None}
+        if nbytes is not None:
+            result['bytes'] = nbytes
+            result['mb_per_second'] = round(nbytes / seconds / 1024 / 1024, 3) if seconds else None
+        self.results.append(result)
+        logger.warning(f'【{name}】规模【{scale}】：{seconds:.3f}秒，共【{items}】项')
+        return result
+
+    def timed(self, name, scale, func, items, nbytes=None):
+        start = time.perf_counter()
+        value = func()
+        self.record(name, scale, time.perf_counter() - start, items, nbytes)
+        return value
+
+    def run(self):
+        for scale in self.args.scales:
+            site = FixtureSite(episodes=scale, page_size=self.args.page_size, paragraphs=self.args.paragraphs,
+                               picture_size=self.args.picture_size, audio_size=self.args.audio_size,
+                               latency=self.args.latency, bandwidth=self.args.bandwidth)
+            workspace = tempfile.mkdtemp(prefix='overheard-benchmark-')
+            try:
+                with site:
+                    self.run_scale(site, scale, workspace)
+            finally:
+                shutil.rmtree(workspace, ignore_errors=True)
+
+    def run_scale(self, site, scale, workspace):
+        selected = self.args.benchmarks
+
+        if 'discovery' in selected:
+            info = self.timed('discovery', scale, lambda: Sniffer(site.home_url).get_all_episode_info(), scale)
+            if len(info or {}) != scale:
+                logger.error(f'获取到的节目数量【{len(info or {})}】与模拟网站的节目数量【{scale}】不一致，请检查！')
+
+        info = site.episode_info()
+        out = os.path.join(workspace, 'extract')
+        os.makedirs(out)
+        # 播放器接口同样由模拟网站提供
+        downloaders = [Downloader(title, url, save_path=out, manifest=None, api_base=site.base_url)
+                       for title, url in info.items()]
+
+        if selected & {'fetch', 'parse', 'audio_url', 'picture', 'audio'}:
+            self.timed('fetch', scale, lambda: [d.fetch_page() for d in downloaders], scale)
+            pictures = self.timed('parse', scale, lambda: [d.parse_page() for d in downloaders], scale)
+            audios = self.timed('audio_url', scale, lambda: [d.get_only_audio_url() for d in downloaders], scale)
+
+            if 'picture' in selected:
+                self.timed('picture', scale, lambda: [d.save_picture(url) for d, url in zip(downloaders, pictures)],
+                           scale, scale * site.picture_size)
+            if 'audio' in selected:
+                self.timed('audio', scale, lambda: [d.save_audio(url) for d, url in zip(downloaders, audios)],
+                           scale, scale * site.audio_size)
+
+        for mode in self.args.modes:
+            self.run_mode(mode, site, scale, workspace, info)
+
+        if 'database' in selected:
+            self.run_database(create_processor('sqlite', directory=os.path.join(workspace, 'data')), scale, info)
+            if self.args.mysql:
+                username, password, host, port = self.args.mysql
+                self.run_database(create_processor('mysql', username, password, host=host, port=port), scale, info)
+
+    def run_mode(self, mode, site, scale, workspace, info):
+        """
+        Func: 使用 get_files() 测量完整下载流程（请求网页、解析、下载图片和音频）的耗时
+        """
+        if mode == 'async' and load_aiohttp() is None:
+            logger.warning('没有安装 aiohttp 模块，跳过异步模式。')
+            return
+
+        out = os.path.join(workspace, mode)
+        os.makedirs(out)
+        manifest = os.path.join(workspace, f'{mode}.json')
+        options = {'pipeline': {'pipeline': True}, 'async': {'concurrency': self.args.concurrency}}.get(mode, {})
+
+        # 使用生成器提供节目信息，与边获取边下载时的用法一致
+        episodes = ((title, url) for title, url in info.items())
+        self.timed(f'get_files_{mode}', scale,
+                   lambda: get_files(episodes, manifest=manifest, save_path=out, api_base=site.base_url, **options),
+                   scale, scale * (site.picture_size + site.audio_size))
+
+    def run_database(self, processor, scale, info):
+        """
+        Func: 测量存储后端的各项操作：建表、批量写入、对比新节目、查询、更新下载状态
+        """
+        backend = processor.backend
+        database, table = 'overheard_benchmark', 'overheard_basic_data'
+        with processor:
+            processor.delete_database(database)
+
+            def create():
+                processor.create_database(database)
+                processor.create_data_table(database, table, create_table_sqls(table, backend))
+
+            self.timed(f'db_{backend}_create', scale, create, 1)
+            self.timed(f'db_{backend}_insert', scale, lambda: processor.insert_episodes(database, table, info), scale)
+            self.timed(f'db_{backend}_check_latest', scale,
+                       lambda: processor.check_latest_issue(database, table, info), scale)
+            self.timed(f'db_{backend}_pending', scale, lambda: processor.pending_episodes(database, table), scale)
+            self.timed(f'db_{backend}_update_status', scale,
+                       lambda: processor.update_download_status(database, table, list(info.values())), scale)
+            processor.delete_database(database)
+
+    def report(self):
+        return {
+            'version': git_version(),
+            'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'config': dict({key: value for key, value in vars(self.args).items()
+                            if key not in ('output', 'compare', 'mysql', 'verbose')},
+                           benchmarks=sorted(self.args.benchmarks)),
+            'results': self.results,
+        }
+
+
+def compare(report, old_report):
+    """
+    Func: 与之前的报告对比，输出每一项的耗时变化（新/旧，小于1表示变快）
+    """
+    old = {(item['name'], item['scale']): item for item in old_report['results']}
+    lines = [f'与版本【{old_report.get("version")}】对比（新/旧）：']
+    for item in report['results']:
+        before = old.get((item['name'], item['scale']))
+        if before and before['seconds']:
+            ratio = item['seconds'] / before['seconds']
+            lines.append(f'{item["name"]:<28}{item["scale"]:>6}{before["seconds"]:>12.3f}s{item["seconds"]:>12.3f}s'
+                         f'{ratio:>10.2f}x')
+    return '\n'.join(lines)
+
+
+def parse_mysql(value):
+    """
+    Func: 解析 user:password@host:port 格式的 MySQL 连接信息
+    """
+    credentials, _, address = value.rpartition('@')
+    username, _, password = credentials.partition(':')
+    host, _, port = address.partition(':')
+    return username, password, host or 'localhost', int(port or 3306)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='在本地模拟网站上运行 Overheard 下载流程的基准测试')
+    parser.add_argument('--scales', type=int, nargs='+', default=[10, 100, 1000], help='节目数量，可以指定多个')
+    parser.add_argument('--benchmarks', nargs='+', choices=BENCHMARKS, default=list(BENCHMARKS), help='运行的测试项')
+    parser.add_argument('--modes', nargs='*', choices=MODES, default=list(MODES), help='完整下载流程的模式')
+    parser.add_argument('--concurrency', type=int, default=10, help='异步模式同时处理的节目数量')
+    parser.add_argument('--page-size', type=int, default=24, help='每一页列表中的节目数量')
+    parser.add_argument('--paragraphs', type=int, default=30, help='每一期节目正文的段落数')
+    parser.add_argument('--picture-size', type=int, default=32 * 1024, help='封面图片的大小（字节）')
+    parser.add_argument('--audio-size', type=int, default=256 * 1024, help='音频文件的大小（字节）')
+    parser.add_argument('--latency', type=float, default=0.0, help='每个请求的额外延迟（秒）')
+    parser.add_argument('--bandwidth', type=int, default=None, help='每个响应的传输速度上限（字节/秒）')
+    parser.add_argument('--segments', type=int, default=1, help='音频文件的分段数量（配合 --bandwidth 测试分段下载）')
+    parser.add_argument('--mysql', type=parse_mysql, default=None, help='同时测试 MySQL：user:password@host:port')
+    parser.add_argument('--output', default='../benchmark.json', help='JSON 报告的保存路径')
+    parser.add_argument('--compare', default=None, help='用来对比的旧报告')
+    parser.add_argument('--verbose', action='store_true', help='输出各个模块的全部日志（会影响耗时）')
+    args = parser.parse_args(argv)
+    args.benchmarks = set(args.benchmarks)
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if not args.verbose:
+        # 逐条输出的日志会明显影响耗时，只保留警告和错误（测试结果使用 warning 级别输出）
+        logging.disable(logging.INFO)
+
+    if args.segments > 1:
+        # 只对音频分段，封面图片小于音频，仍使用单个连接
+        configure_segments(args.segments, min_size=args.audio_size)
+
+    benchmark = Benchmark(args)
+    benchmark.run()
+    report = benchmark.report()
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    logger.warning(f'基准测试完成，报告保存在【{args.output}】。')
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            print(compare(report, json.load(f)))
+    return report
+
+
+logger = log_setting('Overheard_benchmark', '../Logs')
+
+
+if __name__ == '__main__':
+    main()
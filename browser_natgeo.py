@@ -0,0 +1,212 @@
+# -*- encoding: utf-8 -*-
+
+import threading
+import time
+from contextlib import contextmanager
+
+from log_overheard import log_setting
+
+
+def new_driver():
+    """
+    Func: 创建一个无界面（headless）的 Chrome 浏览器
+    """
+    # selenium 的导入较慢，只在真正需要浏览器时导入
+    from selenium import webdriver
+
+    option = webdriver.ChromeOptions()
+    option.add_argument('--headless')
+    option.add_argument('--disable-gpu')
+    option.add_argument('start-maximized')
+    option.add_experimental_option('excludeSwitches', ['enable-automation'])
+    option.add_experimental_option('useAutomationExtension', False)
+    driver = webdriver.Chrome(options=option)
+    driver.implicitly_wait(20)
+    return driver
+
+
+def click_audio_url(driver):
+    """
+    Func: 在已经打开的节目网页中，切换到播放器的 iframe，点击播放按钮后获取音频的链接
+    :param driver: 已经打开节目网页的浏览器
+    :return: 音频链接
+    """
+    from selenium import webdriver
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support import expected_conditions as ec
+    from selenium.webdriver.support.ui import WebDriverWait
+
+    # 切换 frame - 音频相关的内容嵌套在名为第一个 iframe 中
+    logger.info('开始切换到包含音频的iframe ... ')
+
+    iframe = driver.find_elements(By.TAG_NAME, "iframe")[0]
+
+    # KEEP: 如下几种切换 frame的方式
+    # driver.switch_to.frame('iheartembed')
+    # driver.switch_to.frame(0)
+    # driver.switch_to.frame(driver.find_elements(By.TAG_NAME, "iframe")[0])
+    # driver.switch_to.frame(iframe)
+    WebDriverWait(driver, 10).until(ec.frame_to_be_available_and_switch_to_it(iframe))
+
+    logger.info('开始获取【播放】按钮 ... ')
+    # audio_play_button = driver.find_element(By.TAG_NAME, 'button')
+    audio_play_button = WebDriverWait(driver, 20).until(ec.element_to_be_clickable((By.TAG_NAME, 'button')))
+
+    logger.info('开始点击【播放】按钮 ... ')
+    webdriver.ActionChains(driver).move_to_element(audio_play_button).perform()
+    time.sleep(2)
+    webdriver.ActionChains(driver).click(audio_play_button).perform()
+
+    logger.info('开始获取音频链接 ... ')
+    audio_element = WebDriverWait(driver, 20).until(ec.presence_of_element_located((By.TAG_NAME, 'video')))
+    return audio_element.get_attribute('src')
+
+
+def is_browser_error(error):
+    """
+    Func: 判断异常是否来自浏览器本身（浏览器崩溃、chromedriver 退出或者无法连接），
+          而不是网页内容不符合预期
+    """
+    from selenium.common.exceptions import WebDriverException
+    from urllib3.exceptions import HTTPError
+
+    return isinstance(error, (WebDriverException, HTTPError, ConnectionError))
+
+
+class WebDriverPool:
+    def __init__(self, size=1, max_uses=20):
+        """
+        Func: 长期运行的浏览器池。浏览器在各期节目之间复用，每次使用后重置，
+              使用 max_uses 次或者出现崩溃后销毁重建；同时运行的浏览器不超过 size 个
+        :param size: 浏览器的最大数量
+        :param max_uses: 每个浏览器最多使用的次数
+        """
+        self.size = size
+        self.max_uses = max_uses
+        # 以下状态都只在持有 __cond 时读写
+        self.__idle = []
+        self.__uses = {}
+        self.__broken = set()
+        self.__created = 0
+        self.__closed = False
+        self.__cond = threading.Condition()
+
+    def acquire(self):
+        """
+        Func: 获取一个浏览器；没有空闲的浏览器且数量已达上限时，等待其他节目归还
+        """
+        with self.__cond:
+            while True:
+                if self.__closed:
+                    raise RuntimeError('浏览器池已经关闭')
+                if self.__idle:
+                    return self.__idle.pop()
+                if self.__created < self.size:
+                    self.__created += 1
+                    break
+                self.__cond.wait()
+
+        try:
+            logger.info('开始启动新的浏览器 ... ')
+            driver = new_driver()
+        except Exception:
+            with self.__cond:
+                self.__created -= 1
+                self.__cond.notify()
+            raise
+        with self.__cond:
+            self.__uses[id(driver)] = 0
+        return driver
+
+    def mark_broken(self, driver):
+        """
+        Func: 标记浏览器已经出现异常，归还时将其关闭；用于捕获了浏览器错误、没有将其抛出 driver() 的调用者
+        """
+        with self.__cond:
+            self.__broken.add(id(driver))
+
+    def release(self, driver, broken=False):
+        """
+        Func: 归还浏览器。浏览器出现异常或使用次数达到上限时将其关闭，否则重置后放回池中
+        :param broken: 浏览器是否出现了异常
+        """
+        with self.__cond:
+            uses = self.__uses.get(id(driver), 0) + 1
+            self.__uses[id(driver)] = uses
+            broken = broken or id(driver) in self.__broken
+            reuse = not broken and uses < self.max_uses and not self.__closed
+        if reuse:
+            try:
+                self.__reset(driver)
+                with self.__cond:
+                    # 重置期间浏览器池可能已经关闭
+                    if not self.__closed:
+                        self.__idle.append(driver)
+                        self.__cond.notify()
+                        return
+            except Exception as e:
+                # chromedriver 退出后，selenium 抛出的是 urllib3 的 MaxRetryError 或者 ConnectionRefusedError，
+                # 不是 WebDriverException；任何错误都要关闭浏览器并释放名额，否则 acquire() 会一直等待
+                logger.warning(f'重置浏览器出现错误，将其关闭：{e}')
+
+        self.__discard(driver)
+
+    @contextmanager
+    def driver(self):
+        """
+        Func: with pool.driver() as driver: ... 使用结束后自动归还浏览器；使用过程中出现浏览器错误时将其关闭
+        """
+        driver = self.acquire()
+        broken = False
+        try:
+            yield driver
+        except Exception as e:
+            broken = is_browser_error(e)
+            raise
+        finally:
+            self.release(driver, broken=broken)
+
+    @staticmethod
+    def __reset(driver):
+        """
+        Func: 关闭多余的标签页，清除 Cookie 和本地存储，回到空白页
+        """
+        from selenium.common.exceptions import WebDriverException
+
+        driver.switch_to.default_content()
+        for handle in driver.window_handles[1:]:
+            driver.switch_to.window(handle)
+            driver.close()
+        driver.switch_to.window(driver.window_handles[0])
+        try:
+            driver.execute_script('window.localStorage.clear(); window.sessionStorage.clear();')
+        except WebDriverException:
+            pass
+        driver.delete_all_cookies()
+        driver.get('about:blank')
+
+    def __discard(self, driver):
+        with self.__cond:
+            self.__uses.pop(id(driver), None)
+            self.__broken.discard(id(driver))
+            self.__created -= 1
+            self.__cond.notify()
+        try:
+            driver.quit()
+        except Exception as e:
+            logger.warning(f'关闭浏览器出现错误：{e}')
+
+    def close(self):
+        """
+        Func: 关闭池中所有空闲的浏览器；正在使用的浏览器在归还时关闭
+        """
+        with self.__cond:
+            self.__closed = True
+            idle, self.__idle = self.__idle, []
+            self.__cond.notify_all()
+        for driver in idle:
+            self.__discard(driver)
+        logger.info('浏览器池已经关闭。\n')
+
+
+logger = log_setting('Overheard_browser', '../Logs')
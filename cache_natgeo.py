@@ -0,0 +1,247 @@
+# -*- encoding: utf-8 -*-
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+from requests.structures import CaseInsensitiveDict
+
+from log_overheard import log_setting
+from metrics_natgeo import host_of, metrics
+from session_natgeo import async_http_get, http_get
+
+
+# 缓存的默认上限：总大小 200MB，最长保存 30 天
+MAX_SIZE = 200 * 1024 * 1024
+MAX_AGE = 30 * 24 * 3600
+
+
+class CachedResponse:
+    def __init__(self, content, headers):
+        """
+        Func: 服务器返回 304 时，使用缓存的内容构造的响应，提供与 requests.Response 相同的常用属性
+        """
+        self.status_code = 200
+        self.content = content
+        self.headers = CaseInsensitiveDict(headers)
+        self.from_cache = True
+
+    def raise_for_status(self):
+        pass
+
+
+class HttpCache:
+    def __init__(self, directory, max_size=MAX_SIZE, max_age=MAX_AGE):
+        """
+        Func: 保存在磁盘上的HTTP缓存。保存网页内容及其 ETag/Last-Modified，再次请求时发送条件请求，
+              服务器返回 304 时直接使用缓存的内容；超过总大小或保存时间时，按最近最少使用（LRU）的顺序删除
+        :param directory: 缓存目录，不存在时自动创建
+        :param max_size: 缓存的最大总大小（字节）
+        :param max_age: 缓存的最长保存时间（秒），从最近一次得到服务器确认时开始计算
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.max_age = max_age
+        self.__index_path = os.path.join(directory, 'index.json')
+        self.__lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.__index = self.__load()
+
+    def __load(self):
+        if not os.path.exists(self.__index_path):
+            return {}
+        try:
+            with open(self.__index_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f'读取缓存索引出现错误，将清空缓存：{e}')
+            return {}
+
+    def __save(self):
+        temp = self.__index_path + '.tmp'
+        with open(temp, 'w', encoding='utf-8') as f:
+            json.dump(self.__index, f, ensure_ascii=False)
+        os.replace(temp, self.__index_path)
+
+    @staticmethod
+    def __key(url):
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+    def __body_path(self, key):
+        return os.path.join(self.directory, key + '.body')
+
+    def lookup(self, url):
+        """
+        Func: 查找某个链接的缓存记录；过期或者内容文件丢失时删除该记录
+        :return: 缓存记录（字典）；没有缓存时返回 None
+        """
+        key = self.__key(url)
+        with self.__lock:
+            entry = self.__index.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry['validated'] > self.max_age or not os.path.exists(self.__body_path(key)):
+                self.__remove(key)
+                self.__save()
+                return None
+            return dict(entry)
+
+    @staticmethod
+    def conditional_headers(entry):
+        """
+        Func: 根据缓存记录构造条件请求的请求头
+        """
+        headers = {}
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def load(self, url):
+        """
+        Func: 服务器确认内容没有变化（304）后，读取缓存的内容，并更新最近使用和确认的时间
+        :return: CachedResponse；缓存已经被删除时返回 None
+        """
+        key = self.__key(url)
+        with self.__lock:
+            entry = self.__index.get(key)
+            if entry is None:
+                return None
+            try:
+                with open(self.__body_path(key), 'rb') as f:
+                    content = f.read()
+            except OSError:
+                self.__remove(key)
+                self.__save()
+                return None
+            entry['accessed'] = entry['validated'] = time.time()
+            self.__save()
+        logger.info(f'网页【{url}】没有变化，使用缓存的内容。')
+        return CachedResponse(content, {'Content-Type': entry.get('content_type') or ''})
+
+    def store(self, url, content, headers):
+        """
+        Func: 保存服务器返回的内容；没有 ETag 和 Last-Modified，或者要求不缓存时不保存
+        :param headers: 响应头
+        """
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+        if not (etag or last_modified) or 'no-store' in (headers.get('Cache-Control') or ''):
+            return
+
+        key = self.__key(url)
+        now = time.time()
+        with self.__lock:
+            temp = self.__body_path(key) + '.tmp'
+            with open(temp, 'wb') as f:
+                f.write(content)
+            os.replace(temp, self.__body_path(key))
+            self.__index[key] = {'url': url, 'etag': etag, 'last_modified': last_modified,
+                                 'content_type': headers.get('Content-Type'), 'size': len(content),
+                                 'accessed': now, 'validated': now}
+            self.__evict()
+            self.__save()
+
+    def __evict(self):
+        """
+        Func: 删除过期的缓存；总大小超过上限时，从最久没有使用的缓存开始删除
+        """
+        now = time.time()
+        for key in [key for key, entry in self.__index.items() if now - entry['validated'] > self.max_age]:
+            self.__remove(key)
+
+        total = sum(entry['size'] for entry in self.__index.values())
+        for key in sorted(self.__index, key=lambda k: self.__index[k]['accessed']):
+            if total <= self.max_size:
+                break
+            total -= self.__index[key]['size']
+            self.__remove(key)
+
+    def __remove(self, key):
+        self.__index.pop(key, None)
+        try:
+            os.remove(self.__body_path(key))
+        except OSError:
+            pass
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def configure_cache(directory=None, max_size=MAX_SIZE, max_age=MAX_AGE):
+    """
+    Func: 开启或关闭网页的HTTP缓存；directory 为 None 时关闭（默认关闭）
+    """
+    global _cache
+    with _cache_lock:
+        _cache = HttpCache(directory, max_size, max_age) if directory else None
+        return _cache
+
+
+def cached_http_get(url, **kwargs):
+    """
+    Func: 使用共享的HTTP会话请求网页。开启了缓存时发送条件请求，服务器返回 304 时使用缓存的内容
+    :return: requests.Response 或 CachedResponse
+    """
+    cache = _cache
+    entry = cache.lookup(url) if cache is not None else None
+    if entry:
+        kwargs['headers'] = dict(kwargs.get('headers') or {}, **cache.conditional_headers(entry))
+
+    response = http_get(url, **kwargs)
+    if cache is None:
+        metrics.inc('bytes_total', len(response.content), host=host_of(url))
+        return response
+
+    if response.status_code == 304 and entry:
+        cached = cache.load(url)
+        if cached is not None:
+            metrics.inc('cache_requests_total', result='hit')
+            return cached
+        # 缓存刚好被删除，重新发送不带条件的请求
+        kwargs['headers'] = {k: v for k, v in kwargs['headers'].items()
+                             if k not in ('If-None-Match', 'If-Modified-Since')}
+        response = http_get(url, **kwargs)
+
+    metrics.inc('cache_requests_total', result='miss')
+    metrics.inc('bytes_total', len(response.content), host=host_of(url))
+    if response.status_code == 200:
+        cache.store(url, response.content, response.headers)
+    return response
+
+
+async def async_cached_http_get(session, url, **kwargs):
+    """
+    Func: cached_http_get() 的异步版本
+    :param session: aiohttp.ClientSession
+    :return: (状态码, 网页内容, Content-Type)；状态码不是 200 时网页内容为 None
+    """
+    cache = _cache
+    entry = cache.lookup(url) if cache is not None else None
+    if entry:
+        kwargs['headers'] = dict(kwargs.get('headers') or {}, **cache.conditional_headers(entry))
+
+    async with await async_http_get(session, url, **kwargs) as response:
+        if response.status == 304 and entry:
+            cached = cache.load(url)
+            if cached is not None:
+                metrics.inc('cache_requests_total', result='hit')
+                return 200, cached.content, cached.headers.get('Content-Type')
+            return await async_cached_http_get(session, url)
+        if cache is not None:
+            metrics.inc('cache_requests_total', result='miss')
+        if response.status != 200:
+            return response.status, None, None
+
+        content = await response.read()
+        metrics.inc('bytes_total', len(content), host=host_of(url))
+        if cache is not None:
+            cache.store(url, content, response.headers)
+        return 200, content, response.headers.get('Content-Type')
+
+
+logger = log_setting('Overheard_cache', '../Logs')
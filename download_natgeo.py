@@ -1,67 +1,169 @@
 # -*- encoding: utf-8 -*-
 
+import itertools
 import sys
 
-from save_natgeo_data import *
-from get_all_specific_natgeo import *
+from archive_natgeo import configure_archive
+from cache_natgeo import configure_cache
+from get_all_basic_natgeo import Sniffer
+from get_all_specific_natgeo import get_files
+from log_overheard import configure_logging, log_setting
+from metrics_natgeo import configure_metrics
+from save_natgeo_data import check_instance, create_processor
+from scheduler_natgeo import configure_scheduler
+from store_natgeo import configure_store
+from transfer_natgeo import configure_segments
 
 
-def download_all(url, username, password, database, data_table):
+# 新节目写入数据库的批量大小，与一页列表中的节目数量相同
+INSERT_BATCH_SIZE = 24
+
+
+def create_table_sqls(table, backend='mysql'):
+    """
+    Func: 构造创建数据表的SQL语句
+    :param table: 数据表的名称
+    :param backend: 存储后端，'mysql' 或 'sqlite'
+    :return: 列表，保存构造好的sql语句
     """
-    Func: 下载全部节目
+    if backend == 'sqlite':
+        return [f'DROP TABLE IF EXISTS "{table}";',
+                f'CREATE TABLE "{table}" ( '
+                "NUM INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "TITLE TEXT NOT NULL, "
+                "URL TEXT NOT NULL UNIQUE, "
+                "DOWNLOAD_STATUS TEXT NOT NULL DEFAULT 'NO', "
+                "UPDATED_TIME TEXT "
+                ");",
+                f'CREATE INDEX "IDX_{table}_TITLE" ON "{table}" (TITLE);'
+                ]
+
+    return [f"DROP TABLE IF EXISTS `{table}`;",
+            f"CREATE TABLE `{table}` ( "
+            "`NUM` int NOT NULL AUTO_INCREMENT COMMENT '序号', "
+            "`TITLE` varchar(255) NOT NULL COMMENT '标题', "
+            "`URL` varchar(255) NOT NULL COMMENT '链接', "
+            "`DOWNLOAD_STATUS` varchar(255) NOT NULL DEFAULT 'NO' COMMENT '下载状态',"
+            "`UPDATED_TIME` datetime DEFAULT NULL COMMENT '更新时间', "
+            "PRIMARY KEY ( `NUM`), "
+            "UNIQUE KEY `UK_URL` (`URL`), "
+            "KEY `IDX_TITLE` (`TITLE`) "
+            ") "
+            "ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci COMMENT='所有节目的标题和链接';"
+            ]
+
+
+def download_all(url, username, password, database, data_table, backend='mysql', directory='../Data',
+                 page_template=None, episodes=None):
     """
-    # 获取所有节目的基本信息
-    natgeo_sniffer = Sniffer(url)
-    all_basic_info = natgeo_sniffer.get_all_episode_info()
+    Func: 下载全部节目。边获取节目信息边下载：每获取到一期节目，就写入数据库并开始下载
+    :param backend: 存储后端，'mysql'（默认）或 'sqlite'；使用 sqlite 时无需数据库服务，username 和 password 不使用
+    :param directory: sqlite 保存数据库文件的目录
+    :param page_template: 后续列表页的网址模板，见 Sniffer
+    :param episodes: 可迭代对象，依次返回 (节目标题, 节目网址)；提供时不再从网站获取节目信息
+    """
+    # 所有数据库操作复用同一个处理器
+    with create_processor(backend, username, password, directory) as natgeo_processor:
+        # 如果存在同名的数据库，则删除重建；如果不存在，则直接创建
+        natgeo_processor.delete_database(database)
+        natgeo_processor.create_database(database)
 
-    # 将所有节目的基本信息保存到数据库中
-    natgeo_processor = DataProcess(username, password)
+        # 在数据库中创建数据表
+        natgeo_processor.delete_data_table(database, data_table)
+        natgeo_processor.create_data_table(database, data_table, create_table_sqls(data_table, backend))
 
-    # 如果存在同名的数据库，则删除重建；如果不存在，则直接创建
-    natgeo_processor.delete_database(database)
-    natgeo_processor.create_database(database)
+        # 获取所有节目的基本信息：依次请求全部列表页，直到最早的节目
+        if episodes is None:
+            episodes = Sniffer(url, page_template=page_template).iter_episodes()
 
-    # 在数据库中创建数据表
-    natgeo_processor.delete_data_table(database, data_table)
-    natgeo_processor.create_data_table(database, data_table, create_database_sqls)
+        # 下载所有节目；下载清单中已经完成的资源不会重新下载
+        new_episodes = record_new_episodes(natgeo_processor, database, data_table, episodes, set())
+        finish_download(natgeo_processor, database, data_table, get_files(new_episodes))
 
-    # 保存基本信息到数据库指定的表中
-    natgeo_sqls = insert_sqls(data_table, all_basic_info)
-    natgeo_processor.modify_data(database, data_table, natgeo_sqls)
 
-    # 下载所有节目
-    get_files(all_basic_info)
+def update_download(url, username, password, database, data_table, backend='mysql', directory='../Data',
+                    page_template=None, episodes=None):
+    """
+    Func: 只下载与之前相比还没有下载过的最新更新的节目，以及之前下载中断或失败的节目
+    :param backend: 存储后端，'mysql'（默认）或 'sqlite'
+    :param directory: sqlite 保存数据库文件的目录
+    :param page_template: 后续列表页的网址模板，见 Sniffer
+    :param episodes: 可迭代对象，依次返回 (节目标题, 节目网址)；提供时不再从网站获取节目信息
+    """
+    # 所有数据库操作复用同一个处理器
+    with create_processor(backend, username, password, directory) as natgeo_processor:
+        known_urls = natgeo_processor.known_urls(database, data_table)
+        if known_urls is None:
+            logger.error('无法获取数据库中已有的节目信息，请检查！')
+            return
 
+        # 之前下载中断或失败的节目
+        pending_info = natgeo_processor.pending_episodes(database, data_table) or {}
 
-def update_download(url, username, password, database, data_table):
+        # 获取节目的基本信息：从最新的列表页开始翻页，碰到全部已经保存过的列表页时停止
+        # NOTE: 使用运行前数据库中已有网址的副本判断，本次写入的新节目不能影响翻页的判断
+        if episodes is None:
+            episodes = Sniffer(url, page_template=page_template).iter_episodes(known_urls=frozenset(known_urls))
+
+        # 先重试之前没有完成的节目，再下载新的节目；下载清单中已经完成的资源不会重新下载
+        new_episodes = record_new_episodes(natgeo_processor, database, data_table, episodes, known_urls)
+        finish_download(natgeo_processor, database, data_table,
+                        get_files(itertools.chain(pending_info.items(), new_episodes)))
+
+
+def record_new_episodes(processor, database, data_table, episodes, known_urls, batch_size=INSERT_BATCH_SIZE):
     """
-    Func: 只下载与之前相比还没有下载过的最新更新的节目
+    Func: 逐个检查节目信息，将数据库中没有的节目分批写入数据库后交给下载
+    :param processor: 数据库处理器
+    :param episodes: 可迭代对象，依次返回 (节目标题, 节目网址)
+    :param known_urls: 集合，数据库中已有的节目的网址（不会被修改）
+    :param batch_size: 每批写入的节目数量；最后不足一批的节目在 episodes 结束时写入
+    :return: 生成器，依次返回新的 (节目标题, 节目网址)
     """
-    # 获取所有节目的基本信息
-    natgeo_sniffer = Sniffer(url)
-    all_basic_info = natgeo_sniffer.get_all_episode_info()
-
-    # 将所有节目的基本信息保存到数据库中
-    natgeo_processor = DataProcess(username, password)
+    recorded = set()
+    batch = {}
+    for title, url in episodes:
+        if url in known_urls or url in recorded:
+            continue
+        logger.warning(f"节目【{title}】在数据库中没有保存。\n")
+        recorded.add(url)
+        # 同名的节目放在不同的批次中，避免字典中的标题被覆盖
+        if title in batch:
+            yield from _insert_batch(processor, database, data_table, batch)
+            batch = {}
+        batch[title] = url
+        if len(batch) >= batch_size:
+            yield from _insert_batch(processor, database, data_table, batch)
+            batch = {}
+
+    if batch:
+        yield from _insert_batch(processor, database, data_table, batch)
+
+
+def _insert_batch(processor, database, data_table, batch):
+    """
+    Func: 将一批新节目写入数据库，再依次返回这些节目
+    """
+    processor.insert_episodes(database, data_table, batch)
+    yield from batch.items()
 
-    # 更新的节目信息
-    new_basic_info = natgeo_processor.check_latest_issue(database, data_table, all_basic_info)
 
-    if new_basic_info is None or len(new_basic_info) < 1:
-        logger.warning('没有节目更新，无需处理！')
+def finish_download(processor, database, data_table, urls):
+    """
+    Func: 将全部资源都已经下载完成的节目的下载状态更新为 'YES'
+    :param processor: 数据库处理器
+    :param urls: get_files() 的返回值，全部资源都已经下载完成的节目的网址
+    """
+    if not urls:
+        logger.warning('没有节目更新，或者本次没有全部资源都下载完成的节目。')
         return
 
-    # 更新数据库，写入最新的节目信息
-    new_natgeo_sqls = insert_sqls(data_table, new_basic_info)
-    natgeo_processor.modify_data(database, data_table, new_natgeo_sqls)
-
-    # 下载更新的节目
-    get_files(new_basic_info)
+    processor.update_download_status(database, data_table, urls)
 
 
 def insert_sqls(table, data):
     """
-    Func: 构造插入数据的SQL语句
+    Func: 构造插入数据的SQL语句。逐条执行较慢，批量写入请使用 DataProcess.insert_episodes()
     :param table: 保存数据的数据表
     :param data: 字典，保存需要插入的数据
     :return: 列表，保存构造好的sql语句
@@ -78,6 +180,8 @@ def insert_sqls(table, data):
     if not check_instance(table=table, data=data):
         return
 
+    from pymysql.converters import escape_str
+
     sqls = []
     for title, url in data.items():
         title = escape_str(title)
@@ -89,8 +193,13 @@ def insert_sqls(table, data):
     return sqls
 
 
+logger = log_setting('Overheard_download', '../Logs')
+
+
 if __name__ == '__main__':
-    logger = log_setting('Overheard_download', '../Logs')
+    # 所有模块的日志写入同一个文件（../Logs/Overheard-<时间>-<进程号>.log），超过 20MB 时轮转，
+    # 轮转出来的旧文件使用 gzip 压缩；需要用程序检索日志时，可以再加上 json_lines=True
+    configure_logging('../Logs', compress=True)
     if logger is None:
         sys.exit()
 
@@ -113,20 +222,33 @@ if __name__ == '__main__':
     natgeo_db = database_info["database"]
     natgeo_dt = database_info["data_table"]
 
-    # 创建数据表的SQL语句
-    create_database_sqls = [f"DROP TABLE IF EXISTS `{database_info['data_table']}`;",
-                            f"CREATE TABLE `{database_info['data_table']}` ( "
-                            "`NUM` int NOT NULL AUTO_INCREMENT COMMENT '序号', "
-                            "`TITLE` varchar(255) NOT NULL COMMENT '标题', "
-                            "`URL` varchar(255) DEFAULT NULL COMMENT '链接', "
-                            "`DOWNLOAD_STATUS` varchar(255) NOT NULL DEFAULT 'NO' COMMENT '下载状态',"
-                            "`UPDATED_TIME` datetime DEFAULT NULL COMMENT '更新时间', "
-                            "PRIMARY KEY ( `NUM`) "
-                            ") "
-                            "ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci COMMENT='所有节目的标题和链接';"
-                            ]
+    # 开启HTTP缓存：再次运行时发送条件请求，主页和网页没有变化时不再重新传输
+    configure_cache('../Cache')
+
+    # 开启文件仓库：相同内容的图片和音频只保存一份，节目目录中是指向仓库的硬链接，下载过的链接不再下载
+    # 仓库需要与节目目录在同一个磁盘上，才能使用硬链接
+    configure_store(r'D:\National Geographic\Overheard\.blobs')
+
+    # 每次下载结束时保存指标：Prometheus 文本格式（可以交给 node_exporter 的 textfile collector）和 JSON 汇总
+    configure_metrics(prometheus_file='../Data/overheard.prom', summary_file='../Data/last_run.json')
+
+    # 开启下载调度：限制各主机的请求频率，音频同时下载的字节数不超过 512MB；排队时网页优先，音频最后
+    configure_scheduler(host_rates={'www.nationalgeographic.com': 2, 'i.natgeofe.com': 5}, default_rate=5,
+                        max_inflight_bytes=512 * 1024 * 1024)
+
+    # 音频服务器对每个连接限速：支持 Range 请求时，8MB 以上的音频分成 4 段同时下载
+    configure_segments(4)
+
+    # 保留网页原始内容的目录（在后台写入，不影响下载速度），需要排查网页解析的问题时设置为 '../HTMLs'；None 表示不保存
+    natgeo_archive = None
+    if natgeo_archive:
+        configure_archive(natgeo_archive)
+
     # 全量下载
     # download_all(natgeo_homepage, natgeo_user, natgeo_passwd, natgeo_db, natgeo_dt)
 
     # 增量下载
     update_download(natgeo_homepage, natgeo_user, natgeo_passwd, natgeo_db, natgeo_dt)
+
+    # 不想安装 MySQL 时，可以使用内嵌的 SQLite 保存节目信息（数据库文件保存在 ../Data 目录中）
+    # update_download(natgeo_homepage, None, None, natgeo_db, natgeo_dt, backend='sqlite')
@@ -0,0 +1,118 @@
+# -*- encoding: utf-8 -*-
+
+import datetime
+import re
+
+
+# 正文中碰到以下内容开头的段落，表示正文结束
+TRANSCRIPT_END = ('SHOW NOTES', 'SHOWNOTES', 'Show Notes', 'Want more')
+
+# 标题中不能用于文件名的特殊字符
+SPECIAL_CHARS = re.compile(r'[:/\\*?<>\]\["|]')
+
+
+def sanitize_title(title):
+    """
+    Func: 使用 '_' 替换掉标题中的特殊字符（[]\/:*?"<>|），否则会干扰文件命名。
+          Sniffer 和 Downloader 使用同一个方法，同一期节目的标题处理结果始终一致；重复处理结果不变
+    """
+    return SPECIAL_CHARS.sub('_', title)
+
+
+def parse_html(content, content_type=None):
+    """
+    Func: 直接在内存中解析网页的原始内容
+    :param content: 网页的原始内容（bytes）
+    :param content_type: 响应头中的 Content-Type；其中声明了字符集时使用该字符集，否则由 lxml 根据 <meta> 判断
+    :return: lxml 解析得到的根节点
+    """
+    from lxml import etree
+
+    charset = re.search(r'charset=["\']?([\w-]+)', content_type or '', re.I)
+    parser = etree.HTMLParser(encoding=charset.group(1) if charset else None)
+    return etree.fromstring(content, parser)
+
+
+class EpisodeDocument:
+    def __init__(self, html):
+        """
+        Func: 一次性解析某一期节目的网页，保存后续步骤需要用到的全部信息
+        :param html: lxml 解析得到的 ElementTree 或根节点
+        获取失败的字段保存为 None（列表字段保存为 []），由使用者决定如何处理
+        """
+        # 发布日期，数字格式(2023-03-20)
+        self.publish_date = self.__parse_publish_date(html)
+
+        # 标题描述和文章简介
+        self.headline = html.xpath('//p[@class="Article__Headline__Desc"]//text()')
+        self.preface = html.xpath('//section[@class="Article__Content"]/div[1]/p[1]//text()')
+
+        # 正文的各个段落
+        self.transcript = self.__parse_transcript(html)
+
+        # 封面图片的链接、说明和拍摄者
+        self.picture_url = self.__parse_picture_url(html)
+        self.picture_caption = self.__first(html.xpath('//span[@class="RichText"]//text()'))
+        self.picture_credit = self.__first(html.xpath('//span[contains(@class,"Caption__Credit")]//text()'))
+
+        # 音频播放器的链接（嵌入的 iframe）
+        self.player_url = self.__parse_player_url(html)
+
+    @classmethod
+    def from_bytes(cls, content, content_type=None):
+        """
+        Func: 直接从网页的原始内容中解析节目信息，无需写入磁盘
+        """
+        return cls(parse_html(content, content_type))
+
+    @classmethod
+    def from_file(cls, path):
+        """
+        Func: 从保存的HTML文件中解析节目信息
+        """
+        from lxml import etree
+
+        return cls(etree.parse(path, etree.HTMLParser()))
+
+    @staticmethod
+    def __first(items):
+        return items[0] if items else None
+
+    @staticmethod
+    def __parse_publish_date(html):
+        # 将英文格式(March 20, 2023)的日期 修改为 数字格式(2023-03-20)，方便后续使用该信息
+        try:
+            publish_info = html.xpath('//div[@class="Byline__Meta Byline__Meta--publishDate"]//text()')
+            date_info = publish_info[0].replace('Published ', '')
+            time_format = datetime.datetime.strptime(date_info, '%B %d, %Y')
+            return datetime.datetime.strftime(time_format, '%Y-%m-%d')
+        except (IndexError, ValueError):
+            return None
+
+    @staticmethod
+    def __parse_transcript(html):
+        # 从第2个<p>开始算是正文
+        paragraphs = []
+        for item in html.xpath('//section[@class="Article__Content"]//div[1]//p')[2:]:
+            # item.xpath('string(.)') 获取每个节点的文本，并将其转换为字符串
+            text = str(item.xpath('string(.)'))
+            if text.startswith(TRANSCRIPT_END):
+                break
+            paragraphs.append(text)
+        return paragraphs
+
+    @staticmethod
+    def __parse_picture_url(html):
+        try:
+            return html.xpath('//div[contains(@class,"Image__Wrapper")]//source[last()]/@srcset')[0].split(' ')[1]
+        except IndexError:
+            return None
+
+    @staticmethod
+    def __parse_player_url(html):
+        # 优先使用 iHeart 的播放器，否则与浏览器的处理方式一致，使用第一个 iframe
+        sources = html.xpath('//iframe/@src')
+        sources = [src for src in sources if 'iheart' in src] or sources
+        if not sources:
+            return None
+        return 'https:' + sources[0] if sources[0].startswith('//') else sources[0]
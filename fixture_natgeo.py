@@ -0,0 +1,251 @@
+# -*- encoding: utf-8 -*-
+
+import datetime
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+# 列表页、节目网页、图片、音频和播放器接口的路径
+HOME_PATH = '/podcasts/overheard/'
+EPISODE_PATH = re.compile(r'^/podcasts/article/episode-(\d+)$')
+PICTURE_PATH = re.compile(r'^/images/(\d+)\.jpg$')
+AUDIO_PATH = re.compile(r'^/audio/(\d+)\.mp3$')
+API_PATH = re.compile(r'^/api/v3/podcast/episodes/(\d+)$')
+PLAYER_PATH = re.compile(r'^/podcast/1119-overheard/episode/episode-\d+-(\d+)/$')
+
+# 播放器中的节目编号 = EPISODE_ID_BASE + 节目序号
+EPISODE_ID_BASE = 1000000
+
+# 每次写入响应的数据块大小，限速时按数据块计算等待时间
+_WRITE_SIZE = 64 * 1024
+
+
+class FixtureSite:
+    def __init__(self, episodes=10, page_size=24, paragraphs=30, picture_size=32 * 1024, audio_size=256 * 1024,
+                 latency=0.0, bandwidth=None):
+        """
+        Func: 离线的 Overheard 模拟网站，生成与真实网页结构相同的列表页、节目网页、封面图片、合成的音频文件
+              和 iHeart 播放器接口，用于基准测试，不访问真实网站
+        :param episodes: 节目的数量，序号越大的节目越新
+        :param page_size: 每一页列表中的节目数量，列表页之间通过 rel="next" 链接
+        :param paragraphs: 每一期节目正文的段落数
+        :param picture_size: 每张封面图片的大小（字节）
+        :param audio_size: 每个音频文件的大小（字节）
+        :param latency: 每个请求的额外延迟（秒）
+        :param bandwidth: 每个响应的传输速度上限（字节/秒），None 表示不限速
+        """
+        self.episodes = episodes
+        self.page_size = page_size
+        self.paragraphs = paragraphs
+        self.picture_size = picture_size
+        self.audio_size = audio_size
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.base_url = None
+        # 所有文件共用的填充内容，每个文件的开头写入各自的序号，内容互不相同
+        self.__filler = bytes(range(256)) * (max(picture_size, audio_size) // 256 + 1)
+        self.__server = None
+        self.__thread = None
+
+    def start(self):
+        """
+        Func: 在后台线程中启动HTTP服务，端口由系统分配
+        :return: 网站的根地址，例如 http://127.0.0.1:54321
+        """
+        site = self
+
+        class Handler(FixtureHandler):
+            fixture = site
+
+        self.__server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.__server.daemon_threads = True
+        self.base_url = f'http://127.0.0.1:{self.__server.server_address[1]}'
+        self.__thread = threading.Thread(target=self.__server.serve_forever, name='fixture-site', daemon=True)
+        self.__thread.start()
+        return self.base_url
+
+    def stop(self):
+        if self.__server is not None:
+            self.__server.shutdown()
+            self.__server.server_close()
+            self.__server = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    @property
+    def home_url(self):
+        return self.base_url + HOME_PATH
+
+    @property
+    def pages(self):
+        return max(1, -(-self.episodes // self.page_size))
+
+    def title(self, number):
+        return f'Episode {number}: Sounds of the deep [{number}]'
+
+    def episode_url(self, number):
+        return f'{self.base_url}/podcasts/article/episode-{number}'
+
+    def episode_info(self):
+        """
+        Func: 全部节目的标题和网址，由新到旧排列，与列表页中的顺序一致
+        """
+        return {self.title(number): self.episode_url(number) for number in range(self.episodes, 0, -1)}
+
+    def publish_date(self, number):
+        return datetime.date(2023, 3, 20) - datetime.timedelta(days=7 * (self.episodes - number))
+
+    def listing_html(self, page):
+        """
+        Func: 第 page 页列表，第1页中最新的一期使用 PromoTile，其余使用 RegularStandardPrismTile
+        """
+        first = self.episodes - (page - 1) * self.page_size
+        numbers = range(first, max(0, first - self.page_size), -1)
+
+        tiles = []
+        for number in numbers:
+            css = 'PromoTile__Link' if page == 1 and number == self.episodes else 'RegularStandardPrismTile__ContentLink'
+            tiles.append(f'<a class="AnchorLink {css}" href="{self.episode_url(number)}">{self.title(number)}</a>')
+
+        next_link = f'<link rel="next" href="{HOME_PATH}?page={page + 1}">' if page < self.pages else ''
+        return (f'<html><head><meta charset="utf-8"><title>Overheard</title>{next_link}</head>'
+                f'<body><main>{"".join(tiles)}</main></body></html>')
+
+    def episode_html(self, number):
+        date = self.publish_date(number)
+        paragraphs = ''.join(f'<p>{"HOST" if i % 2 else "GUEST"}: paragraph {i} of episode {number} ’quoted’ '
+                             f'“text” about the ocean and the people who study it.</p>'
+                             for i in range(self.paragraphs))
+        return (f'<html><head><meta charset="utf-8"><title>{self.title(number)}</title></head><body>'
+                f'<p class="Article__Headline__Desc">Headline of episode {number}</p>'
+                f'<div class="Byline__Meta Byline__Meta--publishDate">'
+                f'Published {date.strftime("%B")} {date.day}, {date.year}</div>'
+                f'<div class="Image__Wrapper"><picture>'
+                f'<source srcset="2x {self.base_url}/images/{number}.jpg"></picture></div>'
+                f'<span class="RichText">Caption of episode {number}</span>'
+                f'<span class="Caption__Credit">Photograph by Fixture</span>'
+                # 播放器同样由模拟网站提供，播放器接口获取失败时也不会访问真实的网站
+                f'<iframe src="{self.base_url}/podcast/1119-overheard/episode/'
+                f'episode-{number}-{EPISODE_ID_BASE + number}/?embed=true"></iframe>'
+                f'<section class="Article__Content"><div>'
+                f'<p>Preface of episode {number}.</p><p>Transcript</p>{paragraphs}'
+                f'<p>SHOW NOTES</p><p>Not part of the transcript.</p>'
+                f'</div></section></body></html>')
+
+    def file_content(self, number, size):
+        prefix = f'FIXTURE-{number:08d}-'.encode('ascii')
+        return (prefix + self.__filler)[:size]
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    # 由 FixtureSite.start() 设置
+    fixture = None
+    protocol_version = 'HTTP/1.1'
+    # 响应头和内容分开写入，不关闭 Nagle 算法时每个请求会多出约 40 毫秒的延迟
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        site = self.fixture
+        if site.latency:
+            time.sleep(site.latency)
+
+        parts = urlsplit(self.path)
+        path = parts.path
+
+        if path == HOME_PATH:
+            page = int(parse_qs(parts.query).get('page', ['1'])[0])
+            if 1 <= page <= site.pages:
+                return self.__send(site.listing_html(page).encode('utf-8'), 'text/html; charset=utf-8',
+                                   etag=f'"list-{site.episodes}-{page}"')
+
+        match = EPISODE_PATH.match(path)
+        if match and 1 <= int(match.group(1)) <= site.episodes:
+            return self.__send(site.episode_html(int(match.group(1))).encode('utf-8'), 'text/html; charset=utf-8',
+                               etag=f'"episode-{match.group(1)}"')
+
+        match = PICTURE_PATH.match(path)
+        if match and 1 <= int(match.group(1)) <= site.episodes:
+            return self.__send(site.file_content(int(match.group(1)), site.picture_size), 'image/jpeg',
+                               etag=f'"picture-{match.group(1)}"', ranges=True)
+
+        match = AUDIO_PATH.match(path)
+        if match and 1 <= int(match.group(1)) <= site.episodes:
+            return self.__send(site.file_content(int(match.group(1)), site.audio_size), 'audio/mpeg',
+                               etag=f'"audio-{match.group(1)}"', ranges=True)
+
+        match = API_PATH.match(path)
+        if match and 1 <= int(match.group(1)) - EPISODE_ID_BASE <= site.episodes:
+            number = int(match.group(1)) - EPISODE_ID_BASE
+            body = json.dumps({'episode': {'id': int(match.group(1)),
+                                           'mediaUrl': f'{site.base_url}/audio/{number}.mp3'}})
+            return self.__send(body.encode('utf-8'), 'application/json')
+
+        match = PLAYER_PATH.match(path)
+        if match and 1 <= int(match.group(1)) - EPISODE_ID_BASE <= site.episodes:
+            number = int(match.group(1)) - EPISODE_ID_BASE
+            media = json.dumps(f'{site.base_url}/audio/{number}.mp3').replace('/', '\\/')
+            body = f'<html><body><script>window.__DATA__ = {{"mediaUrl": {media}}};</script></body></html>'
+            return self.__send(body.encode('utf-8'), 'text/html; charset=utf-8')
+
+        self.__send(b'Not Found', 'text/plain', status=404)
+
+    def __send(self, body, content_type, status=200, etag=None, ranges=False):
+        """
+        Func: 发送响应；支持 If-None-Match（304）和 Range（206），并按 bandwidth 限速
+        """
+        if etag and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        total = len(body)
+        start, end = 0, total
+        range_header = self.headers.get('Range', '')
+        match = re.match(r'bytes=(\d+)-(\d*)$', range_header) if ranges else None
+        if match and (not self.headers.get('If-Range') or self.headers.get('If-Range') == etag):
+            start = int(match.group(1))
+            if match.group(2):
+                end = min(int(match.group(2)) + 1, total)
+            if start >= end:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{total}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            status = 206
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(end - start))
+        if etag:
+            self.send_header('ETag', etag)
+        if ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        if status == 206:
+            self.send_header('Content-Range', f'bytes {start}-{end - 1}/{total}')
+        self.end_headers()
+
+        bandwidth = self.fixture.bandwidth
+        try:
+            for offset in range(start, end, _WRITE_SIZE):
+                chunk = body[offset:min(offset + _WRITE_SIZE, end)]
+                self.wfile.write(chunk)
+                if bandwidth:
+                    time.sleep(len(chunk) / bandwidth)
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端提前关闭了连接（例如分段下载时只读取了第一个分段）
+            self.close_connection = True
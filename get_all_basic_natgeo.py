@@ -1,52 +1,169 @@
 # -*- encoding: utf-8 -*-
 
-import os
-import re
-
-import requests
-from lxml import etree
+from urllib.parse import urljoin
 
+from archive_natgeo import archive_html
+from cache_natgeo import async_cached_http_get, cached_http_get
+from episode_natgeo import parse_html, sanitize_title
 from log_overheard import log_setting
+from metrics_natgeo import metrics
+from session_natgeo import load_aiohttp
 
 
 class Sniffer:
-    def __init__(self, url):
+    def __init__(self, url, page_template=None, max_pages=None):
+        """
+        :param url: Overheard主页（第1页列表页）的网址
+        :param page_template: 后续列表页的网址模板，例如 'https://.../overheard/?page={page}'；
+                              网页中有 rel="next" 的下一页链接时优先使用该链接，两者都没有时只请求主页
+        :param max_pages: 最多请求的列表页数量，默认不限制
+        """
         self.url = url
-        self.raw_html = '../HTMLs/overheard.html'
+        self.page_template = page_template
+        self.max_pages = max_pages
+        # 开启了网页保存（archive_natgeo.configure_archive）时，主页保存的文件名；后续列表页依次加上页码
+        self.raw_html = 'overheard.html'
+        self.__content = None
+        self.__content_type = None
+
+    def __page_name(self, page):
+        return self.raw_html if page == 1 else self.raw_html.replace('.html', f'_{page}.html')
+
+    def __get_html(self, url, page=1):
+        """
+        Func: 获取Overheard列表页的信息，内容保存在内存中，并按需在后台保存为HTML文件；
+              开启了HTTP缓存时发送条件请求，网页没有变化则使用缓存的内容
+        Return: boolean - 获取成功则返回True，获取失败返回False
+        """
+        try:
+            logger.info(f'开始请求Overheard第【{page}】页列表 {url} ... ')
+            r = cached_http_get(url)
+            r.raise_for_status()
+            return self.__keep_html(r.content, r.headers.get('Content-Type'), page)
+        except Exception as e:
+            logger.error(f'Overheard第【{page}】页列表请求失败，请检查：{e}。\n')
+            return False
 
-    def __get_html(self):
+    async def __async_get_html(self, session, url, page=1):
         """
-        Func: 获取Overheard主页信息，并将其保存为HTML格式
+        Func: __get_html() 的异步版本
+        Param: session: aiohttp.ClientSession
         Return: boolean - 获取成功则返回True，获取失败返回False
         """
         try:
-            logger.info('开始请求Overheard主页，并将其内容保存到HTML文件中 ... ')
-            r = requests.get(self.url)
-            with open(self.raw_html, 'w', encoding='utf-8') as f:
-                f.write(r.text)
-            logger.info(f'Overheard主页的HTML文件【{self.raw_html}】保存完成。\n')
-            return True
+            logger.info(f'开始异步请求Overheard第【{page}】页列表 {url} ... ')
+            status, content, content_type = await async_cached_http_get(session, url)
+            if status != 200:
+                raise ValueError(f'返回码为【{status}】')
+            return self.__keep_html(content, content_type, page)
         except Exception as e:
-            logger.error(f'Overheard主页请求失败，请检查：{e}。\n')
+            logger.error(f'Overheard第【{page}】页列表请求失败，请检查：{e}。\n')
             return False
 
-    def get_all_episode_info(self):
+    def __keep_html(self, content, content_type, page=1):
+        """
+        Func: 保存Overheard列表页的原始内容，用于后续解析
+        """
+        self.__content = content
+        self.__content_type = content_type
+        archive_html(self.__page_name(page), content)
+        logger.info(f'Overheard第【{page}】页列表请求完成。\n')
+        return True
+
+    def iter_episodes(self, known_urls=None):
+        """
+        Func: 从主页开始，由新到旧依次请求各个列表页，每解析完一页就逐个返回该页上的新节目，
+              调用者可以在后续列表页返回之前开始处理已经返回的节目
+        Param: known_urls: 已经保存过的节目的网址（集合）。提供时为增量模式：
+                           某一页上的节目全部已知时，更早的节目也都已经保存过，停止翻页
+        Return: 生成器，依次返回 (节目标题, 节目网址)；主页获取失败时什么也不返回
+        """
+        seen = set()
+        url, page = self.url, 1
+        while url:
+            with metrics.timer('stage_seconds', stage='listing'):
+                if not self.__get_html(url, page):
+                    return
+                new_info, next_url = self.__parse_new_episodes(url, page, seen)
+            yield from new_info.items()
+            if not self.__should_continue(new_info, page, known_urls):
+                return
+            url, page = next_url, page + 1
+
+    def get_all_episode_info(self, known_urls=None):
+        """
+        Func: 获取所有节目的信息，见 iter_episodes()
+        Return: 一个保存每期节目标题和对应网址的字典；没有获取到任何节目（例如主页获取失败）时返回False
+        """
+        return dict(self.iter_episodes(known_urls)) or False
+
+    async def async_get_all_episode_info(self, session=None, known_urls=None):
         """
-        Func: 获取Overheard主页上所有节目的信息
-        Return: 一个保存每期节目标题和对应网址的字典
+        Func: get_all_episode_info() 的异步版本
+        Param: session: aiohttp.ClientSession，不提供则临时创建一个
+        Param: known_urls: 已经保存过的节目的网址（集合），见 iter_episodes()
+        Return: 一个保存每期节目标题和对应网址的字典；没有获取到任何节目时返回False
         """
-        # 判断 Overheard主页的HTML文件是否存在
-        if self.__get_html():
-            if not os.path.exists(self.raw_html):
-                logger.error(f'Overheard主页的HTML文件【{self.raw_html}】不存在，请检查。\n')
+        if session is None:
+            # 异步模式为可选功能，未安装 aiohttp 时只能使用同步接口
+            aiohttp = load_aiohttp()
+            if aiohttp is None:
+                logger.error('没有安装 aiohttp 模块，无法使用异步模式，请检查！\n')
                 return False
-        else:
+            async with aiohttp.ClientSession() as session:
+                return await self.async_get_all_episode_info(session, known_urls)
+
+        seen = set()
+        issue_info = {}
+        url, page = self.url, 1
+        while url:
+            with metrics.timer('stage_seconds', stage='listing'):
+                if not await self.__async_get_html(session, url, page):
+                    break
+                new_info, next_url = self.__parse_new_episodes(url, page, seen)
+            issue_info.update(new_info)
+            if not self.__should_continue(new_info, page, known_urls):
+                break
+            url, page = next_url, page + 1
+        return issue_info or False
+
+    def __parse_new_episodes(self, url, page, seen):
+        """
+        Func: 解析当前列表页，只保留之前的列表页中没有出现过的节目
+        Param: seen: 集合，已经返回过的节目的网址，会加入本页新的节目
+        Return: (保存新节目标题和网址的字典, 下一页的网址)
+        """
+        page_info, next_url = self.__parse_episode_info(url, page)
+        new_info = {title: link for title, link in page_info.items() if link not in seen}
+        seen.update(new_info.values())
+        metrics.inc('episodes_discovered_total', len(new_info))
+        return new_info, next_url
+
+    def __should_continue(self, new_info, page, known_urls):
+        """
+        Func: 判断是否需要继续请求下一页列表
+        """
+        if not new_info:
+            # 列表页为空，或者与之前的列表页内容相同（网站忽略了页码），说明已经没有更早的节目
+            logger.info(f'第【{page}】页列表中没有新的节目，停止翻页。\n')
             return False
+        if known_urls is not None and all(link in known_urls for link in new_info.values()):
+            logger.info(f'第【{page}】页列表中的节目都已经保存过，停止翻页。\n')
+            return False
+        if self.max_pages and page >= self.max_pages:
+            logger.info(f'已经请求了【{page}】页列表，达到上限，停止翻页。\n')
+            return False
+        return True
 
-        # 开始处理HTML文件
+    def __parse_episode_info(self, url, page):
+        """
+        Func: 在内存中解析Overheard列表页的内容，获取该页上所有节目的信息和下一页的网址
+        Return: (保存每期节目标题和对应网址的字典, 下一页的网址)；解析失败时返回 ({}, None)
+        """
+        # 开始解析列表页的内容
         try:
-            logger.info('开始获取 Overheard主页上所有节目的信息 ... ')
-            html = etree.parse(self.raw_html, etree.HTMLParser())
+            logger.info(f'开始获取 Overheard第【{page}】页列表上所有节目的信息 ... ')
+            html = parse_html(self.__content, self.__content_type)
 
             # 最新一期的标题和链接
             latest_title = html.xpath('//a[@class="AnchorLink PromoTile__Link"]//text()')
@@ -56,20 +173,28 @@ class Sniffer:
             titles = html.xpath('//a[@class="AnchorLink RegularStandardPrismTile__ContentLink"]//text()')
             urls = html.xpath('//a[@class="AnchorLink RegularStandardPrismTile__ContentLink"]//@href')
 
-            # 使用 '_' 来替换掉标题中的特殊字符（[\/:*?<>|]），否则会干扰文件命名
-            fine_titles = []
-            special_str = r'[:/\\*?<>|]'
-            for item in latest_title + titles:
-                fine_titles.append(re.sub(special_str, "_", item))
+            # 使用 '_' 来替换掉标题中的特殊字符，否则会干扰文件命名
+            fine_titles = [sanitize_title(item) for item in latest_title + titles]
 
             # 将所有标题和对应的链接合并到一个字典内
-            issue_info = dict(zip(fine_titles, latest_url + urls))
-            logger.info('获取所有节目信息完成。\n')
+            issue_info = dict(zip(fine_titles, [urljoin(url, link) for link in latest_url + urls]))
+            logger.info(f'获取第【{page}】页列表上的节目信息完成，共【{len(issue_info)}】期。\n')
 
-            return issue_info
+            return issue_info, self.__next_page_url(html, url, page)
         except Exception as e:
-            logger.error(f'获取 Overheard主页上的节目信息出现错误，请检查：{e}\n')
-            return False
+            logger.error(f'获取 Overheard第【{page}】页列表上的节目信息出现错误，请检查：{e}\n')
+            return {}, None
+
+    def __next_page_url(self, html, url, page):
+        """
+        Func: 获取下一页列表的网址：优先使用网页中 rel="next" 的链接，其次使用 page_template
+        """
+        links = html.xpath('//link[@rel="next"]/@href | //a[@rel="next"]/@href')
+        if links:
+            return urljoin(url, links[0])
+        if self.page_template:
+            return self.page_template.format(page=page + 1)
+        return None
 
 
 logger = log_setting('Overheard_get_basic', '../Logs')
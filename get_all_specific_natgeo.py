@@ -1,25 +1,85 @@
 # -*- encoding: utf-8 -*-
 
+import asyncio
 import datetime
+import os
+import threading
 import time
+from contextlib import contextmanager
+
+from archive_natgeo import archive_html, wait_archive
+from audio_natgeo import resolve_audio_url
+from browser_natgeo import WebDriverPool, click_audio_url, is_browser_error, new_driver
+from cache_natgeo import async_cached_http_get, cached_http_get
+from episode_natgeo import EpisodeDocument, sanitize_title
+from get_all_basic_natgeo import Sniffer
+from log_overheard import log_setting
+from manifest_natgeo import ASSETS, DEFAULT_MANIFEST, open_manifest
+from metrics_natgeo import metrics, report_run
+from scheduler_natgeo import AUDIO, PICTURE
+from session_natgeo import load_aiohttp
+from store_natgeo import async_stored_download, stored_digest, stored_download
+from transfer_natgeo import max_segments
 
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support import expected_conditions as ec
-from selenium.webdriver.support.ui import WebDriverWait
 
-from get_all_basic_natgeo import *
-from log_overheard import log_setting
+# 可以选择执行的阶段；网页只请求和解析一次，由选中的阶段共用
+# text: 文本；picture_info: 图片链接和说明；picture: 封面图片；audio: 音频链接和音频文件
+STAGES = ('text', 'picture_info', 'picture', 'audio')
+
+
+def check_stages(stages):
+    """
+    Func: 检查选择的阶段是否合法
+    :return: 按 STAGES 中的顺序排列的元组；包含未知的阶段或者为空时返回 None
+    """
+    if isinstance(stages, str):
+        stages = [stages]
+    unknown = set(stages or ()) - set(STAGES)
+    if unknown or not stages:
+        logger.error(f'选择的阶段 {stages} 不合法，只能从 {STAGES} 中选择，请检查！')
+        return None
+    return tuple(stage for stage in STAGES if stage in stages)
 
 
 class Downloader:
-    def __init__(self, title, url, save_path=None):
-        title = re.sub(r'[:/\\*?<>\]\[|]', "_", title)      # 使用 _ 替换掉标题中的 特殊字符
+    def __init__(self, title, url, save_path=None, driver_pool=None, browser_fetch=False, manifest=None,
+                 stages=STAGES, api_base=None):
+        """
+        :param driver_pool: WebDriverPool，需要使用浏览器时从中获取；不提供则每次临时启动一个浏览器
+        :param browser_fetch: 是否只使用浏览器打开一次网页：网页内容取自浏览器渲染后的 DOM，
+                              并在同一次加载中获取音频链接，不再单独请求网页
+        :param manifest: DownloadManifest，记录每项资源的下载状态；提供时跳过已经完成的资源
+        :param stages: 需要执行的阶段，STAGES 的子集；例如 ('text', 'picture_info', 'picture') 只下载文本和图片，
+                       不会获取音频链接，也不会启动浏览器（browser_fetch 除外）；包含未知的阶段或者为空时抛出 ValueError
+        :param api_base: 播放器接口的地址，默认为 audio_natgeo.IHEART_API；测试时可以替换为本地的模拟服务
+        """
+        checked = check_stages(stages)
+        if checked is None:
+            # 不能退回到全部阶段，否则只需要文本的调用者也会启动浏览器、下载音频
+            raise ValueError(f'选择的阶段 {stages} 不合法，只能从 {STAGES} 中选择')
+        title = sanitize_title(title)      # 使用 _ 替换掉标题中的 特殊字符
         self.title = title
         self.url = url
         self.save_path = save_path
+        self.driver_pool = driver_pool
+        self.browser_fetch = browser_fetch
+        self.manifest = manifest
+        self.stages = checked
+        self.api_base = api_base
+        # 本次运行中各项资源的状态（done/failed）和各阶段的耗时（秒），见 result()；
+        # 流水线模式下图片和音频阶段在不同的线程中同时更新，读写时需要持有 __lock
+        self.asset_status = {}
+        self.timings = {}
+        self.__lock = threading.Lock()
+        self.__audio_url = None
         self.__publish_date = None
-        self.__raw_html = f'../HTMLs/{title}.html'
+        self.__located = False
+        # 已经写入下载清单的节目信息（标题和保存路径），每期节目只写入一次
+        self.__recorded_episode = None
+        self.__document = None
+        self.__content = None
+        self.__content_type = None
+        self.__raw_html = f'{title}.html'
         self.__text = title + '.txt'
         self.__picture = title + '.jpg'
         self.__picture_info = title + '_picture_info.txt'
@@ -28,24 +88,215 @@ class Downloader:
 
     def __request_url(self):
         """
-        Func: 获取网址的html文件；最多尝试访问两次
-        Return: html文件的路径；如果获取失败，则默认返回 None
+        Func: 获取网址的内容并保存在内存中；连接异常或服务器繁忙时，由共享的HTTP会话负责退避重试；
+              开启了HTTP缓存时发送条件请求，网页没有变化则使用缓存的内容
+        Return: 获取成功返回True；如果获取失败，则默认返回 None
         """
-        for i in range(2):
-            try:
-                logger.info(f'开始请求网址 {self.url} ... ')
-                result = requests.get(self.url)
+        if self.browser_fetch:
+            return self.__browser_request_url()
 
-                if result.status_code == 200:
-                    with open(self.__raw_html, 'w', encoding='utf-8') as f:
-                        f.write(result.text)
+        try:
+            logger.info(f'开始请求网址 {self.url} ... ')
+            result = cached_http_get(self.url)
 
-                    logger.info(f'网页的html文件【{self.__raw_html}】保存完成。\n')
-                    return self.__raw_html
-                else:
-                    logger.error(f'网址请求异常，返回码为【{result.status_code}】，请检查！\n')
-            except Exception as e:
-                logger.error(f'网址请求出现错误，请检查：{e}\n')
+            if result.status_code == 200:
+                return self.__keep_html(result.content, result.headers.get('Content-Type'))
+            else:
+                logger.error(f'网址请求异常，返回码为【{result.status_code}】，请检查！\n')
+                self.__record_failed('html', f'HTTP {result.status_code}')
+        except Exception as e:
+            logger.error(f'网址请求出现错误，请检查：{e}\n')
+            self.__record_failed('html', e)
+
+    async def __async_request_url(self, session):
+        """
+        Func: __request_url() 的异步版本
+        Param: session: aiohttp.ClientSession
+        Return: 获取成功返回True；如果获取失败，则默认返回 None
+        """
+        try:
+            logger.info(f'开始异步请求网址 {self.url} ... ')
+            status, content, content_type = await async_cached_http_get(session, self.url)
+            if status == 200:
+                # 计算校验值、写入清单在线程中执行，不阻塞事件循环
+                return await asyncio.to_thread(self.__keep_html, content, content_type)
+            else:
+                logger.error(f'网址请求异常，返回码为【{status}】，请检查！\n')
+                self.__record_failed('html', f'HTTP {status}')
+        except Exception as e:
+            logger.error(f'网址请求出现错误，请检查：{e}\n')
+            self.__record_failed('html', e)
+
+    def __browser_request_url(self):
+        """
+        Func: 使用浏览器打开网页，将渲染后的 DOM 作为网页内容，并在同一次加载中获取音频链接
+        Return: 获取成功返回True；如果获取失败，则默认返回 None
+        """
+        try:
+            with self.__borrow_driver() as driver:
+                logger.info(f'开始使用浏览器请求网址 {self.url} ... ')
+                driver.get(self.url)
+                self.__keep_html(driver.page_source.encode('utf-8'), 'text/html; charset=utf-8')
+
+                # 浏览器已经打开了网页，趁此获取音频链接，之后无需再次打开
+                self.__audio_url = self.__get_static_audio_url() or self.__click_audio_url(driver, load=False)
+            return True
+        except Exception as e:
+            logger.error(f'使用浏览器请求网址出现错误，请检查：{e}\n')
+            self.__record_failed('html', e)
+
+    def __keep_html(self, content, content_type):
+        """
+        Func: 保存网页的原始内容用于解析；开启了网页保存时，在后台将其写入html文件
+        Return: True
+        """
+        self.__content = content
+        self.__content_type = content_type
+        # 开启了网页保存时，html文件写入后再记录，清单中记录文件的路径，文件被删除后下次运行会重新请求网页；
+        # 否则网页只保存在内存中，记录其大小和校验值
+        if archive_html(self.__raw_html, content, self.__record_archived) is None:
+            self.__record_done('html', content=content)
+
+        # 网页已经更新，之前的解析结果失效
+        self.__document = None
+        logger.info(f'网页【{self.url}】请求完成。\n')
+        return True
+
+    def __record_archived(self, path):
+        """
+        Func: 网页的html文件保存结束后，在保存文件的线程中记录结果
+        """
+        if path:
+            self.__record_done('html', path)
+        else:
+            self.__record_failed('html', '保存html文件失败')
+
+    def __record_done(self, asset, path=None, content=None, **extra):
+        """
+        Func: 记录某项资源已经完成；使用了下载清单时同时写入清单
+        """
+        with self.__lock:
+            self.asset_status[asset] = 'done'
+            record_episode = self.save_path and self.__recorded_episode != (self.title, self.save_path)
+            if record_episode:
+                self.__recorded_episode = (self.title, self.save_path)
+        metrics.inc('assets_total', asset=asset, status='done')
+        if self.manifest is not None:
+            if record_episode:
+                self.manifest.update_episode(self.url, title=self.title, save_path=self.save_path)
+            self.manifest.mark_done(self.url, asset, path=path, content=content, **extra)
+
+    def __record_failed(self, asset, error=None, **extra):
+        with self.__lock:
+            self.asset_status[asset] = 'failed'
+        metrics.inc('assets_total', asset=asset, status='failed')
+        if self.manifest is not None:
+            self.manifest.mark_failed(self.url, asset, error, **extra)
+
+    @contextmanager
+    def __timed(self, stage):
+        """
+        Func: 记录某个阶段的耗时，累加到 timings 中，同时记录到 stage_seconds 指标
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.__lock:
+                self.timings[stage] = self.timings.get(stage, 0.0) + elapsed
+            metrics.observe('stage_seconds', elapsed, stage=stage)
+
+    def result(self):
+        """
+        Func: 该期节目的处理结果
+        Return: 字典，包括 title、url、save_path、status、assets（各项资源的状态）和 timings（各阶段的耗时）
+                资源的状态：done 本次完成；failed 本次失败；skipped 之前已经完成；pending 没有处理
+                节目的状态：complete 全部资源都已经完成；skipped 之前已经全部完成；incomplete 还有资源没有完成
+        """
+        with self.__lock:
+            asset_status, timings = dict(self.asset_status), dict(self.timings)
+
+        assets = {}
+        for asset in self.__selected_assets():
+            if asset in asset_status:
+                assets[asset] = asset_status[asset]
+            elif self.manifest is not None and self.manifest.is_done(self.url, asset):
+                assets[asset] = 'skipped'
+            else:
+                assets[asset] = 'pending'
+
+        if all(status == 'skipped' for status in assets.values()):
+            status = 'skipped'
+        elif all(status in ('done', 'skipped') for status in assets.values()):
+            status = 'complete'
+        else:
+            status = 'incomplete'
+        return {'title': self.title, 'url': self.url, 'save_path': self.save_path, 'status': status,
+                'assets': assets, 'timings': {stage: round(seconds, 6) for stage, seconds in timings.items()}}
+
+    def __selected_assets(self):
+        """
+        Func: 选中的阶段需要的资源：网页本身，加上各个阶段对应的资源
+        """
+        return [asset for asset in ASSETS if asset == 'html' or asset in self.stages]
+
+    def missing_assets(self):
+        """
+        Func: 获取该期节目中（选中的阶段需要的）还没有完成的资源；没有使用下载清单时，返回这些资源的全部
+        """
+        if self.manifest is None:
+            return self.__selected_assets()
+        return self.manifest.missing(self.url, self.__selected_assets())
+
+    def __prepare(self):
+        """
+        Func: 请求网页并获取发布日期和保存路径；已经请求过网页时不再重复请求
+        Return: 网页获取成功返回True，失败返回False
+        """
+        if self.__document is None and self.__content is None:
+            with self.__timed('fetch'):
+                fetched = self.__request_url()
+            if not fetched:
+                logger.info('网页请求失败，停止获取发布日期，请检查！\n')
+                return False
+        self.__locate()
+        return True
+
+    def __locate(self):
+        """
+        Func: 获取发布日期和保存路径，每一期节目只获取一次
+        """
+        if not self.__located:
+            self.__get_publish_date()
+            self.__get_save_path()
+            self.__located = True
+
+    def __resume_audio(self):
+        """
+        Func: 只缺少音频文件时，使用清单中记录的音频链接和保存路径直接下载，无需再次请求网页
+        Return: 下载成功返回True，其余情况返回 None
+        """
+        audio_url = self.manifest.asset(self.url, 'audio').get('url')
+        save_path = self.manifest.episode(self.url).get('save_path')
+        if not audio_url or not save_path or not os.path.exists(save_path):
+            return
+
+        logger.info('只缺少音频文件，使用清单中记录的音频链接继续下载 ... ')
+        self.save_path = save_path
+        return self.__get_audio_file(audio_url) or None
+
+    def __get_document(self):
+        """
+        Func: 获取网页的解析结果。每一期节目的网页只在内存中解析一次，后续步骤都使用该结果
+        Return: EpisodeDocument
+        """
+        if self.__document is None:
+            logger.info('开始解析网页 ... ')
+            self.__document = EpisodeDocument.from_bytes(self.__content, self.__content_type)
+            # 解析完成后不再需要原始内容
+            self.__content = None
+        return self.__document
 
     def __get_publish_date(self):
         """
@@ -53,13 +304,9 @@ class Downloader:
         """
         try:
             logger.info('开始获取节目的发布日期 ... ')
-            html = etree.parse(self.__raw_html, etree.HTMLParser())
-            publish_info = html.xpath('//div[@class="Byline__Meta Byline__Meta--publishDate"]//text()')
-            date_info = publish_info[0].replace('Published ', '')
-
-            # 将英文格式(March 20, 2023)的日期 修改为 数字格式(2023-03-20)，方便后续使用该信息
-            time_format = datetime.datetime.strptime(date_info, '%B %d, %Y')
-            self.__publish_date = datetime.datetime.strftime(time_format, '%Y-%m-%d')
+            self.__publish_date = self.__get_document().publish_date
+            if self.__publish_date is None:
+                raise ValueError('网页中没有找到格式正确的发布日期')
             logger.info(f'节目的发布日期为【{self.__publish_date}】\n ')
         except Exception as e:
             logger.error(f'获取发布日期出现异常，请检查：{e}\n')
@@ -106,9 +353,7 @@ class Downloader:
         """
         try:
             logger.info('开始获取标题描述和文章简介 ... ')
-            html = etree.parse(self.__raw_html, etree.HTMLParser())
-            title_desc = html.xpath('//p[@class="Article__Headline__Desc"]//text()')
-            preface = html.xpath('//section[@class="Article__Content"]/div[1]/p[1]//text()')
+            document = self.__get_document()
 
             logger.info('开始保存标题描述和文章简介 ... ')
             # 依次写入 链接、标题、作者、标题描述、文章简介
@@ -117,34 +362,19 @@ class Downloader:
                 f.write(self.title + '\n\n')
                 f.write('Nat Geo' + '\n\n')
                 f.write('【标题描述】' + '\n')
-                for item in title_desc:
+                for item in document.headline:
                     f.write(item.replace("’", "'").replace('“', '"').replace('”', '"'))
                 f.write('\n\n')
 
                 f.write('【文章简介】')
-                for item in preface:
+                for item in document.preface:
                     f.write(item.replace("’", "'").replace('“', '"').replace('”', '"'))
                 f.write('\n\n')
 
-            logger.info('开始获取正文 ... ')
-            # 从第2个<p>开始算是正文
-            body_text = html.xpath('//section[@class="Article__Content"]//div[1]//p')[2:]
-
-            keyword1 = 'SHOW NOTES'
-            keyword2 = 'SHOWNOTES'
-            keyword3 = 'Show Notes'
-            keyword4 = 'Want more'
-
-            logger.info('开始保存正文 ... ')
-            with open('\\'.join([self.save_path, self.__text]), 'a', encoding='utf-8') as f:
+                logger.info('开始保存正文 ... ')
                 f.write('【TRANSCRIPT】')
-                for item in body_text:
-                    # item.xpath('string(.)') 获取每个节点的文本，并将其转换为字符串
-                    text = str(item.xpath('string(.)')).replace("’", "'").replace('“', '"').replace('”', '"')
-
-                    # 如果碰到以上述元素开头的文本，则表示正文结束，停止写入
-                    if text.startswith((keyword1, keyword2, keyword3, keyword4)):
-                        break
+                for item in document.transcript:
+                    text = item.replace("’", "'").replace('“', '"').replace('”', '"')
 
                     # 如果某个元素的前4个字母大写（认为是人名），表示该元素需另起一段开始写入
                     # 该判断方式不能涵盖所有情况
@@ -154,19 +384,16 @@ class Downloader:
                         f.write(text.replace(': ', ':\n'))
 
                 logger.info(f'文本【{self.__text}】保存完成。\n')
+            self.__record_done('text', '\\'.join([self.save_path, self.__text]))
         except Exception as e:
             logger.error(f'保存文本出现错误，请检查：{e}\n')
+            self.__record_failed('text', e)
 
     def get_only_text(self):
         """
         Func: 调用该方法，只用来下载某一期的文本
         """
-        if not self.__request_url():
-            logger.info('网页的HTML文件错误或不存在，停止获取发布日期，请检查！\n')
-            return
-        else:
-            self.__get_publish_date()
-            self.__get_save_path()
+        if self.__prepare():
             self.__get_text()
 
     def __get_picture_url(self):
@@ -175,8 +402,9 @@ class Downloader:
         """
         try:
             logger.info('开始获取封面图片的链接 ... ')
-            html = etree.parse(self.__raw_html, etree.HTMLParser())
-            picture_url = html.xpath('//div[contains(@class,"Image__Wrapper")]//source[last()]/@srcset')[0].split(' ')[1]
+            picture_url = self.__get_document().picture_url
+            if picture_url is None:
+                raise ValueError('网页中没有找到封面图片')
 
             with open('\\'.join([self.save_path, self.__picture_info]), 'a', encoding='utf-8') as f:
                 f.writelines(picture_url + '\n\n')
@@ -186,6 +414,7 @@ class Downloader:
             return picture_url
         except Exception as e:
             logger.error(f'获取封面图片的链接出现错误，请检查：{e}\n')
+            self.__record_failed('picture', e)
             return False
 
     def __get_picture_info(self):
@@ -194,23 +423,20 @@ class Downloader:
         """
         try:
             logger.info('开始获取图片的信息(图片说明和拍摄者)并保存 ... ')
-            html = etree.parse(self.__raw_html, etree.HTMLParser())
-            picture_text = html.xpath('//span[@class="RichText"]//text()')
-
-            # 如果 picture_text 为 [], 即网页上没有（有的节目没有封面图片的说明，只有作者；有的节目连图片的作者也没有）
-            if not picture_text:
-                picture_text = ['None']
+            document = self.__get_document()
 
-            picture_auth = html.xpath('//span[contains(@class,"Caption__Credit")]//text()')
-            if not picture_auth:
-                picture_auth = ['None']
+            # 有的节目没有封面图片的说明，只有作者；有的节目连图片的作者也没有
+            picture_text = document.picture_caption or 'None'
+            picture_auth = document.picture_credit or 'None'
 
             with open('\\'.join([self.save_path, self.__picture_info]), 'a', encoding='utf-8') as f:
-                f.writelines([item + '\n\n' for item in ('【图片简介】', picture_text[0], picture_auth[0])])
+                f.writelines([item + '\n\n' for item in ('【图片简介】', picture_text, picture_auth)])
 
             logger.info(f'图片的信息【{self.__picture_info}】保存完成。\n')
+            self.__record_done('picture_info', '\\'.join([self.save_path, self.__picture_info]))
         except Exception as e:
             logger.error(f'保存图片的信息出现错误，请检查：{e}\n')
+            self.__record_failed('picture_info', e)
 
     def __get_picture_file(self, url=None):
         """
@@ -226,22 +452,20 @@ class Downloader:
         # 如果提供了图片链接，则先判断提供的值是否为URL形式的字符串，然后直接使用提供的链接进行下载
         if isinstance(url, str) and url.startswith('http'):
             try:
-                logger.info('开始请求图片数据 ... ')
-                picture_data = requests.get(url)
-            except Exception as e:
-                logger.error(f'图片链接请求出现错误，请检查：{e}\n')
+                logger.info('开始请求并保存图片 ... ')
+                with self.__timed('picture'):
+                    saved = stored_download(url, '\\'.join([self.save_path, self.__picture]), priority=PICTURE)
+                if saved:
+                    logger.info(f'图片【{self.__picture}】保存完成。\n')
+                    self.__record_done('picture', '\\'.join([self.save_path, self.__picture]), url=url,
+                                       sha256=stored_digest(url))
+                    return True
+                self.__record_failed('picture', '下载失败', url=url)
                 return False
-
-            logger.info('开始保存图片 ... ')
-            try:
-                with open('\\'.join([self.save_path, self.__picture]), 'wb') as f:
-                    for chunk in picture_data.iter_content():
-                        if chunk:
-                            f.write(chunk)
-
-                logger.info(f'图片【{self.__picture}】保存完成。\n')
             except Exception as e:
                 logger.error(f'保存图片出现错误，请检查：{e}\n')
+                self.__record_failed('picture', e, url=url)
+                return False
         else:
             logger.error(f'指定的图片链接【{url}】格式错误， 请检查！')
 
@@ -249,136 +473,163 @@ class Downloader:
         """
         Func: 调用该方法，只用来下载某一期的图片的链接
         """
-        if not self.__request_url():
-            logger.info('网页的HTML文件错误或不存在，停止获取发布日期，请检查！\n')
-            return
-        else:
-            self.__get_publish_date()
-            self.__get_save_path()
-
+        if self.__prepare():
             return self.__get_picture_url()
 
     def get_only_picture_info(self):
         """
         Func: 调用该方法，只用来下载某一期的图片的信息
         """
-        if not self.__request_url():
-            logger.info('网页的HTML文件错误或不存在，停止获取发布日期，请检查！\n')
-            return
-        else:
-            self.__get_publish_date()
-            self.__get_save_path()
-
+        if self.__prepare():
             return self.__get_picture_info()
 
     def get_only_picture_file(self):
         """
         Func: 调用该方法，只用来下载某一期的图片
         """
-        if not self.__request_url():
-            logger.info('网页的HTML文件错误或不存在，停止获取发布日期，请检查！\n')
-            return
-        else:
-            self.__get_publish_date()
-            self.__get_save_path()
+        if self.__prepare():
             self.__get_picture_file()
 
     def get_picture_all(self):
         """
         Func: 调用该方法，获取某一期节目中所有图片相关的资源
         """
-        if not self.__request_url():
-            logger.info('网页的HTML文件错误或不存在，停止获取发布日期，请检查！\n')
-            return
-        else:
-            self.__get_publish_date()
-            self.__get_save_path()
+        if self.__prepare():
             self.__get_picture_info()
             self.__get_picture_file()
 
-    def get_only_audio_url(self):
+    async def __async_save_stream(self, session, url, file_name, asset):
         """
-        Func: 获取音频的链接
+        Func: 异步请求链接，并将返回的数据以流的方式分块写入文件，支持断点续传
+        Param: session: aiohttp.ClientSession
+        Param: url: 文件的链接
+        Param: file_name: 保存的文件名
+        Param: asset: 下载清单中的资源名称
+        Return: 保存成功则返回True，失败返回False
         """
-        # headless mode
-        option = webdriver.ChromeOptions()
-        option.add_argument('--headless')
-        option.add_argument('--disable-gpu')
-        option.add_argument('start-maximized')
-        option.add_experimental_option('excludeSwitches', ['enable-automation'])
-        option.add_experimental_option('detach', True)
-        option.add_experimental_option('useAutomationExtension', False)
-        driver = webdriver.Chrome(options=option)
-        driver.implicitly_wait(20)
-
         try:
-            logger.info('再次请求网址获取音频链接 ... ')
-            driver.get(self.url)
+            with self.__timed(asset):
+                saved = await async_stored_download(session, url, '\\'.join([self.save_path, file_name]),
+                                                    priority=PICTURE if asset == 'picture' else AUDIO)
+            if saved:
+                logger.info(f'文件【{file_name}】保存完成。\n')
+                # 计算整个文件的校验值较慢（音频可达几十MB），在线程中执行，不阻塞其他节目
+                await asyncio.to_thread(self.__record_done, asset, '\\'.join([self.save_path, file_name]), url=url,
+                                        sha256=stored_digest(url))
+                return True
+            self.__record_failed(asset, '下载失败', url=url)
+            return False
         except Exception as e:
-            logger.error(f'再次请求网址出现错误，请检查：{e}\n')
-            driver.close()
+            logger.error(f'异步下载文件【{file_name}】出现错误，请检查：{e}\n')
+            self.__record_failed(asset, e, url=url)
             return False
 
-        try:
-            # 切换 frame - 音频相关的内容嵌套在名为第一个 iframe 中
-            logger.info('开始切换到包含音频的iframe ... ')
-
-            iframe = driver.find_elements(By.TAG_NAME, "iframe")[0]
-
-            # KEEP: 如下几种切换 frame的方式
-            # driver.switch_to.frame('iheartembed')
-            # driver.switch_to.frame(0)
-            # driver.switch_to.frame(driver.find_elements(By.TAG_NAME, "iframe")[0])
-            # driver.switch_to.frame(iframe)
-            WebDriverWait(driver, 10).until(ec.frame_to_be_available_and_switch_to_it(iframe))
-
-            logger.info('开始获取【播放】按钮 ... ')
-            # audio_play_button = driver.find_element(By.TAG_NAME, 'button')
-            audio_play_button = WebDriverWait(driver, 20).until(ec.element_to_be_clickable((By.TAG_NAME, 'button')))
-
-            logger.info('开始点击【播放】按钮 ... ')
-            webdriver.ActionChains(driver).move_to_element(audio_play_button).perform()
-            time.sleep(2)
-            webdriver.ActionChains(driver).click(audio_play_button).perform()
-
-            logger.info('开始获取音频链接 ... ')
-            audio_element = WebDriverWait(driver, 20).until(ec.presence_of_element_located((By.TAG_NAME, 'video')))
-            audio_url = audio_element.get_attribute('src')
+    def get_only_audio_url(self):
+        """
+        Func: 获取音频的链接。先通过HTTP请求播放器获取，失败时再使用浏览器获取
+        """
+        if not self.__prepare():
+            return False
+
+        with self.__timed('audio_url'):
+            audio_url = self.__audio_url or self.__get_static_audio_url() or self.__get_browser_audio_url()
+        if audio_url:
+            self.__save_audio_info(audio_url)
+        else:
+            self.__record_failed('audio', '没有获取到音频链接')
+        return audio_url
+
+    def __get_static_audio_url(self):
+        """
+        Func: 从网页中找到播放器的链接，不启动浏览器，直接通过HTTP请求获取音频链接
+        Return: 音频链接；获取失败返回 None
+        """
+        logger.info('开始通过播放器获取音频链接 ... ')
+        audio_url = resolve_audio_url(self.__get_document().player_url, api_base=self.api_base)
+        if audio_url:
             logger.info(f'音频链接为：{audio_url}')
+        else:
+            logger.warning('通过播放器获取音频链接失败，改用浏览器获取。')
+        return audio_url
 
-            with open('\\'.join([self.save_path, self.__audio_info]), 'w', encoding='utf-8') as f:
-                f.write(audio_url)
-            logger.info(f'音频链接【{self.__audio_info}】保存完成。\n')
+    def __save_audio_info(self, audio_url):
+        with open('\\'.join([self.save_path, self.__audio_info]), 'w', encoding='utf-8') as f:
+            f.write(audio_url)
+        logger.info(f'音频链接【{self.__audio_info}】保存完成。\n')
+
+    @contextmanager
+    def __borrow_driver(self):
+        """
+        Func: 从浏览器池中借用一个浏览器；没有提供浏览器池时，临时启动一个浏览器，用完后关闭
+        """
+        if self.driver_pool is not None:
+            with self.driver_pool.driver() as driver:
+                yield driver
+            return
 
+        driver = new_driver()
+        try:
+            yield driver
+        finally:
+            driver.quit()
+
+    def __get_browser_audio_url(self):
+        """
+        Func: 使用浏览器打开网页，点击播放按钮后获取音频的链接
+        """
+        with self.__borrow_driver() as driver:
+            return self.__click_audio_url(driver)
+
+    def __click_audio_url(self, driver, load=True):
+        """
+        Func: 在浏览器中点击播放按钮，获取音频的链接
+        Param: load: 是否需要先在浏览器中打开网页；网页已经打开时为 False
+        """
+        if load:
+            try:
+                logger.info('再次请求网址获取音频链接 ... ')
+                driver.get(self.url)
+            except Exception as e:
+                logger.error(f'再次请求网址出现错误，请检查：{e}\n')
+                self.__check_driver(driver, e)
+                return False
+
+        try:
+            audio_url = click_audio_url(driver)
+            logger.info(f'音频链接为：{audio_url}')
             return audio_url
         except Exception as e:
             logger.error(f'获取音频链接出现错误，请检查：{e}\n')
+            self.__check_driver(driver, e)
             return False
-        finally:
-            driver.close()
+
+    def __check_driver(self, driver, error):
+        """
+        Func: 浏览器本身出现异常时，标记浏览器池中的浏览器，归还后将其关闭，不再交给其他节目使用
+        """
+        if self.driver_pool is not None and is_browser_error(error):
+            self.driver_pool.mark_broken(driver)
 
     def __get_audio_file(self, url):
         """
         Func: 保存音频文件
         url: 音频文件的链接
        """
-        logger.info('开始请求音频数据 ... ')
+        logger.info('开始请求并保存音频文件 ... ')
         try:
-            audio_data = requests.get(url)
-            logger.info('音频数据获取完成。')
-        except Exception as e:
-            logger.error(f'音频链接请求出现错误，请检查：{e}\n')
+            with self.__timed('audio'):
+                saved = stored_download(url, '\\'.join([self.save_path, self.__audio]), priority=AUDIO)
+            if saved:
+                logger.info(f'音频文件【{self.__audio}】保存完成。')
+                self.__record_done('audio', '\\'.join([self.save_path, self.__audio]), url=url,
+                                   sha256=stored_digest(url))
+                return True
+            self.__record_failed('audio', '下载失败', url=url)
             return False
-
-        logger.info('开始保存音频文件 ... ')
-        try:
-            with open('\\'.join([self.save_path, self.__audio]), 'wb') as f:
-                f.write(audio_data.content)
-                f.flush()
-
-            logger.info(f'音频文件【{self.__audio}】保存完成。')
         except Exception as e:
-            logger.error(f'音频文件保存出现错误，请检查：{e}')
+            logger.error(f'音频文件下载出现错误，请检查：{e}')
+            self.__record_failed('audio', e, url=url)
+            return False
 
     def get_audio_file(self, url=None):
         """
@@ -401,69 +652,355 @@ class Downloader:
         else:
             logger.error(f'输入的音频URL {url} 不是字符串, 请检查！')
 
-    def get_file(self):
+    def fetch_page(self):
+        """
+        Func: 流水线的【fetch】阶段：请求网页；全部资源都已经完成，或者只需用记录的链接补下音频时，不再请求网页；
+              网页已经请求过时也不再重复请求
+        Return: 还需要继续处理则返回True，否则返回False
+        """
+        missing = self.missing_assets()
+        if not missing:
+            logger.info(f'【{self.title}】的全部资源已经下载完成，跳过。\n')
+            return False
+        if missing == ['audio'] and self.__resume_audio():
+            return False
+        if self.__document is not None or self.__content is not None:
+            return True
+
+        with self.__timed('fetch'):
+            fetched = self.__request_url()
+        if not fetched:
+            logger.info('网页请求失败，停止处理该节目，请检查！\n')
+            return False
+        return True
+
+    def parse_page(self):
+        """
+        Func: 流水线的【parse】阶段：解析发布日期和保存路径，保存还没有完成的文本和图片信息
+        Return: 封面图片的链接；图片已经下载完成或获取失败，则返回False
+        """
+        missing = self.missing_assets()
+        with self.__timed('parse'):
+            self.__locate()
+            if 'text' in missing:
+                self.__get_text()
+            return self.__get_missing_picture_url(missing)
+
+    def __get_missing_picture_url(self, missing):
+        """
+        Func: 保存还没有完成的图片信息，并返回需要下载的封面图片的链接
+        图片信息文件中先写入图片链接，再写入图片说明；重新写入时先删除上次不完整的文件
+        """
+        if 'picture_info' in missing:
+            picture_info = '\\'.join([self.save_path, self.__picture_info])
+            if os.path.exists(picture_info):
+                os.remove(picture_info)
+            picture_url = self.__get_picture_url()
+            self.__get_picture_info()
+        else:
+            picture_url = self.__get_document().picture_url
+        return picture_url if 'picture' in missing and picture_url else False
+
+    def save_picture(self, url):
+        """
+        Func: 流水线的【picture】阶段：下载封面图片
+        Param: url: 图片文件的链接
+        """
+        return self.__get_picture_file(url)
+
+    def save_audio(self, url):
+        """
+        Func: 流水线的【audio】阶段：下载音频文件；音频已经完成时跳过
+        Param: url: 音频文件的链接
         """
-        Func: 获取Overheard的某一期相关资源，包括文本，图片，音频文件
+        if 'audio' not in self.missing_assets():
+            return True
+        return self.__get_audio_file(url)
+
+    def run(self, stages=None):
+        """
+        Func: 只请求和解析一次网页，然后执行选中的阶段；没有选中 audio 时不会获取音频链接，也不会下载音频
+        Param: stages: 需要执行的阶段，STAGES 的子集，例如 {'text', 'picture'}；不提供则使用创建时指定的阶段
+        Return: 处理结果，见 result()；阶段不合法时返回 None
         """
+        if stages is not None:
+            stages = check_stages(stages)
+            if stages is None:
+                return None
+            self.stages = stages
+
         # logger.info('===============【START】===============')
-        logger.info(f'开始处理【{self.title}】... ')
+        logger.info(f'开始处理【{self.title}】，执行的阶段为：{self.stages} ... ')
+
+        with self.__timed('episode'):
+            if self.fetch_page():
+                picture_url = self.parse_page()
+                if picture_url:
+                    self.__get_picture_file(picture_url)
+                if 'audio' in self.missing_assets():
+                    self.get_audio_file()
+        # logger.info('===============【END】===============\n')
+        return self.result()
 
-        if not self.__request_url():
-            logger.info('网页的HTML文件错误或不存在，停止获取发布日期，请检查！\n')
+    def get_file(self):
+        """
+        Func: 获取Overheard的某一期相关资源，包括文本，图片，音频文件（创建时指定的全部阶段）
+        Return: 处理结果，见 result()
+        """
+        return self.run()
+
+    async def async_get_file(self, session, browser_lock=None):
+        """
+        Func: get_file() 的异步版本。网络请求全部异步完成；
+              解析网页、写入文件、计算校验值和使用浏览器获取音频链接的步骤在线程中执行，不阻塞事件循环
+        Param: session: aiohttp.ClientSession
+        Param: browser_lock: asyncio.Semaphore，用来限制同时运行的浏览器数量
+        Return: 处理结果，见 result()
+        """
+        logger.info(f'开始异步处理【{self.title}】... ')
+        with self.__timed('episode'):
+            await self.__async_get_file(session, browser_lock)
+        return self.result()
+
+    async def __async_get_file(self, session, browser_lock):
+        missing = self.missing_assets()
+        if not missing:
+            logger.info(f'【{self.title}】的全部资源已经下载完成，跳过。\n')
+            return
+        if missing == ['audio'] and await asyncio.to_thread(self.__resume_audio):
+            return
+
+        with self.__timed('fetch'):
+            fetched = await self.__async_request_url(session)
+        if not fetched:
+            logger.info('网页请求失败，停止获取发布日期，请检查！\n')
+            return
+
+        # 解析网页、写入文本和图片信息文件在线程中执行，不阻塞事件循环
+        picture_url = await asyncio.to_thread(self.parse_page)
+        if picture_url:
+            logger.info('开始异步请求图片数据 ... ')
+            await self.__async_save_stream(session, picture_url, self.__picture, 'picture')
+
+        if 'audio' not in missing:
             return
+
+        # 只有通过播放器获取失败时才需要启动浏览器，浏览器的数量受 browser_lock 限制
+        with self.__timed('audio_url'):
+            audio_url = await asyncio.to_thread(self.__get_static_audio_url)
+            if not audio_url:
+                if browser_lock is None:
+                    audio_url = await asyncio.to_thread(self.__get_browser_audio_url)
+                else:
+                    async with browser_lock:
+                        audio_url = await asyncio.to_thread(self.__get_browser_audio_url)
+        if audio_url:
+            await asyncio.to_thread(self.__save_audio_info, audio_url)
         else:
-            self.__get_publish_date()
-            self.__get_save_path()
-            self.__get_text()
-            self.__get_picture_file()
-            self.__get_picture_info()
-            self.get_audio_file()
-        # logger.info('===============【END】===============\n')
+            self.__record_failed('audio', '没有获取到音频链接')
+
+        if audio_url:
+            logger.info('开始异步请求音频数据 ... ')
+            await self.__async_save_stream(session, audio_url, self.__audio, 'audio')
+
+
+def iter_episode_items(info):
+    """
+    Func: 将节目信息统一转换为 (节目标题, 节目网址) 的迭代器
+    Param: info: 字典（key 是节目标题，value 是节目网址），或者任意依次返回 (节目标题, 节目网址) 的可迭代对象，
+                 例如 Sniffer.iter_episodes() 返回的生成器
+    Return: 迭代器；info 不是字典或可迭代对象时返回 None
+    """
+    if isinstance(info, dict):
+        return iter(info.items())
+    if isinstance(info, (str, bytes)):
+        return None
+    try:
+        return iter(info)
+    except TypeError:
+        return None
 
 
-def get_files(info):
+def _track(episodes, processed):
+    """
+    Func: 依次返回节目信息，同时记录处理过的节目的网址
     """
-    Func: 获取一期或者几期节目资源
-    Param: info: 字典格式，保存节目的标题和对应的网址
+    for episode_title, episode_url in episodes:
+        processed.append(episode_url)
+        yield episode_title, episode_url
+
+
+def get_files(info, pipeline=False, workers=None, concurrency=None, browser_fetch=False, manifest=DEFAULT_MANIFEST,
+              save_path=None, stages=STAGES, api_base=None):
     """
-    if not isinstance(info, dict):
-        logger.error(f'输入的信息 {info} 不是字典类型，请检查！')
+    Func: 获取一期或者几期节目资源。节目信息可以边获取边下载：info 为生成器时，每返回一期节目就开始处理该节目
+    Param: info: 字典格式，保存节目的标题和对应的网址；或者依次返回 (标题, 网址) 的可迭代对象
+    Param: pipeline: 是否使用分阶段的流水线模式下载（各阶段拥有独立的线程池和队列）
+    Param: workers: 字典，流水线模式下各阶段的线程数，例如 {'audio_url': 2}；未指定的阶段使用默认值
+    Param: concurrency: 如果指定，则使用异步模式下载，该值为同时处理的节目数量
+    Param: browser_fetch: 每一期节目只使用浏览器打开一次网页，见 Downloader；异步模式不支持该选项
+    Param: manifest: 下载清单的路径或 DownloadManifest，跳过已经完成的资源，只重试缺失或失败的资源；
+                     为 None 时不使用清单，全部重新下载
+    Param: save_path: 保存文件的目录，不提供则根据各期节目的发布日期构造
+    Param: stages: 需要执行的阶段，STAGES 的子集；例如 ('text', 'picture_info', 'picture') 只更新文本和图片，
+                   不会获取音频链接，也不会下载音频
+    Param: api_base: 播放器接口的地址，默认为 audio_natgeo.IHEART_API
+    Return: 列表，保存（选中的阶段需要的）资源都已经下载完成的节目的网址；参数错误或者没有节目时返回False
+            结束时将本次下载的指标汇总（各阶段耗时、下载的字节数、请求和重试次数、缓存命中、每分钟处理的节目数）
+            写入日志，输出方式见 metrics_natgeo.configure_metrics()
+    """
+    episodes = iter_episode_items(info)
+    if episodes is None:
+        logger.error(f'输入的信息 {info} 不是字典或可迭代对象，请检查！')
+        return False
+
+    stages = check_stages(stages)
+    if stages is None:
         return False
 
-    if len(info) < 1:
-        logger.warning(f'输入的信息 {info} 为空字典，无须下载！')
+    manifest = open_manifest(manifest)
+    since, started = metrics.snapshot(), time.time()
+
+    processed = []
+    if concurrency:
+        # 没有安装 aiohttp 或者没有节目时返回 False
+        if asyncio.run(async_get_files(_track(episodes, processed), concurrency=concurrency, manifest=manifest,
+                                       save_path=save_path, stages=stages, api_base=api_base)) is False:
+            return False
+    elif pipeline:
+        from pipeline_natgeo import DownloadPipeline
+        pipeline = DownloadPipeline(workers, browser_fetch=browser_fetch, manifest=manifest, save_path=save_path,
+                                    stages=stages, api_base=api_base)
+        pipeline.run(_track(episodes, processed))
+    else:
+        # 所有节目共用一个浏览器，避免每一期都重新启动浏览器
+        driver_pool = WebDriverPool(size=1)
+        try:
+            num = 1
+            for episode_title, episode_url in _track(episodes, processed):
+                logger.info(f'===============【Episode{num}: START】===============')
+                downloader = Downloader(episode_title, episode_url, save_path=save_path, driver_pool=driver_pool,
+                                        browser_fetch=browser_fetch, manifest=manifest, stages=stages,
+                                        api_base=api_base)
+                downloader.get_file()
+                logger.info(f'===============【Episode{num}: END】===============\n\n')
+                num += 1
+        finally:
+            driver_pool.close()
+
+    if not processed:
+        logger.warning(f'输入的信息 {info} 中没有节目，无须下载！')
         return False
 
-    num = 1
-    for episode_title, episode_url in info.items():
-        logger.info(f'===============【Episode{num}: START】===============')
-        downloader = Downloader(episode_title, episode_url)
-        downloader.get_file()
-        logger.info(f'===============【Episode{num}: END】===============\n\n')
-        num += 1
+    # 网页的保存结果写入清单后，才能确定各期节目是否完成
+    wait_archive()
+    completed = completed_urls(processed, manifest, stages)
+    if manifest is not None:
+        # 将本次追加的清单记录合并到清单文件中
+        manifest.compact()
+        metrics.inc('episodes_total', len(completed), result='complete')
+        metrics.inc('episodes_total', len(processed) - len(completed), result='incomplete')
+    report_run(since, started, len(processed), len(completed) if manifest is not None else None)
+    return completed
 
 
-def get_all_files(url):
+def completed_urls(urls, manifest, stages=STAGES):
     """
-    Func: 获取Overheard的全部节目资源
+    Func: 根据下载清单，获取（选中的阶段需要的）资源都已经下载完成的节目的网址；没有使用清单时返回空列表
+    Param: urls: 处理过的节目的网址
+    Param: stages: 选中的阶段，默认为全部阶段
     """
-    # 开始处理Overhead主页
-    sniffer = Sniffer(url)
-    episode_info = sniffer.get_all_episode_info()
+    if manifest is None:
+        return []
+    assets = [asset for asset in ASSETS if asset == 'html' or asset in stages]
+    return [episode_url for episode_url in urls if not manifest.missing(episode_url, assets)]
+
+
+async def async_get_files(info, concurrency=10, browsers=1, manifest=None, save_path=None, stages=STAGES,
+                          api_base=None):
+    """
+    Func: get_files() 的异步版本，使用一个进程同时处理多期节目
+    Param: info: 字典格式，保存节目的标题和对应的网址；或者依次返回 (标题, 网址) 的可迭代对象
+    Param: concurrency: 同时处理的节目数量，同时也是连接池的大小
+    Param: browsers: 同时运行的浏览器数量，也是浏览器池的大小
+    Param: manifest: 下载清单的路径或 DownloadManifest
+    Param: save_path: 保存文件的目录，不提供则根据各期节目的发布日期构造
+    Param: stages: 需要执行的阶段，见 get_files()
+    Param: api_base: 播放器接口的地址，见 get_files()
+    Return: 列表，保存（选中的阶段需要的）资源都已经下载完成的节目的网址；参数错误或者没有节目时返回False
+    """
+    aiohttp = load_aiohttp()
+    if aiohttp is None:
+        logger.error('没有安装 aiohttp 模块，无法使用异步模式，请检查！\n')
+        return False
+
+    episodes = iter_episode_items(info)
+    if episodes is None:
+        logger.error(f'输入的信息 {info} 不是字典或可迭代对象，请检查！')
+        return False
 
-    if len(episode_info) < 1:
-        logger.warning(f'输入的信息 {episode_info} 为空字典，无须下载！')
+    stages = check_stages(stages)
+    if stages is None:
         return False
 
-    # 开始依次获取每一期节目的资源
-    if episode_info:
-        num = 1
-        for episode_title, episode_url in episode_info.items():
+    manifest = open_manifest(manifest)
+    episode_lock = asyncio.Semaphore(concurrency)
+    browser_lock = asyncio.Semaphore(browsers)
+    processed = []
+
+    async def get_one(num, episode_title, episode_url):
+        try:
             logger.info(f'===============【Episode{num}: START】===============')
-            downloader = Downloader(episode_title, episode_url)
-            downloader.get_file()
+            downloader = Downloader(episode_title, episode_url, save_path=save_path, driver_pool=driver_pool,
+                                    manifest=manifest, stages=stages, api_base=api_base)
+            await downloader.async_get_file(session, browser_lock)
             logger.info(f'===============【Episode{num}: END】===============\n\n')
-            num += 1
+        except Exception as e:
+            logger.error(f'处理【{episode_title}】出现错误，请检查：{e}\n')
+        finally:
+            episode_lock.release()
+
+    driver_pool = WebDriverPool(size=browsers)
+    # 分段下载时，每期节目的音频最多同时使用 max_segments() 个连接
+    connector = aiohttp.TCPConnector(limit=concurrency * max_segments())
+    try:
+        async with aiohttp.ClientSession(connector=connector) as session:
+            tasks = set()
+            try:
+                while True:
+                    # 节目信息可能来自边翻页边解析的生成器，在线程中获取下一期，不阻塞事件循环
+                    episode = await asyncio.to_thread(next, episodes, None)
+                    if episode is None:
+                        break
+
+                    # 同时处理的节目数量达到上限时，等待其中一期处理完成后再获取下一期
+                    await episode_lock.acquire()
+                    processed.append(episode[1])
+                    task = asyncio.create_task(get_one(len(processed), *episode))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+            finally:
+                # 获取节目信息出现异常时，同样等待已经开始处理的节目完成后再关闭会话，不留下没有等待的任务
+                await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        driver_pool.close()
+
+    if not processed:
+        logger.warning(f'输入的信息 {info} 中没有节目，无须下载！')
+        return False
+    await asyncio.to_thread(wait_archive)
+    return completed_urls(processed, manifest, stages)
+
+
+def get_all_files(url, pipeline=False, workers=None):
+    """
+    Func: 获取Overheard的全部节目资源
+    Param: pipeline: 是否使用分阶段的流水线模式下载
+    Param: workers: 字典，流水线模式下各阶段的线程数
+    """
+    # 开始处理Overhead主页；每解析完一页列表，就开始获取该页上每一期节目的资源
+    sniffer = Sniffer(url)
+    return get_files(sniffer.iter_episodes(), pipeline=pipeline, workers=workers)
 
 
 logger = log_setting('Overheard_get_all', '../Logs')
@@ -1,45 +1,195 @@
 # -*- encoding: utf-8 -*-
 
+import atexit
+import gzip
+import json
 import logging
+import os
+import queue
+import shutil
+import threading
 import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
-import colorlog
 
+# 单个日志文件的大小上限（字节）和保留的旧文件数量
+MAX_BYTES = 20 * 1024 * 1024
+BACKUP_COUNT = 10
 
-def log_setting(logger_flag, log_path):
+DATEFMT = "%Y-%m-%d %H:%M:%S"
+
+#  无需使用颜色来标记日志级别，而是直接用文字标明日志级别
+FILE_LOG_FORMAT = '%(asctime)s.%(msecs)03d\t\t%(filename)s:%(lineno)d\t\t%(funcName)s\t\t【%(levelname)s】%(message)s'
+
+# 在控制台中，不同级别的日志显示的颜色不同，通过 colorlog 模块实现
+CONTROL_LOG_FORMAT = '%(log_color)s%(asctime)s.%(msecs)03d\t\t%(filename)s:%(lineno)d\t\t%(funcName)s\t\t%(message)s'
+
+
+class JsonLinesFormatter(logging.Formatter):
     """
-    Func: 配置log的输出和格式
+    每条日志输出为一行 JSON，便于使用程序检索和统计
     """
-    try:
-        logger = logging.getLogger(f'{logger_flag}')
-        logger.setLevel(logging.DEBUG)
+    def format(self, record):
+        entry = {
+            'time': time.strftime(DATEFMT, time.localtime(record.created)) + f'.{int(record.msecs):03d}',
+            'level': record.levelname,
+            'logger': record.name,
+            'file': record.filename,
+            'line': record.lineno,
+            'func': record.funcName,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
 
-        datefmt = "%Y-%m-%d %H:%M:%S"
 
-        # 保存到日志文件中的log
-        log_file = f'{log_path}/{logger_flag}-{time.strftime("%Y-%m-%d_%H-%M-%S", time.localtime())}.log'
-        file_handler = logging.FileHandler(log_file, encoding='utf-8')
+def _gzip_namer(name):
+    return name + '.gz'
 
-        #  无需使用颜色来标记日志级别，而是直接用文字标明日志级别
-        file_log_format = '%(asctime)s.%(msecs)03d\t\t%(filename)s:%(lineno)d\t\t%(funcName)s\t\t【%(levelname)s】%(message)s'
-        file_formatter = logging.Formatter(file_log_format, datefmt=datefmt)
 
-        # 设置保存到日志文件的日志格式
-        file_handler.setFormatter(file_formatter)
+def _gzip_rotator(source, dest):
+    """
+    Func: 日志文件轮转时，将写满的文件压缩保存
+    """
+    with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
 
-        # 输出到控制台上的日志
-        control_handler = logging.StreamHandler()
 
-        # 在控制台中，不同级别的日志显示的颜色不同，通过 colorlog 模块实现
-        control_log_format = '%(log_color)s%(asctime)s.%(msecs)03d\t\t%(filename)s:%(lineno)d\t\t%(funcName)s\t\t%(message)s'
-        control_formatter = colorlog.ColoredFormatter(control_log_format, datefmt=datefmt)
+class _LazyQueueHandler(QueueHandler):
+    """
+    第一条日志放入队列时才启动 listener（创建日志目录和后台线程），导入各个模块时没有任何副作用
+    """
+    def enqueue(self, record):
+        if _listener is None and not _shutdown:
+            _start_default()
+        super().enqueue(record)
 
-        # 设置输出到控制台的日志格式
-        control_handler.setFormatter(control_formatter)
 
-        # 分别添加两个日志控制器
-        logger.addHandler(control_handler)
-        logger.addHandler(file_handler)
+# 所有模块的 logger 共用一个 QueueHandler：写日志时只把记录放入队列，不会阻塞工作线程；
+# 由 QueueListener 的后台线程统一写入控制台和日志文件
+_queue = queue.SimpleQueue()
+_queue_handler = _LazyQueueHandler(_queue)
+_listener = None
+_log_file = None
+_default_path = None
+_shutdown = False
+_lock = threading.RLock()
+
+
+def configure_logging(log_path='../Logs', max_bytes=MAX_BYTES, backup_count=BACKUP_COUNT, compress=False,
+                      json_lines=False, console=True):
+    """
+    Func: 配置本进程的日志输出：每次运行只写一个日志文件，超过大小上限时轮转。
+          不调用时，第一条日志输出时使用默认参数配置；再次调用时按新的参数重新配置，
+          已经创建的 logger 无需重新设置
+    :param log_path: 日志文件的目录，不存在时自动创建；为 None 时不写入文件
+    :param max_bytes: 单个日志文件的大小上限（字节），为 0 时不轮转
+    :param backup_count: 轮转时保留的旧文件数量
+    :param compress: 是否使用 gzip 压缩轮转出来的旧文件
+    :param json_lines: 是否以 JSON Lines 格式写入日志文件（每行一条 JSON）
+    :param console: 是否同时输出到控制台
+    :return: 本次运行的日志文件的路径；不写入文件时返回 None
+    """
+    global _listener, _log_file, _shutdown
+    with _lock:
+        handlers = []
+        log_file = None
+
+        if console:
+            import colorlog
+
+            control_handler = logging.StreamHandler()
+            control_handler.setFormatter(colorlog.ColoredFormatter(CONTROL_LOG_FORMAT, datefmt=DATEFMT))
+            handlers.append(control_handler)
+
+        if log_path:
+            os.makedirs(log_path, exist_ok=True)
+            suffix = 'jsonl' if json_lines else 'log'
+            log_file = f'{log_path}/Overheard-{time.strftime("%Y-%m-%d_%H-%M-%S", time.localtime())}-{os.getpid()}.{suffix}'
+            # delay=True：第一条日志写入时才创建文件
+            file_handler = RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backup_count,
+                                               encoding='utf-8', delay=True)
+            if compress:
+                file_handler.namer = _gzip_namer
+                file_handler.rotator = _gzip_rotator
+            file_handler.setFormatter(JsonLinesFormatter() if json_lines else
+                                      logging.Formatter(FILE_LOG_FORMAT, datefmt=DATEFMT))
+            handlers.append(file_handler)
+
+        # 先停止之前的 listener，队列中剩余的日志由之前的配置写完
+        _stop_listener()
+        _listener = QueueListener(_queue, *handlers, respect_handler_level=True)
+        _listener.start()
+        _log_file = log_file
+        _shutdown = False
+        return log_file
+
+
+def _start_default():
+    """
+    Func: 没有调用 configure_logging() 时，使用默认参数和 log_setting() 提供的目录配置日志；
+          日志目录无法创建时只输出到控制台
+    """
+    with _lock:
+        if _listener is not None:
+            return
+        try:
+            configure_logging(_default_path or '../Logs')
+        except Exception as e:
+            print('日志文件设置失败，只输出到控制台，请检查！')
+            print(e)
+            configure_logging(None)
+
+
+def _stop_listener():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+def shutdown_logging():
+    """
+    Func: 写完队列中剩余的日志并关闭日志文件；程序退出时自动调用，之后的日志不再输出
+    """
+    global _shutdown
+    with _lock:
+        _stop_listener()
+        _shutdown = True
+
+
+def current_log_file():
+    """
+    Func: 本次运行的日志文件的路径
+    """
+    return _log_file
+
+
+atexit.register(shutdown_logging)
+
+
+def log_setting(logger_flag, log_path):
+    """
+    Func: 获取名为 logger_flag 的 logger，日志通过队列写入本进程共用的控制台和日志文件；
+          本进程还没有配置日志时，第一条日志输出时使用 log_path 作为日志目录进行配置（导入模块时不创建任何文件）。
+          重复调用不会重复添加 handler
+    :return: logger；设置失败时返回 None
+    """
+    global _default_path
+    try:
+        with _lock:
+            if _default_path is None:
+                _default_path = log_path
+
+        logger = logging.getLogger(f'{logger_flag}')
+        logger.setLevel(logging.DEBUG)
+        if _queue_handler not in logger.handlers:
+            logger.addHandler(_queue_handler)
 
         return logger
     except Exception as e:
@@ -0,0 +1,230 @@
+# -*- encoding: utf-8 -*-
+
+import datetime
+import hashlib
+import json
+import os
+import threading
+
+from log_overheard import log_setting
+
+
+# 每一期节目需要下载的资源
+# html: 网页内容；text: 文本；picture: 封面图片；picture_info: 图片链接和说明；audio: 音频
+ASSETS = ('html', 'text', 'picture', 'picture_info', 'audio')
+
+# 清单文件的默认位置，与 SQLite 数据库文件放在一起
+DEFAULT_MANIFEST = '../Data/manifest.json'
+
+# 计算校验值时每次读取的大小
+_READ_SIZE = 1024 * 1024
+
+# 日志文件中的记录达到该数量时，合并到清单文件中
+COMPACT_EVERY = 5000
+
+
+def file_digest(path):
+    """
+    Func: 计算文件的 SHA-256 校验值
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_READ_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DownloadManifest:
+    def __init__(self, path=DEFAULT_MANIFEST, compact_every=COMPACT_EVERY):
+        """
+        Func: 记录每一期节目中每一项资源的下载状态。每项资源完成后立即记录文件的路径、大小和校验值，
+              再次下载时跳过已经完成的资源，只重试缺失或失败的资源
+        :param path: 清单文件（JSON）的路径，不存在时自动创建
+        :param compact_every: 日志文件中的记录达到该数量时，合并到清单文件中
+        各个方法中的 episode 参数均为节目的网址
+        清单的格式：{网址: {'title':.., 'save_path':.., 'assets': {资源: {'status':.., 'path':.., 'size':..,
+                   'sha256':.., 'url':.., 'error':.., 'updated':..}}}}
+        每次更新只在日志文件（path.journal）末尾追加一行 JSON，不重写整个清单；读取时先加载清单文件，再依次应用日志中的记录。
+        日志记录较多时，以及 compact()/close() 时，合并为新的清单文件并清空日志
+        """
+        self.path = path
+        self.journal_path = path + '.journal'
+        self.compact_every = compact_every
+        self.__lock = threading.RLock()
+        self.__journal = None
+        self.__pending = 0
+        self.__episodes = self.__load()
+
+    def __load(self):
+        episodes = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    episodes = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.error(f'读取下载清单【{self.path}】出现错误，将重新记录：{e}')
+
+        if os.path.exists(self.journal_path):
+            try:
+                with open(self.journal_path, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            # 程序崩溃时最后一行可能没有写完整，忽略即可
+                            continue
+                        self.__apply(episodes, entry)
+                        self.__pending += 1
+            except OSError as e:
+                logger.error(f'读取下载清单的日志【{self.journal_path}】出现错误：{e}')
+        return episodes
+
+    @staticmethod
+    def __apply(episodes, entry):
+        record = episodes.setdefault(entry['episode'], {'assets': {}})
+        if 'asset' in entry:
+            record.setdefault('assets', {})[entry['asset']] = entry['record']
+        else:
+            record.update(entry['fields'])
+
+    def __append(self, entry):
+        """
+        Func: 更新内存中的清单，并在日志文件末尾追加一行；需要在持有锁时调用
+        """
+        self.__apply(self.__episodes, entry)
+        if self.__journal is None:
+            directory = os.path.dirname(self.journal_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.__journal = open(self.journal_path, 'a', encoding='utf-8')
+            if self.__journal.tell() and not self.__ends_with_newline():
+                # 上次崩溃时最后一行没有写完整，先换行，避免与新的记录连在一起
+                self.__journal.write('\n')
+        self.__journal.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self.__journal.flush()
+        self.__pending += 1
+        if self.__pending >= self.compact_every:
+            self.compact()
+
+    def __ends_with_newline(self):
+        with open(self.journal_path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b'\n'
+
+    def compact(self):
+        """
+        Func: 将内存中的清单写入清单文件，然后清空日志。先写入临时文件再替换，程序中途崩溃时清单文件也不会损坏；
+              替换后、清空日志前崩溃时，再次读取会重复应用日志中的记录，结果相同
+        """
+        with self.__lock:
+            if not self.__pending:
+                return
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            temp = self.path + '.tmp'
+            with open(temp, 'w', encoding='utf-8') as f:
+                json.dump(self.__episodes, f, ensure_ascii=False, indent=1)
+            os.replace(temp, self.path)
+
+            if self.__journal is not None:
+                self.__journal.close()
+                self.__journal = None
+            if os.path.exists(self.journal_path):
+                os.remove(self.journal_path)
+            self.__pending = 0
+
+    def close(self):
+        """
+        Func: 合并日志并关闭日志文件；之后仍然可以继续使用
+        """
+        self.compact()
+
+    def episode(self, episode):
+        """
+        Func: 获取某一期节目的记录（副本）；没有记录时返回空字典
+        """
+        with self.__lock:
+            entry = self.__episodes.get(episode, {})
+            return dict(entry, assets=dict(entry.get('assets', {})))
+
+    def asset(self, episode, asset):
+        """
+        Func: 获取某一期节目中某项资源的记录（副本）；没有记录时返回空字典
+        """
+        with self.__lock:
+            return dict(self.__episodes.get(episode, {}).get('assets', {}).get(asset, {}))
+
+    def is_done(self, episode, asset, verify=False):
+        """
+        Func: 判断某项资源是否已经下载完成：状态为完成，且文件仍然存在、大小没有变化
+        :param verify: 是否重新计算文件的校验值进行比较（较慢）
+        """
+        record = self.asset(episode, asset)
+        if record.get('status') != 'done':
+            return False
+
+        path = record.get('path')
+        if path is None:
+            return True
+        if not os.path.exists(path) or os.path.getsize(path) != record.get('size'):
+            return False
+        return not verify or file_digest(path) == record.get('sha256')
+
+    def missing(self, episode, assets=ASSETS):
+        """
+        Func: 获取某一期节目中还没有完成的资源
+        :return: 列表，保存缺失或失败的资源名称
+        """
+        return [asset for asset in assets if not self.is_done(episode, asset)]
+
+    def is_complete(self, episode):
+        return not self.missing(episode)
+
+    def update_episode(self, episode, **fields):
+        """
+        Func: 更新某一期节目的信息，例如标题和保存路径
+        """
+        with self.__lock:
+            self.__append({'episode': episode, 'fields': fields})
+
+    def mark_done(self, episode, asset, path=None, content=None, sha256=None, **extra):
+        """
+        Func: 记录某项资源下载完成，同时记录文件的大小和校验值
+        :param path: 保存资源的文件；没有对应的文件时（例如只保存在内存中的网页）为 None
+        :param content: 没有文件时，用来计算大小和校验值的原始内容（bytes）
+        :param sha256: 已经计算过的文件的校验值（例如文件仓库中的记录），提供时不再重新计算
+        :param extra: 需要一起记录的其他信息，例如资源的链接
+        """
+        record = {'status': 'done', 'path': path, 'updated': datetime.datetime.now().isoformat(timespec='seconds')}
+        if path is not None:
+            record.update(size=os.path.getsize(path), sha256=sha256 or file_digest(path))
+        elif content is not None:
+            record.update(size=len(content), sha256=hashlib.sha256(content).hexdigest())
+        record.update(extra)
+        self.__set(episode, asset, record)
+
+    def mark_failed(self, episode, asset, error=None, **extra):
+        """
+        Func: 记录某项资源下载失败，下次运行时重试
+        """
+        record = {'status': 'failed', 'error': str(error) if error else None,
+                  'updated': datetime.datetime.now().isoformat(timespec='seconds')}
+        record.update(extra)
+        self.__set(episode, asset, record)
+
+    def __set(self, episode, asset, record):
+        with self.__lock:
+            self.__append({'episode': episode, 'asset': asset, 'record': record})
+
+
+def open_manifest(manifest):
+    """
+    Func: 将清单文件的路径转换为 DownloadManifest；已经是 DownloadManifest 或者为 None 时原样返回
+    """
+    if manifest is None or isinstance(manifest, DownloadManifest):
+        return manifest
+    return DownloadManifest(manifest)
+
+
+logger = log_setting('Overheard_manifest', '../Logs')
@@ -0,0 +1,290 @@
+# -*- encoding: utf-8 -*-
+
+import bisect
+import datetime
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+from log_overheard import log_setting
+
+
+# 导出为 Prometheus 格式时，指标名称统一加上的前缀
+NAMESPACE = 'overheard'
+
+# 耗时直方图的分桶上限（秒）
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# 各项指标的说明，导出为 Prometheus 格式时写入 # HELP
+DESCRIPTIONS = {
+    'stage_seconds': '各阶段的耗时：listing/fetch/parse/picture/audio_url/audio/episode',
+    'http_requests_total': 'HTTP请求的次数，按主机和返回码统计（连接异常时返回码为 error）',
+    'http_request_seconds': 'HTTP请求收到响应头的耗时，按主机统计',
+    'http_retries_total': 'HTTP请求的重试次数，按主机统计',
+    'bytes_total': '下载的字节数，按主机统计',
+    'cache_requests_total': '网页缓存的命中（hit）和未命中（miss）次数',
+    'store_requests_total': '文件仓库的命中（hit）和未命中（miss）次数',
+    'assets_total': '各项资源完成（done）和失败（failed）的次数',
+    'episodes_discovered_total': '从列表页中获取到的节目数量',
+    'episodes_total': '处理过的节目数量，按是否全部完成统计',
+    'db_seconds': '数据库操作的耗时，按后端和操作统计',
+    'segmented_downloads_total': '分段下载的次数（segmented）和改为单个连接下载的次数（fallback），按主机统计',
+    'scheduler_wait_seconds': '下载调度的等待时间：request（请求频率）/inflight（进行中的字节数）/bandwidth（带宽），按优先级统计',
+}
+
+
+def host_of(url):
+    """
+    Func: 获取链接的主机名，用作指标的标签
+    """
+    return urlsplit(url).hostname or ''
+
+
+def _key(name, labels):
+    return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _label_text(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + '}'
+
+
+def _quantile(bounds, counts, total, q):
+    """
+    Func: 根据直方图各个分桶的数量估算分位数（在分桶内线性插值）；落在最后一个分桶中时返回其下限
+    """
+    if not total:
+        return None
+    rank = q * total
+    seen = 0
+    lower = 0.0
+    for upper, count in zip(bounds, counts):
+        if count and seen + count >= rank:
+            return round(lower + (upper - lower) * (rank - seen) / count, 6)
+        seen += count
+        lower = upper
+    return lower
+
+
+class Metrics:
+    def __init__(self, buckets=BUCKETS):
+        """
+        Func: 进程内的指标记录：计数器（counter）和耗时直方图（histogram），各线程可以同时记录；
+              可以导出为 Prometheus 的文本格式，或者生成 JSON 格式的汇总
+        :param buckets: 直方图的分桶上限（秒），从小到大排列
+        """
+        self.buckets = tuple(buckets)
+        self.__lock = threading.Lock()
+        self.__counters = {}
+        self.__histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        """
+        Func: 计数器加上 value
+        """
+        key = _key(name, labels)
+        with self.__lock:
+            self.__counters[key] = self.__counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """
+        Func: 在直方图中记录一次观测值（通常为耗时，单位为秒）
+        """
+        key = _key(name, labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.__lock:
+            histogram = self.__histograms.get(key)
+            if histogram is None:
+                histogram = self.__histograms[key] = {'count': 0, 'sum': 0.0, 'buckets': [0] * (len(self.buckets) + 1)}
+            histogram['count'] += 1
+            histogram['sum'] += value
+            histogram['buckets'][index] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Func: 记录 with 语句块的耗时；出现异常时同样记录
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def snapshot(self):
+        """
+        Func: 当前全部指标的副本，可以传给 summary() 计算这之后的变化
+        """
+        with self.__lock:
+            return {'counters': dict(self.__counters),
+                    'histograms': {key: dict(value, buckets=list(value['buckets']))
+                                   for key, value in self.__histograms.items()}}
+
+    def reset(self):
+        with self.__lock:
+            self.__counters.clear()
+            self.__histograms.clear()
+
+    def summary(self, since=None):
+        """
+        Func: JSON 格式的汇总；提供 since 时只统计该快照之后的变化
+        :param since: snapshot() 返回的快照
+        :return: {'counters': {指标: {标签: 数值}}, 'histograms': {指标: {标签: {count, sum, avg, p50, p95}}}}
+        """
+        current = self.snapshot()
+        old = since or {'counters': {}, 'histograms': {}}
+        bounds = self.buckets + (float('inf'),)
+
+        counters = {}
+        for (name, labels), value in sorted(current['counters'].items()):
+            value -= old['counters'].get((name, labels), 0)
+            if value:
+                counters.setdefault(name, {})[_label_text(labels) or 'total'] = value
+
+        histograms = {}
+        for (name, labels), value in sorted(current['histograms'].items()):
+            before = old['histograms'].get((name, labels), {'count': 0, 'sum': 0.0, 'buckets': [0] * len(bounds)})
+            count = value['count'] - before['count']
+            if not count:
+                continue
+            total = value['sum'] - before['sum']
+            buckets = [a - b for a, b in zip(value['buckets'], before['buckets'])]
+            histograms.setdefault(name, {})[_label_text(labels) or 'total'] = {
+                'count': count, 'sum': round(total, 6), 'avg': round(total / count, 6),
+                'p50': _quantile(bounds, buckets, count, 0.5), 'p95': _quantile(bounds, buckets, count, 0.95)}
+
+        return {'counters': counters, 'histograms': histograms}
+
+    def prometheus(self):
+        """
+        Func: 导出为 Prometheus 的文本格式（text exposition format 0.0.4）
+        """
+        current = self.snapshot()
+        lines = []
+        described = set()
+
+        def describe(name, kind):
+            if name not in described:
+                described.add(name)
+                if name in DESCRIPTIONS:
+                    lines.append(f'# HELP {NAMESPACE}_{name} {DESCRIPTIONS[name]}')
+                lines.append(f'# TYPE {NAMESPACE}_{name} {kind}')
+
+        for (name, labels), value in sorted(current['counters'].items()):
+            describe(name, 'counter')
+            lines.append(f'{NAMESPACE}_{name}{_label_text(labels)} {value}')
+
+        for (name, labels), value in sorted(current['histograms'].items()):
+            describe(name, 'histogram')
+            cumulative = 0
+            for upper, count in zip(self.buckets + ('+Inf',), value['buckets']):
+                cumulative += count
+                lines.append(f'{NAMESPACE}_{name}_bucket{_label_text(labels, [("le", upper)])} {cumulative}')
+            lines.append(f'{NAMESPACE}_{name}_sum{_label_text(labels)} {value["sum"]}')
+            lines.append(f'{NAMESPACE}_{name}_count{_label_text(labels)} {value["count"]}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def _write(path, content):
+    """
+    Func: 先写入临时文件再替换，读取指标的程序不会读到写了一半的文件
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temp = path + '.tmp'
+    with open(temp, 'w', encoding='utf-8') as f:
+        f.write(content)
+    os.replace(temp, path)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# 进程内共享的指标记录，各个模块都记录到这里
+metrics = Metrics()
+
+_prometheus_file = None
+_summary_file = None
+_server = None
+_config_lock = threading.Lock()
+
+
+def configure_metrics(prometheus_file=None, summary_file=None, port=None):
+    """
+    Func: 配置指标的输出方式（默认都不输出，指标只保存在内存中，get_files() 结束时写入日志）
+    :param prometheus_file: get_files() 结束时，将 Prometheus 文本格式的指标写入该文件
+                            （可以交给 node_exporter 的 textfile collector 读取）
+    :param summary_file: get_files() 结束时，将本次下载的 JSON 汇总写入该文件
+    :param port: 在该端口上启动 HTTP 服务，通过 http://127.0.0.1:port/metrics 提供 Prometheus 格式的指标；
+                 为 None 时关闭已经启动的服务
+    """
+    global _prometheus_file, _summary_file, _server
+    with _config_lock:
+        _prometheus_file = prometheus_file
+        _summary_file = summary_file
+
+        if _server is not None:
+            _server.shutdown()
+            _server.server_close()
+            _server = None
+        if port is not None:
+            _server = ThreadingHTTPServer(('127.0.0.1', port), _MetricsHandler)
+            _server.daemon_threads = True
+            threading.Thread(target=_server.serve_forever, name='metrics-server', daemon=True).start()
+            logger.info(f'指标服务已经启动：http://127.0.0.1:{_server.server_address[1]}/metrics\n')
+        return _server
+
+
+def report_run(since, started, episodes, completed):
+    """
+    Func: 生成一次下载的 JSON 汇总，写入日志；配置了输出文件时，同时写入汇总文件和 Prometheus 文件
+    :param since: 下载开始前 metrics.snapshot() 的快照
+    :param started: 下载开始的时间（time.time()）
+    :param episodes: 处理过的节目数量
+    :param completed: 全部资源都已经完成的节目数量；没有使用下载清单时为 None
+    :return: 字典，本次下载的汇总
+    """
+    elapsed = time.time() - started
+    summary = {
+        'started': datetime.datetime.fromtimestamp(started).isoformat(timespec='seconds'),
+        'elapsed_seconds': round(elapsed, 3),
+        'episodes': episodes,
+        'completed': completed,
+        'episodes_per_minute': round(episodes * 60 / elapsed, 3) if elapsed else None,
+    }
+    summary.update(metrics.summary(since))
+    logger.info(f'本次下载的指标汇总：{json.dumps(summary, ensure_ascii=False)}\n')
+
+    try:
+        if _summary_file:
+            _write(_summary_file, json.dumps(summary, ensure_ascii=False, indent=1))
+        if _prometheus_file:
+            _write(_prometheus_file, metrics.prometheus())
+    except OSError as e:
+        logger.error(f'保存指标出现错误，请检查：{e}\n')
+    return summary
+
+
+logger = log_setting('Overheard_metrics', '../Logs')
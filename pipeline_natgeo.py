@@ -0,0 +1,202 @@
+# -*- encoding: utf-8 -*-
+
+import queue
+import threading
+
+from browser_natgeo import WebDriverPool
+from get_all_specific_natgeo import STAGES, Downloader, check_stages, iter_episode_items
+from log_overheard import log_setting
+from session_natgeo import configure_session
+
+
+# 流水线的各个阶段及默认的线程数
+# fetch: 请求网页；parse: 解析网页并保存文本、图片信息；picture: 下载图片；
+# audio_url: 通过浏览器获取音频链接；audio: 下载音频
+DEFAULT_WORKERS = {
+    'fetch': 4,
+    'parse': 2,
+    'picture': 4,
+    'audio_url': 1,
+    'audio': 2,
+}
+
+# 队列中的结束标记
+_STOP = object()
+
+
+class Stage:
+    def __init__(self, name, func, workers, queue_size=None):
+        """
+        Func: 流水线中的一个阶段，拥有独立的线程池和有界队列
+        :param name: 阶段名称
+        :param func: 处理函数，接收一个节目的上下文（字典）；返回 False 表示该节目不再进入下游阶段
+        :param workers: 该阶段的线程数
+        :param queue_size: 输入队列的长度，默认为线程数的2倍
+        """
+        self.name = name
+        self.func = func
+        self.workers = max(1, int(workers))
+        self.queue = queue.Queue(maxsize=queue_size or self.workers * 2)
+        self.downstream = []
+        self.__threads = []
+        self.__alive = self.workers
+        self.__lock = threading.Lock()
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.__work, name=f'{self.name}-{i + 1}', daemon=True)
+            thread.start()
+            self.__threads.append(thread)
+
+    def join(self):
+        for thread in self.__threads:
+            thread.join()
+
+    def stop(self):
+        """
+        Func: 通知该阶段的所有线程：上游已经没有新的节目
+        """
+        for _ in range(self.workers):
+            self.queue.put(_STOP)
+
+    def __work(self):
+        while True:
+            ctx = self.queue.get()
+            if ctx is _STOP:
+                break
+
+            try:
+                result = self.func(ctx)
+            except Exception as e:
+                logger.error(f'【{ctx["title"]}】在【{self.name}】阶段出现错误，请检查：{e}\n')
+                result = False
+
+            # 处理成功，则交给下游的各个阶段继续处理
+            targets = self.downstream if result is not False else []
+            _branch(ctx, len(targets))
+            for stage in targets:
+                stage.queue.put(ctx)
+
+        # 最后一个退出的线程负责通知下游阶段
+        with self.__lock:
+            self.__alive -= 1
+            last = self.__alive == 0
+        if last:
+            for stage in self.downstream:
+                stage.stop()
+
+
+def _branch(ctx, count):
+    """
+    Func: 记录某一期节目在流水线中的分支数：一个阶段结束后交给 count 个下游阶段继续处理；
+          最后一个分支结束时（无论是处理完成、失败，还是没有选中后续的阶段）输出该节目的结束日志
+    """
+    with ctx['lock']:
+        ctx['branches'] += count - 1
+        finished = ctx['branches'] == 0
+    if finished:
+        logger.info(f'===============【Episode{ctx["num"]}: END】===============\n\n')
+
+
+class DownloadPipeline:
+    def __init__(self, workers=None, queue_size=None, browser_fetch=False, manifest=None, save_path=None,
+                 stages=STAGES, api_base=None):
+        """
+        Func: 分阶段的下载流水线。各阶段拥有独立的线程池和有界队列，
+              耗时的浏览器阶段不会阻塞网页请求和文件下载
+        :param workers: 字典，各阶段的线程数，未指定的阶段使用 DEFAULT_WORKERS 中的值
+        :param queue_size: 各阶段输入队列的长度，默认为该阶段线程数的2倍
+        :param browser_fetch: 在【fetch】阶段使用浏览器打开网页，并同时获取音频链接，见 Downloader
+        :param manifest: DownloadManifest，跳过已经完成的资源
+        :param save_path: 保存文件的目录，不提供则根据各期节目的发布日期构造，见 Downloader
+        :param stages: 需要执行的阶段，见 Downloader；没有选中 audio 时，音频相关的阶段不会收到任何节目；
+                       包含未知的阶段或者为空时抛出 ValueError
+        :param api_base: 播放器接口的地址，见 Downloader
+        """
+        if check_stages(stages) is None:
+            raise ValueError(f'选择的阶段 {stages} 不合法，只能从 {STAGES} 中选择')
+        self.workers = dict(DEFAULT_WORKERS)
+        if workers:
+            self.workers.update(workers)
+        self.queue_size = queue_size
+        self.browser_fetch = browser_fetch
+        self.manifest = manifest
+        self.save_path = save_path
+        self.stages = stages
+        self.api_base = api_base
+
+    @staticmethod
+    def _fetch(ctx):
+        logger.info(f'===============【Episode{ctx["num"]}: START】===============')
+        # 全部资源已经完成、只补下了音频，或者网页请求失败时，该节目不再进入下游阶段
+        if not ctx['downloader'].fetch_page():
+            return False
+
+    @staticmethod
+    def _parse(ctx):
+        ctx['picture_url'] = ctx['downloader'].parse_page()
+
+    @staticmethod
+    def _picture(ctx):
+        if ctx.get('picture_url'):
+            ctx['downloader'].save_picture(ctx['picture_url'])
+        return False
+
+    @staticmethod
+    def _audio_url(ctx):
+        if 'audio' not in ctx['downloader'].missing_assets():
+            return False
+        ctx['audio_url'] = ctx['downloader'].get_only_audio_url()
+        if not ctx['audio_url']:
+            return False
+
+    @staticmethod
+    def _audio(ctx):
+        ctx['downloader'].save_audio(ctx['audio_url'])
+        return False
+
+    def run(self, info):
+        """
+        Func: 使用流水线下载一期或者几期节目资源
+        :param info: 字典格式，保存节目的标题和对应的网址；或者依次返回 (标题, 网址) 的可迭代对象，
+                     例如 Sniffer.iter_episodes()，每返回一期节目就立即进入流水线
+        """
+        stages = {name: Stage(name, getattr(self, f'_{name}'), self.workers[name], self.queue_size)
+                  for name in DEFAULT_WORKERS}
+
+        # fetch -> parse -> (picture, audio_url -> audio)
+        stages['fetch'].downstream = [stages['parse']]
+        stages['parse'].downstream = [stages['picture'], stages['audio_url']]
+        stages['audio_url'].downstream = [stages['audio']]
+
+        # 连接池的大小与发起网络请求的线程总数保持一致，避免线程等待连接
+        configure_session(pool_size=sum(self.workers[name] for name in ('fetch', 'picture', 'audio')))
+
+        logger.info(f'开始使用流水线模式下载，各阶段的线程数为：{self.workers}\n')
+        for stage in stages.values():
+            stage.start()
+
+        # 浏览器的数量与使用浏览器的阶段的线程数一致，各期节目共用这些浏览器
+        driver_pool = WebDriverPool(size=self.workers['fetch' if self.browser_fetch else 'audio_url'])
+        num = 1
+        try:
+            for episode_title, episode_url in iter_episode_items(info) or ():
+                downloader = Downloader(episode_title, episode_url, save_path=self.save_path, driver_pool=driver_pool,
+                                        browser_fetch=self.browser_fetch, manifest=self.manifest, stages=self.stages,
+                                        api_base=self.api_base)
+                # branches: 该节目还在流水线中处理的分支数，见 _branch()
+                ctx = {'num': num, 'title': episode_title, 'downloader': downloader, 'branches': 1,
+                       'lock': threading.Lock()}
+                # 队列有界，上游过快时在此处阻塞，避免一次性堆积所有节目
+                stages['fetch'].queue.put(ctx)
+                num += 1
+        finally:
+            # 获取节目信息出现异常时同样通知各阶段结束，已经进入流水线的节目处理完后线程退出，不会一直阻塞在队列上
+            stages['fetch'].stop()
+            for stage in stages.values():
+                stage.join()
+            driver_pool.close()
+        logger.info(f'流水线处理完成，共处理【{num - 1}】期节目。\n')
+
+
+logger = log_setting('Overheard_pipeline', '../Logs')
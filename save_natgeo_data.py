@@ -1,11 +1,14 @@
 # -*- encoding: utf-8 -*-
 
+import datetime
+import functools
+import os
 import re
-
-import pymysql
-from pymysql.converters import escape_str
+import sqlite3
+import threading
 
 from log_overheard import log_setting
+from metrics_natgeo import metrics
 
 
 def check_instance(database='1', table='1', sqls=False, data=False):
@@ -41,11 +44,11 @@ def check_instance(database='1', table='1', sqls=False, data=False):
         status.append(False)
 
     if not isinstance(sqls, list) or len(sqls) < 1:
-        logger.error(f'提供的SQL语句不是非空列表的形式，请检查！')
+        logger.error('提供的SQL语句不是非空列表的形式，请检查！')
         status.append(False)
 
     if not isinstance(data, dict) or len(data) < 1:
-        logger.critical(f"提供的待检测的数据不是非空字典形式，请检查！")
+        logger.critical("提供的待检测的数据不是非空字典形式，请检查！")
         status.append(False)
 
     if False in status:
@@ -54,17 +57,106 @@ def check_instance(database='1', table='1', sqls=False, data=False):
         return True
 
 
-class DataProcess(object):
+def timed_operation(func):
+    """
+    Func: 记录数据库操作的耗时（db_seconds 指标），按存储后端和方法名统计
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with metrics.timer('db_seconds', backend=self.backend, operation=func.__name__):
+            return func(self, *args, **kwargs)
+    return wrapper
+
+
+class BaseDataProcess(object):
+    """
+    存储后端的公共接口。各个后端提供相同的操作：
+    is_database_exist / is_data_table_exist / create_database / delete_database /
+    create_data_table / delete_data_table / modify_data / insert_episodes /
+    check_latest_issue / known_urls / update_download_status / pending_episodes，并且可以作为上下文管理器使用
+    """
+    # 后端名称，与 create_processor() 的 backend 参数对应
+    backend = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        raise NotImplementedError
+
+    @timed_operation
+    def check_latest_issue(self, database, table, data):
+        """
+        Func: 检查用户提供的最新的节目信息中，哪些没有保存到指定的数据表中。
+              节目以网址（而不是可能被修改的标题）区分，一次查询取出所有已保存的网址后在内存中对比
+        :param database: 指定的数据库
+        :param table: 指定的数据表
+        :param data: 字典，保存最新的全部节目的基本信息，key 是节目标题，value 是节目的网址
+        :return: 字典，保存那些还未保存到数据库中的节目信息
+        """
+        if not check_instance(database=database, table=table, data=data):
+            return
+
+        if not self.is_database_exist(database):
+            return
+
+        if not self.is_data_table_exist(database, table):
+            return
+
+        logger.info('开始对比提供的节目信息和数据库中已有的节目信息 ... ')
+        known_urls = self.known_urls(database, table)
+        if known_urls is None:
+            return
+
+        # 用来保存数据库中没有的节目信息
+        latest_issue = {}
+        for title, url in data.items():
+            if url not in known_urls:
+                logger.warning(f"节目【{title}】在数据库中没有保存。\n")
+                latest_issue[title] = url
+
+        return latest_issue
+
+
+class DataProcess(BaseDataProcess):
+    backend = 'mysql'
+
     def __init__(self, username, password, host='localhost', port=3306, charset='utf8mb4'):
+        """
+        Func: MySQL 数据库处理器。每个线程复用一条长连接，可以作为上下文管理器使用，退出时关闭所有连接；
+              数据库和数据表是否存在的检查结果在处理器的生命周期内缓存，创建或删除时更新
+        """
         self.host = host
         self.port = port
         self.username = username
         self.password = password
         self.charset = charset
+        self.__local = threading.local()
+        self.__conns = []
+        self.__conns_lock = threading.Lock()
+        self.__database_cache = {}
+        self.__table_cache = {}
+
+    def close(self):
+        """
+        Func: 关闭处理器创建的所有数据库连接
+        """
+        with self.__conns_lock:
+            conns, self.__conns = self.__conns, []
+            # 之后再次使用时，各线程重新创建连接
+            self.__local = threading.local()
+        for conn in conns:
+            try:
+                conn.close()
+            except Exception:
+                pass
 
     def __create_conn(self, database=None):
         """
-        Func：创建数据库的连接
+        Func：获取当前线程的数据库连接；第一次调用时创建，之后复用（断开时重新创建）
         :param database: 要连接的数据库，默认为None，即不指定具体的数据库名称
         :return: 数据库连接
         """
@@ -72,13 +164,49 @@ class DataProcess(object):
             return
 
         try:
-            conn = pymysql.connect(user=self.username, password=self.password, host=self.host, port=self.port,
-                                   database=database, autocommit=True)
+            conn = getattr(self.__local, 'conn', None)
+            if conn is not None:
+                try:
+                    conn.ping()
+                except Exception as e:
+                    # 重新建立的会话中没有选择数据库，不能沿用缓存的数据库名称，因此直接创建新的连接
+                    logger.warning(f'数据库连接已经断开，重新连接：{e}')
+                    self.__drop_conn(conn)
+                    conn = None
+
+            if conn is None:
+                # pymysql 只在使用 MySQL 后端时导入
+                import pymysql
+
+                conn = pymysql.connect(user=self.username, password=self.password, host=self.host, port=self.port,
+                                       charset=self.charset, autocommit=True)
+                self.__local.conn = conn
+                self.__local.database = None
+                with self.__conns_lock:
+                    self.__conns.append(conn)
+
+            if database and database != self.__local.database:
+                conn.select_db(database)
+                self.__local.database = database
             return conn
         except Exception as e:
-            logger.critical(f'连接数据库服务出现异常，请检查！')
+            logger.critical('连接数据库服务出现异常，请检查！')
             logger.error(e)
 
+    def __drop_conn(self, conn):
+        """
+        Func: 关闭当前线程已经断开的连接，不再复用
+        """
+        self.__local.conn = None
+        self.__local.database = None
+        with self.__conns_lock:
+            if conn in self.__conns:
+                self.__conns.remove(conn)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
     def is_database_exist(self, database):
         """
         Func: 检查某个数据库是否存在
@@ -88,12 +216,16 @@ class DataProcess(object):
         if not check_instance(database=database):
             return
 
+        if database in self.__database_cache:
+            return self.__database_cache[database]
+
         conn = self.__create_conn()
         if conn:
             cursor = conn.cursor()
             try:
-                cursor.execute(f'select * from information_schema.SCHEMATA where SCHEMA_NAME = {escape_str(database)};')
-                if cursor.fetchall():
+                cursor.execute('select * from information_schema.SCHEMATA where SCHEMA_NAME = %s;', (database,))
+                self.__database_cache[database] = bool(cursor.fetchall())
+                if self.__database_cache[database]:
                     logger.info(f'数据库【{database}】存在。')
                     return True
                 else:
@@ -104,7 +236,6 @@ class DataProcess(object):
                 logger.error(e)
             finally:
                 cursor.close()
-                conn.close()
 
     def is_data_table_exist(self, database, table):
         """
@@ -116,14 +247,17 @@ class DataProcess(object):
         if not check_instance(database=database, table=table):
             return
 
+        if (database, table) in self.__table_cache:
+            return self.__table_cache[(database, table)]
+
         conn = self.__create_conn()
         if conn:
             cursor = conn.cursor()
             try:
-                cursor.execute(
-                    f'select * from information_schema.TABLES '
-                    f'where TABLE_SCHEMA = {escape_str(database)} and TABLE_NAME = {escape_str(table)};')
-                if cursor.fetchall():
+                cursor.execute('select * from information_schema.TABLES where TABLE_SCHEMA = %s and TABLE_NAME = %s;',
+                               (database, table))
+                self.__table_cache[(database, table)] = bool(cursor.fetchall())
+                if self.__table_cache[(database, table)]:
                     logger.info(f'数据表【{table}】存在。')
                     return True
                 else:
@@ -134,7 +268,17 @@ class DataProcess(object):
                 logger.error(e)
             finally:
                 cursor.close()
-                conn.close()
+
+    def __forget_database(self, database):
+        """
+        Func: 数据库被删除后，更新缓存的检查结果
+        """
+        self.__database_cache[database] = False
+        for key in [key for key in self.__table_cache if key[0] == database]:
+            self.__table_cache[key] = False
+        # 删除的数据库可能是当前连接正在使用的数据库
+        if getattr(self.__local, 'database', None) == database:
+            self.__local.database = None
 
     def create_database(self, database):
         """
@@ -153,15 +297,15 @@ class DataProcess(object):
             cursor = conn.cursor()
             try:
                 cursor.execute(f'CREATE DATABASE {database};')
+                self.__database_cache[database] = True
                 logger.info(f'数据库【{database}】创建完成。\n')
                 return True
             except Exception as e:
-                logger.critical(f'数据库创建出现异常，请检查！\n')
+                logger.critical('数据库创建出现异常，请检查！\n')
                 logger.error(e)
                 return False
             finally:
                 cursor.close()
-                conn.close()
 
     def delete_database(self, database):
         """
@@ -181,16 +325,17 @@ class DataProcess(object):
             try:
                 logger.info(f'开始删除数据库【{database}】 ... ')
                 cursor.execute(f'DROP DATABASE IF EXISTS {database};')
+                self.__forget_database(database)
                 logger.info(f'数据库【{database}】删除完成。\n')
                 return True
             except Exception as e:
-                logger.critical(f'数据库删除出现异常，请检查！\n')
+                logger.critical('数据库删除出现异常，请检查！\n')
                 logger.error(e)
                 return False
             finally:
                 cursor.close()
-                conn.close()
 
+    @timed_operation
     def create_data_table(self, database, table, sqls):
         """
         Func: 在指定的数据库中创建数据表
@@ -212,6 +357,7 @@ class DataProcess(object):
                 logger.info(f"开始在数据库【{database}】创建数据表【{table}】... ")
                 for sql in sqls:
                     cursor.execute(sql)
+                self.__table_cache[(database, table)] = True
                 logger.info(f"数据表【{table}】创建完成。\n")
                 return True
             except Exception as e:
@@ -223,7 +369,6 @@ class DataProcess(object):
                 return False
             finally:
                 cursor.close()
-                conn.close()
 
     def delete_data_table(self, database, table):
         """
@@ -244,16 +389,17 @@ class DataProcess(object):
             try:
                 logger.info(f'开始删除数据表【{table}】 ... ')
                 cursor.execute(f'drop table {table};')
+                self.__table_cache[(database, table)] = False
                 logger.info(f'数据表【{table}】删除完成。\n')
                 return True
             except Exception as e:
-                logger.critical(f'数据表删除出现异常，请检查！\n')
+                logger.critical('数据表删除出现异常，请检查！\n')
                 logger.error(e)
                 return False
             finally:
                 cursor.close()
-                conn.close()
 
+    @timed_operation
     def modify_data(self, database, table, sqls):
         """
         Func: 修改指定数据库中指定数据表中的数据
@@ -275,14 +421,14 @@ class DataProcess(object):
         if conn:
             cursor = conn.cursor()
             try:
-                logger.info(f'开始写入节目的基本信息 ... ')
+                logger.info('开始写入节目的基本信息 ... ')
                 for sql in sqls:
                     cursor.execute(sql)
                 # conn.commit()  # 数据库连接设置已经设置为自动提交
                 logger.info(f'节目的基本信息已经全部写入数据表【{table}】中。\n')
                 return True
             except Exception as e:
-                logger.critical(f'写入基本信息时出现异常，请检查！\n')
+                logger.critical('写入基本信息时出现异常，请检查！\n')
                 logger.error(e)
                 logger.warning(f'开始回滚数据库【{database}】... ')
                 conn.rollback()
@@ -290,15 +436,16 @@ class DataProcess(object):
                 return False
             finally:
                 cursor.close()
-                conn.close()
 
-    def check_latest_issue(self, database, table, data):
+    @timed_operation
+    def insert_episodes(self, database, table, data, batch_size=500):
         """
-        Func: 检查用户提供的最新的节目信息中，哪些没有保存到指定的数据表中
+        Func: 批量写入节目的基本信息。使用参数化的多行 INSERT 语句，所有批次在同一个事务中提交
         :param database: 指定的数据库
         :param table: 指定的数据表
-        :param data: 字典，保存最新的全部节目的基本信息，key 是节目标题，value 是节目的网址
-        :return: 字典，保存那些还未保存到数据库中的节目信息
+        :param data: 字典，key 是节目标题，value 是节目的网址
+        :param batch_size: 每个批次写入的行数
+        :return: 列表，保存每个批次写入的行数；写入失败，则返回False；其余情况，返回None
         """
         if not check_instance(database=database, table=table, data=data):
             return
@@ -309,30 +456,462 @@ class DataProcess(object):
         if not self.is_data_table_exist(database, table):
             return
 
+        # NOTE: pymysql 的 executemany() 只有在 VALUES (...) 中全部是 %s 占位符时，才会合并为一条多行 INSERT 语句，
+        #  写成 NOW() 会退化为逐行执行；因此更新时间在本批次中统一取一次，作为参数传入
+        # NOTE: URL 上有唯一索引，已经保存过的节目只更新标题（标题可能被修改过），不会重复写入
+        now = datetime.datetime.now().replace(microsecond=0)
+        rows = [(title, url, now) for title, url in data.items()]
+        sql = (f"INSERT INTO {table} (TITLE, URL, UPDATED_TIME) VALUES (%s, %s, %s) "
+               f"ON DUPLICATE KEY UPDATE TITLE = VALUES(TITLE)")
+
+        conn = self.__create_conn(database)
+        if conn:
+            cursor = conn.cursor()
+            try:
+                logger.info(f'开始批量写入【{len(rows)}】期节目的基本信息 ... ')
+                conn.begin()
+                counts = []
+                for start in range(0, len(rows), batch_size):
+                    counts.append(cursor.executemany(sql, rows[start:start + batch_size]))
+                conn.commit()
+                logger.info(f'节目的基本信息已经全部写入数据表【{table}】中，各批次写入的行数为：{counts}\n')
+                return counts
+            except Exception as e:
+                logger.critical('批量写入基本信息时出现异常，请检查！\n')
+                logger.error(e)
+                logger.warning(f'开始回滚数据库【{database}】... ')
+                conn.rollback()
+                logger.warning(f'回滚数据库【{database}】完成。\n')
+                return False
+            finally:
+                cursor.close()
+
+    @timed_operation
+    def update_download_status(self, database, table, urls, status='YES', batch_size=500):
+        """
+        Func: 更新节目的下载状态。每个批次使用一条 UPDATE ... WHERE URL IN (...) 语句
+        :param database: 指定的数据库
+        :param table: 指定的数据表
+        :param urls: 可迭代对象，需要更新的节目的网址
+        :param status: 下载状态
+        :param batch_size: 每条语句更新的网址数量
+        :return: 更新的行数；更新失败，则返回False；其余情况，返回None
+        """
+        if not check_instance(database=database, table=table):
+            return
+
+        urls = list(urls)
+        conn = self.__create_conn(database)
+        if conn:
+            cursor = conn.cursor()
+            try:
+                count = 0
+                for start in range(0, len(urls), batch_size):
+                    batch = urls[start:start + batch_size]
+                    count += cursor.execute(f"UPDATE {table} SET DOWNLOAD_STATUS = %s, UPDATED_TIME = NOW() "
+                                            f"WHERE URL IN ({', '.join(['%s'] * len(batch))})", [status, *batch])
+                logger.info(f'【{count}】期节目的下载状态更新为【{status}】。\n')
+                return count
+            except Exception as e:
+                logger.error('更新下载状态时出现异常，请检查！\n')
+                logger.error(e)
+                return False
+            finally:
+                cursor.close()
+
+    @timed_operation
+    def pending_episodes(self, database, table, status='YES'):
+        """
+        Func: 获取下载状态不是 status 的节目，包括新写入的节目和之前下载中断或失败的节目
+        :param database: 指定的数据库
+        :param table: 指定的数据表
+        :return: 字典，key 是节目标题，value 是节目的网址；查询失败，则返回None
+        """
+        if not check_instance(database=database, table=table):
+            return
+
+        if not self.is_data_table_exist(database, table):
+            return
+
         conn = self.__create_conn(database)
         if conn:
             cursor = conn.cursor()
             try:
-                logger.info(f'开始对比提供的节目信息和数据库中已有的节目信息 ... ')
-                # 用来保存数据库中没有的节目信息
-                latest_issue = {}
-
-                # 查询每条信息是否已经在数据库的表中
-                for title, url in data.items():
-                    # title = escape_str(title)
-                    cursor.execute(f"select 1 from {table} where title = {escape_str(title)} limit 1; ")
-                    num = cursor.fetchall()     # 返回值为一个元组
-                    if len(num) == 0:
-                        logger.warning(f"节目【{title}】在数据库中没有保存。\n")
-                        latest_issue[title] = url
-
-                return latest_issue
+                cursor.execute(f"select TITLE, URL from {table} where DOWNLOAD_STATUS <> %s order by NUM;", (status,))
+                return {title: url for title, url in cursor.fetchall()}
             except Exception as e:
-                logger.error('对比信息时出现异常，请检查！\n')
+                logger.error('查询未完成下载的节目时出现异常，请检查！\n')
                 logger.error(e)
             finally:
                 cursor.close()
+
+    @timed_operation
+    def known_urls(self, database, table):
+        """
+        Func: 一次查询取出数据表中已经保存的全部节目的网址
+        :return: 集合，保存已有节目的网址；数据表不存在或者查询失败，则返回None
+        """
+        if not check_instance(database=database, table=table):
+            return
+
+        if not self.is_data_table_exist(database, table):
+            return
+
+        conn = self.__create_conn(database)
+        if conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(f"select URL from {table};")
+                return {row[0] for row in cursor.fetchall()}
+            except Exception as e:
+                logger.error('查询已有的节目信息时出现异常，请检查！\n')
+                logger.error(e)
+            finally:
+                cursor.close()
+
+
+class SQLiteDataProcess(BaseDataProcess):
+    backend = 'sqlite'
+
+    def __init__(self, directory='../Data'):
+        """
+        Func: 内嵌的 SQLite 数据库处理器，无需单独的数据库服务。每个数据库对应 directory 下的一个 .db 文件，
+              使用 WAL 模式；每个线程复用自己的连接，可以作为上下文管理器使用
+        :param directory: 保存数据库文件的目录
+        """
+        self.directory = directory
+        self.__local = threading.local()
+        # 各个数据库在所有线程中创建的连接；删除数据库时关闭其全部连接，并增加其版本号，
+        # 其他线程发现自己的连接版本过期后重新创建
+        self.__conns = {}
+        self.__generations = {}
+        self.__conns_lock = threading.Lock()
+
+    def close(self):
+        """
+        Func: 关闭处理器创建的所有数据库连接
+        """
+        with self.__conns_lock:
+            conns, self.__conns = self.__conns, {}
+            self.__local = threading.local()
+        for conn in [conn for database in conns for conn in conns[database]]:
+            try:
                 conn.close()
+            except Exception:
+                pass
+
+    def __path(self, database):
+        return os.path.join(self.directory, f'{database}.db')
+
+    def __create_conn(self, database):
+        """
+        Func：获取当前线程中指定数据库的连接；第一次调用时创建，之后复用
+        :return: 数据库连接
+        """
+        if not check_instance(database=database):
+            return
+
+        conns = getattr(self.__local, 'conns', None)
+        if conns is None:
+            conns = self.__local.conns = {}
+
+        if database not in conns or conns[database][1] != self.__generations.get(database, 0):
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                # isolation_level=None：默认自动提交，需要事务时显式 BEGIN；
+                # check_same_thread=False：连接只在创建它的线程中使用，但可以由其他线程关闭
+                conn = sqlite3.connect(self.__path(database), isolation_level=None, check_same_thread=False)
+                conn.execute('PRAGMA journal_mode=WAL;')
+                conn.execute('PRAGMA synchronous=NORMAL;')
+                with self.__conns_lock:
+                    conns[database] = (conn, self.__generations.get(database, 0))
+                    self.__conns.setdefault(database, []).append(conn)
+            except Exception as e:
+                logger.critical(f'连接数据库【{database}】出现异常，请检查！')
+                logger.error(e)
+                return
+        return conns[database][0]
+
+    def __drop_conns(self, database):
+        """
+        Func: 关闭所有线程中指定数据库的连接
+        """
+        with self.__conns_lock:
+            self.__generations[database] = self.__generations.get(database, 0) + 1
+            conns = self.__conns.pop(database, [])
+        getattr(self.__local, 'conns', {}).pop(database, None)
+        for conn in conns:
+            conn.close()
+
+    def is_database_exist(self, database):
+        """
+        Func: 检查某个数据库（文件）是否存在
+        :return: 如果存在，则返回Ture；不存在，则返回False；其余情况，返回None
+        """
+        if not check_instance(database=database):
+            return
+
+        if os.path.exists(self.__path(database)):
+            return True
+        logger.warning(f'数据库【{database}】不存在。')
+        return False
+
+    def is_data_table_exist(self, database, table):
+        """
+        Func: 检查某张数据表是否存在于某个数据库中
+        :return: 如果存在，则返回Ture；不存在，则返回False；其余情况，返回None
+        """
+        if not check_instance(database=database, table=table):
+            return
+
+        if not self.is_database_exist(database):
+            return False
+
+        conn = self.__create_conn(database)
+        if conn:
+            try:
+                row = conn.execute("select 1 from sqlite_master where type = 'table' and name = ?;", (table,)).fetchone()
+                if row:
+                    return True
+                logger.warning(f'数据表【{table}】不存在。')
+                return False
+            except Exception as e:
+                logger.critical(f'检查数据表【{table}】出现异常！')
+                logger.error(e)
+
+    def create_database(self, database):
+        """
+        Func: 创建数据库（文件）
+        :return: 创建成功，则返回Ture；创建失败，则返回False；其余情况，返回None
+        """
+        if not check_instance(database=database):
+            return
+
+        if self.is_database_exist(database):
+            return
+
+        if self.__create_conn(database):
+            logger.info(f'数据库【{database}】创建完成。\n')
+            return True
+        return False
+
+    def delete_database(self, database):
+        """
+        Func: 删除指定的数据库（文件）
+        :return: 删除成功，则返回Ture；删除失败，则返回False；其余情况，返回None
+        """
+        if not check_instance(database=database):
+            return
+
+        if not self.is_database_exist(database):
+            return
+
+        try:
+            logger.info(f'开始删除数据库【{database}】 ... ')
+            self.__drop_conns(database)
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(self.__path(database) + suffix):
+                    os.remove(self.__path(database) + suffix)
+            logger.info(f'数据库【{database}】删除完成。\n')
+            return True
+        except Exception as e:
+            logger.critical('数据库删除出现异常，请检查！\n')
+            logger.error(e)
+            return False
+
+    @timed_operation
+    def create_data_table(self, database, table, sqls):
+        """
+        Func: 在指定的数据库中创建数据表
+        :param sqls: 一个列表，保存用来创建数据表的sql语句（SQLite 语法）
+        :return: 创建成功，则返回Ture；创建失败，则返回False；其余情况，返回None
+        """
+        if not check_instance(database=database, table=table, sqls=sqls):
+            return
+
+        if self.is_data_table_exist(database, table):
+            return
+
+        conn = self.__create_conn(database)
+        if conn:
+            try:
+                logger.info(f"开始在数据库【{database}】创建数据表【{table}】... ")
+                conn.execute('BEGIN;')
+                for sql in sqls:
+                    conn.execute(sql)
+                conn.execute('COMMIT;')
+                logger.info(f"数据表【{table}】创建完成。\n")
+                return True
+            except Exception as e:
+                logger.critical(f"数据表【{table}】创建失败，请检查！\n")
+                logger.error(e)
+                conn.rollback()
+                return False
+
+    def delete_data_table(self, database, table):
+        """
+        Func: 删除数据库中的数据表
+        :return: 删除成功，则返回Ture；删除失败，则返回False；其余情况，返回None
+        """
+        if not check_instance(database=database, table=table):
+            return
+
+        if not self.is_data_table_exist(database, table):
+            return
+
+        conn = self.__create_conn(database)
+        if conn:
+            try:
+                logger.info(f'开始删除数据表【{table}】 ... ')
+                conn.execute(f'drop table "{table}";')
+                logger.info(f'数据表【{table}】删除完成。\n')
+                return True
+            except Exception as e:
+                logger.critical('数据表删除出现异常，请检查！\n')
+                logger.error(e)
+                return False
+
+    @timed_operation
+    def modify_data(self, database, table, sqls):
+        """
+        Func: 在一个事务中执行用户提供的sql语句
+        :return: 修改成功，则返回Ture；修改失败，则返回False；其余情况，返回None
+        """
+        if not check_instance(database=database, table=table, sqls=sqls):
+            return
+
+        if not self.is_data_table_exist(database, table):
+            return
+
+        conn = self.__create_conn(database)
+        if conn:
+            try:
+                conn.execute('BEGIN;')
+                for sql in sqls:
+                    conn.execute(sql)
+                conn.execute('COMMIT;')
+                logger.info(f'数据已经全部写入数据表【{table}】中。\n')
+                return True
+            except Exception as e:
+                logger.critical('写入数据时出现异常，请检查！\n')
+                logger.error(e)
+                conn.rollback()
+                return False
+
+    @timed_operation
+    def insert_episodes(self, database, table, data, batch_size=500):
+        """
+        Func: 批量写入节目的基本信息，所有批次在同一个事务中提交；已经保存过的网址只更新标题
+        :param data: 字典，key 是节目标题，value 是节目的网址
+        :return: 列表，保存每个批次写入的行数；写入失败，则返回False；其余情况，返回None
+        """
+        if not check_instance(database=database, table=table, data=data):
+            return
+
+        if not self.is_data_table_exist(database, table):
+            return
+
+        rows = list(data.items())
+        sql = (f'INSERT INTO "{table}" (TITLE, URL, UPDATED_TIME) VALUES (?, ?, datetime(\'now\', \'localtime\')) '
+               f'ON CONFLICT(URL) DO UPDATE SET TITLE = excluded.TITLE')
+
+        conn = self.__create_conn(database)
+        if conn:
+            try:
+                logger.info(f'开始批量写入【{len(rows)}】期节目的基本信息 ... ')
+                conn.execute('BEGIN;')
+                counts = []
+                for start in range(0, len(rows), batch_size):
+                    counts.append(conn.executemany(sql, rows[start:start + batch_size]).rowcount)
+                conn.execute('COMMIT;')
+                logger.info(f'节目的基本信息已经全部写入数据表【{table}】中，各批次写入的行数为：{counts}\n')
+                return counts
+            except Exception as e:
+                logger.critical('批量写入基本信息时出现异常，请检查！\n')
+                logger.error(e)
+                conn.rollback()
+                return False
+
+    @timed_operation
+    def update_download_status(self, database, table, urls, status='YES'):
+        """
+        Func: 更新节目的下载状态
+        :return: 更新的行数；更新失败，则返回False；其余情况，返回None
+        """
+        if not check_instance(database=database, table=table):
+            return
+
+        conn = self.__create_conn(database)
+        if conn:
+            try:
+                count = conn.executemany(f'UPDATE "{table}" SET DOWNLOAD_STATUS = ?, '
+                                         f'UPDATED_TIME = datetime(\'now\', \'localtime\') WHERE URL = ?',
+                                         [(status, url) for url in urls]).rowcount
+                logger.info(f'【{count}】期节目的下载状态更新为【{status}】。\n')
+                return count
+            except Exception as e:
+                logger.error('更新下载状态时出现异常，请检查！\n')
+                logger.error(e)
+                return False
+
+    @timed_operation
+    def pending_episodes(self, database, table, status='YES'):
+        """
+        Func: 获取下载状态不是 status 的节目，包括新写入的节目和之前下载中断或失败的节目
+        :return: 字典，key 是节目标题，value 是节目的网址；查询失败，则返回None
+        """
+        if not check_instance(database=database, table=table):
+            return
+
+        if not self.is_data_table_exist(database, table):
+            return
+
+        conn = self.__create_conn(database)
+        if conn:
+            try:
+                rows = conn.execute(f'select TITLE, URL from "{table}" where DOWNLOAD_STATUS <> ? order by NUM;',
+                                    (status,))
+                return {title: url for title, url in rows}
+            except Exception as e:
+                logger.error('查询未完成下载的节目时出现异常，请检查！\n')
+                logger.error(e)
+
+    @timed_operation
+    def known_urls(self, database, table):
+        """
+        Func: 一次查询取出数据表中已经保存的全部节目的网址
+        :return: 集合，保存已有节目的网址；数据表不存在或者查询失败，则返回None
+        """
+        if not check_instance(database=database, table=table):
+            return
+
+        if not self.is_data_table_exist(database, table):
+            return
+
+        conn = self.__create_conn(database)
+        if conn:
+            try:
+                return {row[0] for row in conn.execute(f'select URL from "{table}";')}
+            except Exception as e:
+                logger.error('查询已有的节目信息时出现异常，请检查！\n')
+                logger.error(e)
+
+
+def create_processor(backend='mysql', username=None, password=None, directory='../Data', **kwargs):
+    """
+    Func: 创建指定存储后端的数据库处理器
+    :param backend: 'mysql' 或 'sqlite'
+    :param username: MySQL 的用户名
+    :param password: MySQL 的密码
+    :param directory: SQLite 保存数据库文件的目录
+    :param kwargs: 传给 DataProcess 的其他参数（host、port、charset）
+    :return: 数据库处理器
+    """
+    if backend == 'mysql':
+        return DataProcess(username, password, **kwargs)
+    if backend == 'sqlite':
+        return SQLiteDataProcess(directory)
+    raise ValueError(f'不支持的存储后端【{backend}】')
 
 
 logger = log_setting('Overheard_database', '../Logs')
@@ -0,0 +1,468 @@
+# -*- encoding: utf-8 -*-
+
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+
+from log_overheard import log_setting
+from metrics_natgeo import host_of, metrics
+
+
+# 请求的优先级，数值越小越先处理：网页（列表页、节目网页、播放器接口）最先，其次是图片，音频最后
+PAGE = 0
+PICTURE = 1
+AUDIO = 2
+PRIORITY_NAMES = {PAGE: 'page', PICTURE: 'picture', AUDIO: 'audio'}
+
+# 不知道文件大小时，开始下载前按优先级预留的字节数；收到响应头后按实际大小调整
+DEFAULT_ESTIMATES = {PAGE: 512 * 1024, PICTURE: 1024 * 1024, AUDIO: 64 * 1024 * 1024}
+
+# 已经开始的下载重新预留字节数时使用的优先级，排在所有等待开始的下载之前
+_RESERVE_AGAIN = -1
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        """
+        Func: 令牌桶。每秒补充 rate 个令牌，最多积攒 burst 个；不是线程安全的，由使用者加锁
+        :param rate: 每秒补充的令牌数（每秒的请求数，或者每秒的字节数）
+        :param burst: 令牌桶的容量，默认为 rate（至少为1）
+        """
+        self.rate = float(rate)
+        self.capacity = float(burst or max(1.0, self.rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, tokens=1):
+        """
+        Func: 还需要等待多久才有 tokens 个令牌（秒）
+        """
+        return max(0.0, (tokens - self.tokens) / self.rate)
+
+    def reserve(self, tokens):
+        """
+        Func: 预先取走 tokens 个令牌（令牌数可以为负），返回需要等待的时间；用于按字节数限速
+        """
+        self.refill(time.monotonic())
+        self.tokens -= tokens
+        return max(0.0, -self.tokens / self.rate)
+
+
+class _PriorityQueue:
+    """
+    按 (优先级, 先后顺序) 排队的等待者，只有排在最前面的等待者可以继续
+    """
+    def __init__(self):
+        self.__heap = []
+
+    def push(self, ticket):
+        heapq.heappush(self.__heap, ticket)
+
+    def first(self):
+        return self.__heap[0] if self.__heap else None
+
+    def remove(self, ticket):
+        self.__heap.remove(ticket)
+        heapq.heapify(self.__heap)
+
+    def __len__(self):
+        return len(self.__heap)
+
+
+class Transfer:
+    def __init__(self, scheduler, url, priority, reserved=0):
+        """
+        Func: 一次文件下载在调度器中的记录：记录预留的、尚未传输的字节数，并按全局带宽限速
+              由 TransferScheduler.start_transfer() 创建；scheduler 为 None（没有开启下载调度）时不做任何限制
+        :param reserved: 开始下载时已经预留的字节数
+        """
+        self.__scheduler = scheduler
+        self.__lock = threading.Lock()
+        self.url = url
+        self.priority = priority
+        self.remaining = reserved
+
+    def expect(self, size):
+        """
+        Func: 收到响应头后，按需要传输的实际字节数调整预留的字节数；比预留的多时，释放已经预留的字节数，
+              重新排队预留 size 字节（排在所有等待开始的下载之前），等待期间不占用预留，多个下载同时等待时不会互相阻塞
+        """
+        if self.__scheduler is None:
+            return
+        if self.__adjust(size):
+            self.__scheduler._reserve_again(self, size)
+
+    async def async_expect(self, size):
+        """
+        Func: expect() 的异步版本
+        """
+        if self.__scheduler is None:
+            return
+        if self.__adjust(size):
+            await self.__scheduler._async_reserve_again(self, size)
+
+    def __adjust(self, size):
+        """
+        Func: 预留的字节数不少于 size 时释放多出的部分；少于 size 时释放全部预留，返回True表示需要重新预留
+        """
+        with self.__lock:
+            held = self.remaining
+        self.__release(held - size if held >= size else held)
+        return held < size
+
+    def _reserved(self, size):
+        """
+        Func: 调度器增加了 size 字节的预留后调用（调用时持有调度器的锁）
+        """
+        with self.__lock:
+            self.remaining += size
+
+    def received(self, size):
+        """
+        Func: 收到 size 字节后调用；超过全局带宽时在此处等待
+        """
+        if self.__scheduler is None:
+            return
+        delay = self.__scheduler._throttle(size, self.priority)
+        if delay:
+            time.sleep(delay)
+        self.__release(size)
+
+    async def async_received(self, size):
+        """
+        Func: received() 的异步版本，等待时不阻塞事件循环
+        """
+        if self.__scheduler is None:
+            return
+        delay = self.__scheduler._throttle(size, self.priority)
+        if delay:
+            await asyncio.sleep(delay)
+        self.__release(size)
+
+    def finish(self):
+        """
+        Func: 下载结束（包括失败）时调用，释放还没有传输的字节数
+        """
+        self.__release(self.remaining)
+
+    def __release(self, size):
+        # 分段下载时，多个线程同时调用
+        with self.__lock:
+            size = min(size, self.remaining)
+            self.remaining -= size
+        if size:
+            self.__scheduler._add_inflight(-size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.finish()
+
+
+class TransferScheduler:
+    def __init__(self, host_rates=None, default_rate=None, burst=None, bandwidth=None, max_inflight_bytes=None,
+                 estimates=None):
+        """
+        Func: 下载调度器。限制每个主机的请求频率（令牌桶）、全局的下载速度和进行中的下载字节数；
+              排队时按优先级处理：网页最先，其次是图片，音频最后。各项等待时间记录在 scheduler_wait_seconds 指标中。
+              线程和协程在同一个队列中排队：线程通过条件变量等待，协程在事件循环中等待，不占用线程
+        :param host_rates: 字典，各个主机每秒最多发送的请求数，例如 {'www.nationalgeographic.com': 2}
+        :param default_rate: 没有在 host_rates 中指定的主机每秒最多发送的请求数；None 表示不限制
+        :param burst: 令牌桶的容量（允许短时间内连续发送的请求数），默认与每秒的请求数相同
+        :param bandwidth: 全局的下载速度上限（字节/秒）；None 表示不限制
+        :param max_inflight_bytes: 进行中的下载预留的字节数之和的上限。开始下载时先预留文件的大小（不知道大小时
+                                   按 estimates 估计，收到响应头后再调整），超过上限时排队等待，直到有下载完成；
+                                   没有其他下载时不受限制（文件本身大于上限）。None 表示不限制
+        :param estimates: 字典，不知道文件大小时各优先级预留的字节数，默认为 DEFAULT_ESTIMATES
+        """
+        self.host_rates = dict(host_rates or {})
+        self.default_rate = default_rate
+        self.burst = burst
+        self.max_inflight_bytes = max_inflight_bytes
+        self.estimates = dict(DEFAULT_ESTIMATES)
+        self.estimates.update(estimates or {})
+        self.__cond = threading.Condition()
+        self.__seq = itertools.count()
+        self.__buckets = {}
+        self.__host_queues = {}
+        self.__transfer_queue = _PriorityQueue()
+        self.__async_waiters = set()
+        self.__inflight = 0
+        self.__peak = 0
+        self.__bandwidth = TokenBucket(bandwidth, bandwidth) if bandwidth else None
+
+    def __bucket(self, host):
+        if host not in self.__buckets:
+            rate = self.host_rates.get(host, self.default_rate)
+            self.__buckets[host] = TokenBucket(rate, self.burst) if rate else None
+        return self.__buckets[host]
+
+    @staticmethod
+    def __record_wait(kind, priority, start):
+        wait = time.monotonic() - start
+        metrics.observe('scheduler_wait_seconds', wait, kind=kind, priority=PRIORITY_NAMES.get(priority, priority))
+        return wait
+
+    def __notify(self):
+        """
+        Func: 状态发生变化时唤醒所有等待者（需要在持有锁时调用）：线程通过条件变量，协程通过各自事件循环中的 Event
+        """
+        self.__cond.notify_all()
+        for loop, event in self.__async_waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                # 事件循环已经关闭
+                pass
+
+    def __wait(self, queue, ticket, attempt):
+        """
+        Func: 在 queue 中排队，直到 attempt() 返回 (True, _)；attempt() 在持有锁时调用，
+              返回 (是否成功, 最多等待的秒数)，等待的秒数为 None 时等待状态变化的通知
+        """
+        with self.__cond:
+            queue.push(ticket)
+            try:
+                while True:
+                    acquired, timeout = attempt()
+                    if acquired:
+                        return
+                    self.__cond.wait(timeout)
+            finally:
+                queue.remove(ticket)
+                self.__notify()
+
+    async def __async_wait(self, queue, ticket, attempt):
+        """
+        Func: __wait() 的异步版本，在事件循环中等待通知或者超时，不占用线程
+        """
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self.__cond:
+            queue.push(ticket)
+            self.__async_waiters.add(waiter)
+        try:
+            while True:
+                waiter[1].clear()
+                with self.__cond:
+                    acquired, timeout = attempt()
+                if acquired:
+                    return
+                try:
+                    await asyncio.wait_for(waiter[1].wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with self.__cond:
+                queue.remove(ticket)
+                self.__async_waiters.discard(waiter)
+                self.__notify()
+
+    def __request_attempt(self, bucket, waiting, ticket):
+        def attempt():
+            bucket.refill(time.monotonic())
+            first = waiting.first() == ticket
+            if first and bucket.tokens >= 1:
+                bucket.tokens -= 1
+                return True, None
+            # 排在最前面时等待下一个令牌，否则等待前面的请求发送后再检查
+            return False, bucket.delay() if first else None
+        return attempt
+
+    def __request_queue(self, url):
+        host = host_of(url)
+        with self.__cond:
+            bucket = self.__bucket(host)
+            if bucket is None:
+                return None, None
+            return bucket, self.__host_queues.setdefault(host, _PriorityQueue())
+
+    def acquire_request(self, url, priority=PAGE):
+        """
+        Func: 发送请求之前调用；该主机的请求频率达到上限时等待，同一主机上优先级高的请求先发送
+        :return: 等待的时间（秒）
+        """
+        start = time.monotonic()
+        bucket, waiting = self.__request_queue(url)
+        if bucket is None:
+            return 0.0
+        ticket = (priority, next(self.__seq))
+        self.__wait(waiting, ticket, self.__request_attempt(bucket, waiting, ticket))
+        return self.__record_wait('request', priority, start)
+
+    async def async_acquire_request(self, url, priority=PAGE):
+        """
+        Func: acquire_request() 的异步版本，在事件循环中等待
+        """
+        start = time.monotonic()
+        bucket, waiting = self.__request_queue(url)
+        if bucket is None:
+            return 0.0
+        ticket = (priority, next(self.__seq))
+        await self.__async_wait(waiting, ticket, self.__request_attempt(bucket, waiting, ticket))
+        return self.__record_wait('request', priority, start)
+
+    def __reserve(self, size, transfer=None):
+        """
+        Func: 预留 size 字节（需要在持有锁时调用）
+        """
+        self.__inflight += size
+        self.__peak = max(self.__peak, self.__inflight)
+        if transfer is not None:
+            transfer._reserved(size)
+
+    def __reserve_attempt(self, ticket, size, transfer=None):
+        """
+        Func: 排在最前面，且预留 size 字节后不超过上限（或者没有其他下载）时预留
+        """
+        def attempt():
+            if self.__transfer_queue.first() != ticket:
+                return False, None
+            if self.__inflight + size > self.max_inflight_bytes and self.__inflight > 0:
+                return False, None
+            self.__reserve(size, transfer)
+            return True, None
+        return attempt
+
+    def __estimate(self, priority, size):
+        size = self.estimates.get(priority, self.estimates[AUDIO]) if size is None else size
+        return min(size, self.max_inflight_bytes)
+
+    def start_transfer(self, url, priority=AUDIO, size=None):
+        """
+        Func: 开始下载文件之前调用；预留 size 字节（不知道大小时按优先级估计），超过进行中的字节数上限时等待，
+              优先级高的下载先开始
+        :param size: 需要下载的字节数（例如断点续传时剩余的大小）；None 表示不知道
+        :return: Transfer，下载过程中调用其 expect()/received()，结束时调用 finish()（或者使用 with 语句）
+        """
+        if not self.max_inflight_bytes:
+            return Transfer(self, url, priority)
+        start = time.monotonic()
+        size = self.__estimate(priority, size)
+        ticket = (priority, next(self.__seq))
+        self.__wait(self.__transfer_queue, ticket, self.__reserve_attempt(ticket, size))
+        self.__record_wait('inflight', priority, start)
+        return Transfer(self, url, priority, size)
+
+    async def async_start_transfer(self, url, priority=AUDIO, size=None):
+        """
+        Func: start_transfer() 的异步版本，在事件循环中等待
+        """
+        if not self.max_inflight_bytes:
+            return Transfer(self, url, priority)
+        start = time.monotonic()
+        size = self.__estimate(priority, size)
+        ticket = (priority, next(self.__seq))
+        await self.__async_wait(self.__transfer_queue, ticket, self.__reserve_attempt(ticket, size))
+        self.__record_wait('inflight', priority, start)
+        return Transfer(self, url, priority, size)
+
+    def _reserve_again(self, transfer, size):
+        """
+        Func: 已经开始的下载 transfer 释放预留后，重新预留 size 字节，排在所有等待开始的下载之前
+        """
+        if not self.max_inflight_bytes:
+            with self.__cond:
+                return self.__reserve(size, transfer)
+        start = time.monotonic()
+        ticket = (_RESERVE_AGAIN, next(self.__seq))
+        self.__wait(self.__transfer_queue, ticket, self.__reserve_attempt(ticket, size, transfer))
+        self.__record_wait('inflight', transfer.priority, start)
+
+    async def _async_reserve_again(self, transfer, size):
+        """
+        Func: _reserve_again() 的异步版本
+        """
+        if not self.max_inflight_bytes:
+            with self.__cond:
+                return self.__reserve(size, transfer)
+        start = time.monotonic()
+        ticket = (_RESERVE_AGAIN, next(self.__seq))
+        await self.__async_wait(self.__transfer_queue, ticket, self.__reserve_attempt(ticket, size, transfer))
+        self.__record_wait('inflight', transfer.priority, start)
+
+    def _add_inflight(self, size):
+        with self.__cond:
+            self.__inflight += size
+            if size < 0:
+                self.__notify()
+
+    def _throttle(self, size, priority):
+        """
+        Func: 按全局带宽计算收到 size 字节后需要等待的时间
+        """
+        if self.__bandwidth is None:
+            return 0.0
+        with self.__cond:
+            delay = self.__bandwidth.reserve(size)
+        if delay:
+            metrics.observe('scheduler_wait_seconds', delay, kind='bandwidth',
+                            priority=PRIORITY_NAMES.get(priority, priority))
+        return delay
+
+    def stats(self):
+        """
+        Func: 调度器的当前状态，用于调整参数
+        :return: 字典，包括进行中的字节数及其峰值、排队等待开始的下载数量和各个主机排队等待的请求数量
+        """
+        with self.__cond:
+            return {'inflight_bytes': self.__inflight, 'peak_inflight_bytes': self.__peak,
+                    'waiting_transfers': len(self.__transfer_queue),
+                    'waiting_requests': {host: len(queue) for host, queue in self.__host_queues.items() if len(queue)}}
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def configure_scheduler(host_rates=None, default_rate=None, burst=None, bandwidth=None, max_inflight_bytes=None,
+                        estimates=None):
+    """
+    Func: 开启下载调度，参数同 TransferScheduler；所有参数都为 None 时关闭（默认关闭，不做任何限制）
+    """
+    global _scheduler
+    with _scheduler_lock:
+        if host_rates or default_rate or bandwidth or max_inflight_bytes:
+            _scheduler = TransferScheduler(host_rates, default_rate, burst, bandwidth, max_inflight_bytes, estimates)
+            logger.info(f'下载调度已经开启：各主机的请求频率【{host_rates}】，其他主机【{default_rate}】次/秒，'
+                        f'带宽上限【{bandwidth}】字节/秒，进行中的字节数上限【{max_inflight_bytes}】。\n')
+        else:
+            _scheduler = None
+        return _scheduler
+
+
+def get_scheduler():
+    """
+    Func: 当前的下载调度器；没有开启时返回 None
+    """
+    return _scheduler
+
+
+def start_transfer(url, priority=AUDIO, size=None):
+    """
+    Func: 通过当前的下载调度器开始一次文件下载；没有开启下载调度时返回不做任何限制的 Transfer
+    :param size: 需要下载的字节数，不知道时为 None，见 TransferScheduler.start_transfer()
+    """
+    scheduler = _scheduler
+    if scheduler is None:
+        return Transfer(None, url, priority)
+    return scheduler.start_transfer(url, priority, size)
+
+
+async def async_start_transfer(url, priority=AUDIO, size=None):
+    """
+    Func: start_transfer() 的异步版本
+    """
+    scheduler = _scheduler
+    if scheduler is None:
+        return Transfer(None, url, priority)
+    return await scheduler.async_start_transfer(url, priority, size)
+
+
+logger = log_setting('Overheard_scheduler', '../Logs')
@@ -0,0 +1,198 @@
+# -*- encoding: utf-8 -*-
+
+import asyncio
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from log_overheard import log_setting
+from metrics_natgeo import host_of, metrics
+from scheduler_natgeo import PAGE, get_scheduler
+
+
+# 遇到以下状态码时进行重试
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+# 遇到以下异常（连接被重置、超时等）时进行重试
+RETRY_EXCEPTIONS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+
+
+class HttpSession:
+    def __init__(self, pool_size=10, connect_timeout=10, read_timeout=60, retries=4, backoff=0.5, max_backoff=30):
+        """
+        Func: 进程内共享的HTTP会话，复用TCP+TLS连接，并对失败的请求进行指数退避重试
+        :param pool_size: 连接池的大小，应与并发数保持一致
+        :param connect_timeout: 建立连接的超时时间（秒）
+        :param read_timeout: 读取数据的超时时间（秒）
+        :param retries: 最多重试的次数
+        :param backoff: 退避的基础时间（秒），第n次重试前等待 backoff * 2^n 秒，并加上随机抖动
+        :param max_backoff: 单次退避的最长时间（秒）
+        """
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def delay(self, attempt, retry_after=None):
+        """
+        Func: 计算第 attempt 次重试前需要等待的时间（full jitter）；服务器提供了 Retry-After 时优先使用
+        """
+        if retry_after:
+            try:
+                return min(float(retry_after), self.max_backoff)
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def get(self, url, priority=PAGE, **kwargs):
+        """
+        Func: 发送GET请求；状态码为 429/5xx 或者连接出现异常时，按指数退避进行重试。
+              开启了下载调度时，每次请求（包括重试）之前按主机的请求频率排队
+        :param url: 请求的链接
+        :param priority: 排队时的优先级（scheduler_natgeo.PAGE/PICTURE/AUDIO）
+        :param kwargs: 传给 requests.Session.get() 的其他参数
+        :return: requests.Response；重试次数用完后，返回最后一次的响应或抛出最后一次的异常
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        host = host_of(url)
+
+        for attempt in range(self.retries + 1):
+            scheduler = get_scheduler()
+            if scheduler is not None:
+                scheduler.acquire_request(url, priority)
+            try:
+                with metrics.timer('http_request_seconds', host=host):
+                    response = self.session.get(url, **kwargs)
+            except RETRY_EXCEPTIONS as e:
+                metrics.inc('http_requests_total', host=host, status='error')
+                if attempt >= self.retries:
+                    raise
+                metrics.inc('http_retries_total', host=host)
+                wait = self.delay(attempt)
+                logger.warning(f'请求【{url}】出现错误：{e}，{wait:.2f}秒后进行第{attempt + 1}次重试 ... ')
+                time.sleep(wait)
+                continue
+
+            metrics.inc('http_requests_total', host=host, status=response.status_code)
+            if response.status_code in RETRY_STATUS and attempt < self.retries:
+                metrics.inc('http_retries_total', host=host)
+                wait = self.delay(attempt, response.headers.get('Retry-After'))
+                logger.warning(f'请求【{url}】返回码为【{response.status_code}】，'
+                               f'{wait:.2f}秒后进行第{attempt + 1}次重试 ... ')
+                response.close()
+                time.sleep(wait)
+                continue
+
+            return response
+
+    async def async_get(self, session, url, priority=PAGE, **kwargs):
+        """
+        Func: get() 的异步版本，使用相同的重试策略和下载调度
+        :param session: aiohttp.ClientSession
+        :param url: 请求的链接
+        :param priority: 排队时的优先级
+        :param kwargs: 传给 aiohttp.ClientSession.get() 的其他参数
+        :return: aiohttp.ClientResponse，调用者需要使用 async with 释放连接
+        """
+        aiohttp = load_aiohttp()
+        kwargs.setdefault('timeout', aiohttp.ClientTimeout(sock_connect=self.timeout[0], sock_read=self.timeout[1]))
+        host = host_of(url)
+
+        for attempt in range(self.retries + 1):
+            scheduler = get_scheduler()
+            if scheduler is not None:
+                await scheduler.async_acquire_request(url, priority)
+            try:
+                with metrics.timer('http_request_seconds', host=host):
+                    response = await session.get(url, **kwargs)
+            except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError) as e:
+                metrics.inc('http_requests_total', host=host, status='error')
+                if attempt >= self.retries:
+                    raise
+                metrics.inc('http_retries_total', host=host)
+                wait = self.delay(attempt)
+                logger.warning(f'请求【{url}】出现错误：{e}，{wait:.2f}秒后进行第{attempt + 1}次重试 ... ')
+                await asyncio.sleep(wait)
+                continue
+
+            metrics.inc('http_requests_total', host=host, status=response.status)
+            if response.status in RETRY_STATUS and attempt < self.retries:
+                metrics.inc('http_retries_total', host=host)
+                wait = self.delay(attempt, response.headers.get('Retry-After'))
+                logger.warning(f'请求【{url}】返回码为【{response.status}】，'
+                               f'{wait:.2f}秒后进行第{attempt + 1}次重试 ... ')
+                response.release()
+                await asyncio.sleep(wait)
+                continue
+
+            return response
+
+    def close(self):
+        self.session.close()
+
+
+def load_aiohttp():
+    """
+    Func: 导入 aiohttp。异步模式为可选功能，只在使用时导入，不影响同步接口的启动速度
+    :return: aiohttp 模块；没有安装时返回 None
+    """
+    try:
+        import aiohttp
+    except ImportError:
+        return None
+    return aiohttp
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def configure_session(**kwargs):
+    """
+    Func: 按指定的参数重新创建进程内共享的HTTP会话，参数同 HttpSession
+    """
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = HttpSession(**kwargs)
+        logger.info(f'HTTP会话配置完成，连接池大小为【{_session.pool_size}】。\n')
+        return _session
+
+
+def get_session():
+    """
+    Func: 获取进程内共享的HTTP会话；第一次调用时使用默认参数创建
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = HttpSession()
+    return _session
+
+
+def http_get(url, **kwargs):
+    """
+    Func: 使用共享的HTTP会话发送GET请求
+    """
+    return get_session().get(url, **kwargs)
+
+
+async def async_http_get(session, url, **kwargs):
+    """
+    Func: 使用共享会话的重试策略，通过 aiohttp 发送GET请求
+    """
+    return await get_session().async_get(session, url, **kwargs)
+
+
+logger = log_setting('Overheard_session', '../Logs')
@@ -0,0 +1,256 @@
+# -*- encoding: utf-8 -*-
+
+import asyncio
+import json
+import os
+import shutil
+import threading
+
+from log_overheard import log_setting
+from manifest_natgeo import file_digest
+from metrics_natgeo import metrics
+from session_natgeo import async_http_get, http_get
+from transfer_natgeo import _total_size, async_download_file, download_file
+
+# 检查链接是否变化时只请求第一个字节，从响应头中取得 ETag 和文件的总大小
+PROBE_HEADERS = {'Range': 'bytes=0-0'}
+
+
+class BlobStore:
+    def __init__(self, directory):
+        """
+        Func: 按内容寻址的文件仓库。每个文件只按其 SHA-256 校验值保存一份，
+              各期节目目录中的文件都是指向仓库的硬链接（不支持时使用符号链接，再不行则复制）；
+              同时记录每个链接对应的校验值、文件大小和 ETag；再次使用已经下载过的链接时只检查服务器上的文件是否变化，
+              没有变化则无需再次下载
+        :param directory: 仓库目录，不存在时自动创建；与节目目录在同一个磁盘上时才能使用硬链接
+        """
+        self.directory = directory
+        self.__index_path = os.path.join(directory, 'urls.json')
+        self.__lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.__urls = self.__load()
+
+    def __load(self):
+        if not os.path.exists(self.__index_path):
+            return {}
+        try:
+            with open(self.__index_path, 'r', encoding='utf-8') as f:
+                urls = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f'读取文件仓库的链接索引出现错误，将重新记录：{e}')
+            return {}
+        # 旧版本的索引只记录了校验值
+        return {url: record if isinstance(record, dict) else {'digest': record} for url, record in urls.items()}
+
+    def __save(self):
+        temp = self.__index_path + '.tmp'
+        with open(temp, 'w', encoding='utf-8') as f:
+            json.dump(self.__urls, f, ensure_ascii=False)
+        os.replace(temp, self.__index_path)
+
+    def blob_path(self, digest):
+        """
+        Func: 校验值对应的文件在仓库中的位置，按校验值的前两位分目录保存
+        """
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def lookup(self, url):
+        """
+        Func: 查找某个链接对应的记录
+        :return: 字典，包含校验值（digest）、文件大小（size）和 ETag（etag，没有时为 None）；
+                 没有下载过或者仓库中的文件已经丢失时返回 None
+        """
+        with self.__lock:
+            record = dict(self.__urls.get(url) or {})
+        if record and os.path.exists(self.blob_path(record['digest'])):
+            return record
+        return None
+
+    def digest(self, url):
+        """
+        Func: 查找某个链接对应的校验值，没有记录时返回 None
+        """
+        record = self.lookup(url)
+        return record['digest'] if record else None
+
+    @staticmethod
+    def __changed(record, etag, size):
+        """
+        Func: 根据服务器返回的 ETag 和文件大小，判断链接的内容是否已经变化；服务器没有返回的项不参与比较
+        """
+        if size is not None and record.get('size') is not None and size != record['size']:
+            return True
+        return etag is not None and record.get('etag') is not None and etag != record['etag']
+
+    @staticmethod
+    def __link(source, path):
+        """
+        Func: 在 path 处创建指向 source 的链接：优先硬链接，其次符号链接，都不支持时复制
+        """
+        temp = path + '.link'
+        if os.path.lexists(temp):
+            os.remove(temp)
+        try:
+            os.link(source, temp)
+        except OSError:
+            try:
+                os.symlink(os.path.abspath(source), temp)
+            except OSError:
+                shutil.copyfile(source, temp)
+        os.replace(temp, path)
+
+    def link_url(self, url, path, validators=None):
+        """
+        Func: 链接已经下载过、并且服务器上的文件没有变化时，直接将仓库中的文件链接到 path，无需再次下载
+        :param validators: 服务器当前返回的 (ETag, 文件大小)，见 probe()；为 None 时表示无法确认，需要重新下载
+        :return: 链接成功返回 path，否则返回 None
+        """
+        record = self.lookup(url)
+        if record is None or validators is None:
+            return None
+
+        etag, size = validators
+        if self.__changed(record, etag, size):
+            logger.warning(f'链接【{url}】的内容已经变化，重新下载。')
+            with self.__lock:
+                self.__urls.pop(url, None)
+                self.__save()
+            return None
+
+        self.__link(self.blob_path(record['digest']), path)
+        # 之前没有记录 ETag 时补充记录，之后可以据此判断
+        if etag is not None and record.get('etag') is None:
+            with self.__lock:
+                if url in self.__urls:
+                    self.__urls[url]['etag'] = etag
+                    self.__save()
+        logger.info(f'链接【{url}】已经下载过，直接使用仓库中的文件【{record["digest"]}】。')
+        return path
+
+    def add(self, path, url=None):
+        """
+        Func: 将下载完成的文件放入仓库，并在原位置换成指向仓库的链接；
+              仓库中已经有相同内容的文件时，删除新下载的文件，只保留链接
+        :param path: 下载完成的文件
+        :param url: 文件的链接，记录后可以跳过再次下载
+        :return: 文件的校验值
+        """
+        digest = file_digest(path)
+        size = os.path.getsize(path)
+        blob = self.blob_path(digest)
+        with self.__lock:
+            if os.path.exists(blob):
+                logger.info(f'文件【{path}】与仓库中的文件【{digest}】内容相同，不再重复保存。')
+            else:
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                shutil.move(path, blob)
+            self.__link(blob, path)
+
+            if url and self.__urls.get(url, {}).get('digest') != digest:
+                # ETag 在第一次重复使用该链接时记录，见 link_url()
+                self.__urls[url] = {'digest': digest, 'size': size, 'etag': None}
+                self.__save()
+        return digest
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def configure_store(directory=None):
+    """
+    Func: 开启或关闭按内容寻址的文件仓库；directory 为 None 时关闭（默认关闭）
+    """
+    global _store
+    with _store_lock:
+        _store = BlobStore(directory) if directory else None
+        return _store
+
+
+def stored_digest(url):
+    """
+    Func: 开启了文件仓库时，返回链接对应的文件的校验值，记录下载清单时无需再次计算；否则返回 None
+    """
+    store = _store
+    return store.digest(url) if store is not None else None
+
+
+def probe(url):
+    """
+    Func: 只请求文件的第一个字节，获取服务器上文件当前的 ETag 和大小
+    :return: (ETag, 文件大小)，无法获取的项为 None；请求失败时返回 None
+    """
+    try:
+        with http_get(url, headers=PROBE_HEADERS, stream=True) as response:
+            if response.status_code not in (200, 206):
+                return None
+            return response.headers.get('ETag'), _total_size(response.status_code, response.headers, 0)
+    except Exception as e:
+        logger.warning(f'检查链接【{url}】是否变化时出现错误：{e}')
+        return None
+
+
+async def async_probe(session, url):
+    """
+    Func: probe() 的异步版本
+    :param session: aiohttp.ClientSession
+    """
+    try:
+        async with await async_http_get(session, url, headers=PROBE_HEADERS) as response:
+            if response.status not in (200, 206):
+                return None
+            return response.headers.get('ETag'), _total_size(response.status, response.headers, 0)
+    except Exception as e:
+        logger.warning(f'检查链接【{url}】是否变化时出现错误：{e}')
+        return None
+
+
+def _keep(store, url, path):
+    try:
+        store.add(path, url)
+    except OSError as e:
+        # 放入仓库失败不影响已经下载完成的文件
+        logger.warning(f'文件【{path}】放入仓库出现错误：{e}')
+
+
+def stored_download(url, path, **kwargs):
+    """
+    Func: 下载文件。开启了文件仓库时，下载过的链接直接链接到仓库中的文件，新下载的文件放入仓库
+    :param kwargs: 传给 download_file() 的其他参数
+    :return: 下载成功返回 path，失败返回 False
+    """
+    store = _store
+    if store is not None and store.lookup(url) and store.link_url(url, path, probe(url)):
+        metrics.inc('store_requests_total', result='hit')
+        return path
+    if store is not None:
+        metrics.inc('store_requests_total', result='miss')
+
+    result = download_file(url, path, **kwargs)
+    if result and store is not None:
+        _keep(store, url, path)
+    return result
+
+
+async def async_stored_download(session, url, path, **kwargs):
+    """
+    Func: stored_download() 的异步版本
+    :param session: aiohttp.ClientSession
+    """
+    store = _store
+    if store is not None and store.lookup(url) and \
+            await asyncio.to_thread(store.link_url, url, path, await async_probe(session, url)):
+        metrics.inc('store_requests_total', result='hit')
+        return path
+    if store is not None:
+        metrics.inc('store_requests_total', result='miss')
+
+    result = await async_download_file(session, url, path, **kwargs)
+    if result and store is not None:
+        # 计算校验值较慢，在线程中执行，不阻塞事件循环
+        await asyncio.to_thread(_keep, store, url, path)
+    return result
+
+
+logger = log_setting('Overheard_store', '../Logs')
@@ -0,0 +1,48 @@
+# -*- encoding: utf-8 -*-
+
+import os
+import sys
+
+import pytest
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(scope='session', autouse=True)
+def workdir(tmp_path_factory):
+    """
+    Func: 在 pytest 管理的临时目录中运行所有测试：没有指定目录时下载的文件保存在当前目录，日志写入其中的 Logs 目录
+    """
+    from log_overheard import configure_logging
+
+    root = tmp_path_factory.mktemp('overheard')
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.chdir(root)
+        configure_logging(str(root / 'Logs'), console=False)
+        yield root
+
+
+@pytest.fixture
+def site():
+    """
+    Func: 离线的模拟网站，测试结束后关闭
+    """
+    from fixture_natgeo import FixtureSite
+
+    with FixtureSite(episodes=2, audio_size=2_000_000) as fixture:
+        yield fixture
+
+
+@pytest.fixture(autouse=True)
+def reset_settings():
+    """
+    Func: 每个测试结束后恢复分段下载和下载调度的默认设置
+    """
+    import scheduler_natgeo
+    import transfer_natgeo
+
+    yield
+    transfer_natgeo.configure_segments()
+    scheduler_natgeo.configure_scheduler()
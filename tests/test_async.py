@@ -0,0 +1,72 @@
+# -*- encoding: utf-8 -*-
+
+import asyncio
+import threading
+import warnings
+
+import pytest
+
+from fixture_natgeo import FixtureSite
+from get_all_specific_natgeo import Downloader, async_get_files
+from manifest_natgeo import DownloadManifest
+from session_natgeo import load_aiohttp
+
+
+pytestmark = pytest.mark.skipif(load_aiohttp() is None, reason='没有安装 aiohttp')
+
+
+@pytest.fixture
+def site():
+    with FixtureSite(episodes=4) as fixture:
+        yield fixture
+
+
+def test_async_get_files_downloads_every_asset(site, tmp_path):
+    manifest = DownloadManifest(str(tmp_path / 'manifest.json'))
+    completed = asyncio.run(async_get_files(site.episode_info(), concurrency=2, manifest=manifest,
+                                            save_path=str(tmp_path), api_base=site.base_url))
+
+    assert sorted(completed) == sorted(site.episode_info().values())
+    for number, url in enumerate(reversed(list(site.episode_info().values())), 1):
+        with open(manifest.asset(url, 'audio')['path'], 'rb') as f:
+            assert f.read() == site.file_content(number, site.audio_size)
+
+
+def test_parsing_and_hashing_run_off_the_event_loop(site, tmp_path, monkeypatch):
+    loop_threads = set()
+    parse_page = Downloader.parse_page
+    mark_done = DownloadManifest.mark_done
+
+    def record(func):
+        def wrapper(*args, **kwargs):
+            loop_threads.add(threading.current_thread() is threading.main_thread())
+            return func(*args, **kwargs)
+        return wrapper
+
+    monkeypatch.setattr(Downloader, 'parse_page', record(parse_page))
+    monkeypatch.setattr(DownloadManifest, 'mark_done', record(mark_done))
+    manifest = DownloadManifest(str(tmp_path / 'manifest.json'))
+    asyncio.run(async_get_files(site.episode_info(), concurrency=2, manifest=manifest, save_path=str(tmp_path),
+                                api_base=site.base_url))
+
+    # 事件循环运行在主线程中
+    assert loop_threads == {False}
+
+
+def test_iterator_error_waits_for_started_episodes(site, tmp_path):
+    info = list(site.episode_info().items())
+
+    def episodes():
+        yield from info[:2]
+        raise RuntimeError('列表页解析失败')
+
+    manifest = DownloadManifest(str(tmp_path / 'manifest.json'))
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        with pytest.raises(RuntimeError):
+            asyncio.run(async_get_files(episodes(), concurrency=2, manifest=manifest, save_path=str(tmp_path),
+                                        api_base=site.base_url))
+
+    # 已经开始的节目处理完成，没有被遗弃的任务
+    assert all(not manifest.missing(url) for _, url in info[:2])
+    assert not [w for w in caught if 'never awaited' in str(w.message) or 'destroyed' in str(w.message)]
@@ -0,0 +1,31 @@
+# -*- encoding: utf-8 -*-
+
+import pytest
+
+import audio_natgeo
+from audio_natgeo import IHEART_API, resolve_audio_url
+from fixture_natgeo import FixtureSite
+from get_all_specific_natgeo import Downloader
+
+
+@pytest.fixture
+def api_only(monkeypatch):
+    # 播放器页面不可用，音频链接只能通过播放器接口获取
+    monkeypatch.setattr(audio_natgeo, 'audio_url_from_player', lambda player_url: None)
+
+
+def test_resolve_audio_url_uses_given_api_base(api_only):
+    with FixtureSite(episodes=2) as site:
+        player_url = f'{site.base_url}/podcast/1119-overheard/episode/episode-2-{1000000 + 2}/?embed=true'
+        assert resolve_audio_url(player_url, api_base=site.base_url) == f'{site.base_url}/audio/2.mp3'
+
+
+def test_downloader_passes_api_base_to_resolver(api_only, tmp_path):
+    with FixtureSite(episodes=2) as site:
+        for number, (title, url) in enumerate(reversed(list(site.episode_info().items())), 1):
+            downloader = Downloader(title, url, save_path=str(tmp_path), manifest=None, api_base=site.base_url)
+            assert downloader.fetch_page()
+            downloader.parse_page()
+            assert downloader.get_only_audio_url() == f'{site.base_url}/audio/{number}.mp3'
+    # 模拟服务的地址只对传入的 Downloader 生效，不修改全局的接口地址
+    assert audio_natgeo.IHEART_API == IHEART_API
@@ -0,0 +1,141 @@
+# -*- encoding: utf-8 -*-
+
+import threading
+
+import pytest
+from urllib3.exceptions import MaxRetryError
+
+import browser_natgeo
+import get_all_specific_natgeo
+from browser_natgeo import WebDriverPool
+from get_all_specific_natgeo import Downloader
+
+
+class FakeDriver:
+    """
+    模拟 selenium 的浏览器；crash() 之后所有操作都像 chromedriver 退出后一样抛出 MaxRetryError
+    """
+    def __init__(self):
+        self.crashed = False
+        self.quit_called = False
+
+    def crash(self):
+        self.crashed = True
+
+    def __check(self):
+        if self.crashed:
+            raise MaxRetryError(None, 'http://localhost:9515/session', 'Connection refused')
+
+    @property
+    def window_handles(self):
+        self.__check()
+        return ['main']
+
+    @property
+    def switch_to(self):
+        self.__check()
+        return self
+
+    def default_content(self):
+        pass
+
+    def window(self, handle):
+        pass
+
+    def execute_script(self, script):
+        self.__check()
+
+    def delete_all_cookies(self):
+        self.__check()
+
+    def get(self, url):
+        self.__check()
+
+    def quit(self):
+        self.quit_called = True
+        self.__check()
+
+
+@pytest.fixture
+def drivers(monkeypatch):
+    created = []
+
+    def new_driver():
+        created.append(FakeDriver())
+        return created[-1]
+
+    monkeypatch.setattr(browser_natgeo, 'new_driver', new_driver)
+    return created
+
+
+def acquire_with_timeout(pool, timeout=5):
+    """
+    Func: 在后台线程中获取浏览器；浏览器的名额泄漏时 acquire() 会一直等待，此时返回 None
+    """
+    result = []
+    thread = threading.Thread(target=lambda: result.append(pool.acquire()), daemon=True)
+    thread.start()
+    thread.join(timeout)
+    return result[0] if result else None
+
+
+def test_pool_reuses_healthy_driver(drivers):
+    pool = WebDriverPool(size=1)
+    with pool.driver() as driver:
+        pass
+    with pool.driver() as again:
+        pass
+
+    assert again is driver
+    assert len(drivers) == 1
+    pool.close()
+
+
+def test_pool_recovers_after_driver_crash_during_use(drivers):
+    pool = WebDriverPool(size=1)
+    with pytest.raises(MaxRetryError):
+        with pool.driver() as driver:
+            driver.crash()
+            driver.get('https://example.com')
+
+    replacement = acquire_with_timeout(pool)
+    assert replacement is not None and replacement is not driver
+    assert driver.quit_called
+    pool.release(replacement)
+    pool.close()
+
+
+def test_pool_recovers_when_crash_is_found_on_release(drivers):
+    # 浏览器在使用结束后才崩溃：重置时出现的错误同样需要关闭浏览器并释放名额
+    pool = WebDriverPool(size=1)
+    with pool.driver() as driver:
+        driver.crash()
+
+    replacement = acquire_with_timeout(pool)
+    assert replacement is not None and replacement is not driver
+    assert len(drivers) == 2
+    pool.release(replacement)
+    pool.close()
+
+
+@pytest.mark.parametrize('error, replaced', [
+    (MaxRetryError(None, 'http://localhost:9515/session', 'Connection refused'), True),
+    # 网页中没有播放器属于网页内容的问题，浏览器可以继续使用
+    (IndexError('list index out of range'), False),
+])
+def test_browser_error_while_clicking_audio_discards_driver(error, replaced, drivers, site, tmp_path, monkeypatch):
+    def click_audio_url(driver):
+        raise error
+
+    monkeypatch.setattr(get_all_specific_natgeo, 'click_audio_url', click_audio_url)
+    monkeypatch.setattr(get_all_specific_natgeo, 'resolve_audio_url', lambda player_url, api_base=None: None)
+    pool = WebDriverPool(size=1)
+    title, url = list(site.episode_info().items())[0]
+    downloader = Downloader(title, url, save_path=str(tmp_path), driver_pool=pool, manifest=None)
+    assert not downloader.get_only_audio_url()
+
+    again = acquire_with_timeout(pool)
+    assert (again is not drivers[0]) == replaced
+    assert drivers[0].quit_called == replaced
+    pool.release(again)
+    pool.close()
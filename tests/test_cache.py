@@ -0,0 +1,81 @@
+# -*- encoding: utf-8 -*-
+
+import asyncio
+
+import pytest
+
+import cache_natgeo
+from cache_natgeo import HttpCache, async_cached_http_get, cached_http_get, configure_cache
+from metrics_natgeo import metrics
+from session_natgeo import load_aiohttp
+
+
+@pytest.fixture
+def cache(tmp_path):
+    yield configure_cache(str(tmp_path / 'cache'))
+    configure_cache(None)
+
+
+def cache_results(since):
+    return metrics.summary(since)['counters'].get('cache_requests_total', {})
+
+
+def test_unchanged_page_is_served_from_cache(cache, site):
+    url = site.episode_url(1)
+    first = cached_http_get(url)
+    assert first.status_code == 200 and not getattr(first, 'from_cache', False)
+    assert cache.lookup(url)['etag'] == '"episode-1"'
+
+    since = metrics.snapshot()
+    second = cached_http_get(url)
+    assert second.from_cache and second.content == first.content
+    assert cache_results(since) == {'{result="hit"}': 1}
+    # 服务器返回 304 时不传输网页内容
+    assert not metrics.summary(since)['counters'].get('bytes_total')
+
+
+@pytest.mark.skipif(load_aiohttp() is None, reason='没有安装 aiohttp')
+def test_async_unchanged_page_is_served_from_cache(cache, site):
+    aiohttp = load_aiohttp()
+
+    async def fetch():
+        async with aiohttp.ClientSession() as session:
+            return await async_cached_http_get(session, site.episode_url(1))
+
+    status, content, _ = asyncio.run(fetch())
+    since = metrics.snapshot()
+    assert asyncio.run(fetch()) == (200, content, 'text/html; charset=utf-8')
+    assert cache_results(since) == {'{result="hit"}': 1}
+
+
+def test_least_recently_used_pages_are_evicted(tmp_path):
+    cache = HttpCache(str(tmp_path / 'cache'), max_size=250)
+    headers = {'ETag': '"v1"'}
+    cache.store('https://example.com/a', b'a' * 100, headers)
+    cache.store('https://example.com/b', b'b' * 100, headers)
+    # a 最近得到了确认，b 成为最久没有使用的缓存
+    assert cache.load('https://example.com/a')
+    cache.store('https://example.com/c', b'c' * 100, headers)
+
+    assert cache.lookup('https://example.com/a')
+    assert cache.lookup('https://example.com/b') is None
+    assert cache.lookup('https://example.com/c')
+
+
+def test_expired_pages_are_dropped(tmp_path, monkeypatch):
+    cache = HttpCache(str(tmp_path / 'cache'), max_age=60)
+    cache.store('https://example.com/a', b'a', {'Last-Modified': 'Sat, 17 Oct 2026 00:00:00 GMT'})
+    assert cache.conditional_headers(cache.lookup('https://example.com/a')) == {
+        'If-Modified-Since': 'Sat, 17 Oct 2026 00:00:00 GMT'}
+
+    now = cache_natgeo.time.time()
+    monkeypatch.setattr(cache_natgeo.time, 'time', lambda: now + 61)
+    assert cache.lookup('https://example.com/a') is None
+
+
+def test_uncacheable_responses_are_not_stored(tmp_path):
+    cache = HttpCache(str(tmp_path / 'cache'))
+    cache.store('https://example.com/a', b'a', {})
+    cache.store('https://example.com/b', b'b', {'ETag': '"v1"', 'Cache-Control': 'no-store'})
+    assert cache.lookup('https://example.com/a') is None
+    assert cache.lookup('https://example.com/b') is None
@@ -0,0 +1,61 @@
+# -*- encoding: utf-8 -*-
+
+import download_natgeo
+from fixture_natgeo import FixtureSite
+from get_all_basic_natgeo import Sniffer
+from metrics_natgeo import metrics
+from save_natgeo_data import create_processor
+
+
+DATABASE = 'natgeo'
+DATA_TABLE = 'overheard'
+
+
+def listing_pages():
+    """
+    Func: 到目前为止请求过的列表页数量（每一页记录一次 stage_seconds{stage="listing"}）
+    """
+    return metrics.summary()['histograms'].get('stage_seconds', {}).get('{stage="listing"}', {}).get('count', 0)
+
+
+def test_all_pages_are_walked_without_known_urls():
+    with FixtureSite(episodes=30, page_size=10) as site:
+        episodes = list(Sniffer(site.home_url).iter_episodes())
+        # 标题中的特殊字符会被替换，只比较网址和顺序
+        assert [url for _, url in episodes] == list(site.episode_info().values())
+
+
+def test_early_stop_when_first_page_is_known():
+    with FixtureSite(episodes=30, page_size=10) as site:
+        info = site.episode_info()
+        newest = list(info.values())[:10]
+        episodes = list(Sniffer(site.home_url).iter_episodes(known_urls=frozenset(newest)))
+
+    assert [url for _, url in episodes] == newest
+
+
+def test_early_stop_with_partially_known_database(tmp_path, monkeypatch):
+    downloaded = []
+    # 只检查交给下载的节目，不真正下载
+    monkeypatch.setattr(download_natgeo, 'get_files',
+                        lambda episodes: [downloaded.append(url) or url for _, url in episodes])
+
+    with FixtureSite(episodes=30, page_size=10) as site:
+        info = site.episode_info()
+        # 数据库中已有最早的 5 期节目，都在最后一页上
+        oldest = dict(list(info.items())[-5:])
+        with create_processor('sqlite', directory=str(tmp_path)) as processor:
+            processor.create_database(DATABASE)
+            processor.create_data_table(DATABASE, DATA_TABLE, download_natgeo.create_table_sqls(DATA_TABLE, 'sqlite'))
+            processor.insert_episodes(DATABASE, DATA_TABLE, oldest)
+            processor.update_download_status(DATABASE, DATA_TABLE, list(oldest.values()))
+
+        pages = listing_pages()
+        download_natgeo.update_download(site.home_url, None, None, DATABASE, DATA_TABLE, backend='sqlite',
+                                        directory=str(tmp_path))
+
+        # 前两页的节目都是新的，写入数据库后不能提前停止翻页；第3页上的新节目同样需要下载
+        assert listing_pages() - pages == 3
+        assert sorted(downloaded) == sorted(url for url in info.values() if url not in oldest.values())
+        with create_processor('sqlite', directory=str(tmp_path)) as processor:
+            assert processor.known_urls(DATABASE, DATA_TABLE) == set(info.values())
@@ -0,0 +1,47 @@
+# -*- encoding: utf-8 -*-
+
+import os
+
+import pytest
+
+from archive_natgeo import configure_archive
+from fixture_natgeo import FixtureSite
+from get_all_specific_natgeo import get_files
+from manifest_natgeo import DownloadManifest
+
+
+@pytest.fixture
+def archive(tmp_path):
+    yield configure_archive(str(tmp_path / 'html'))
+    configure_archive(None)
+
+
+def test_archived_html_is_tracked_by_path(archive, tmp_path):
+    manifest = DownloadManifest(str(tmp_path / 'manifest.json'))
+    with FixtureSite(episodes=2) as site:
+        info = site.episode_info()
+        assert sorted(get_files(info, manifest=manifest, save_path=str(tmp_path), stages=('text',))) == \
+            sorted(info.values())
+
+        url = list(info.values())[0]
+        path = manifest.asset(url, 'html')['path']
+        assert os.path.dirname(path) == archive.directory
+        assert manifest.is_done(url, 'html')
+
+        # html文件被删除后，该期节目不再完整，再次运行时重新请求网页并保存
+        os.remove(path)
+        assert manifest.missing(url, ['html', 'text']) == ['html']
+        assert sorted(get_files(info, manifest=manifest, save_path=str(tmp_path), stages=('text',))) == \
+            sorted(info.values())
+        assert os.path.exists(path)
+        assert manifest.is_done(url, 'html')
+
+
+def test_html_in_memory_is_done_without_archive(tmp_path):
+    manifest = DownloadManifest(str(tmp_path / 'manifest.json'))
+    with FixtureSite(episodes=1) as site:
+        info = site.episode_info()
+        get_files(info, manifest=manifest, save_path=str(tmp_path), stages=('text',))
+
+    record = manifest.asset(list(info.values())[0], 'html')
+    assert record['status'] == 'done' and record['path'] is None and record['size'] > 0
@@ -0,0 +1,80 @@
+# -*- encoding: utf-8 -*-
+
+import json
+import urllib.request
+
+import pytest
+
+from get_all_specific_natgeo import Downloader, get_files
+from manifest_natgeo import DownloadManifest
+from metrics_natgeo import Metrics, configure_metrics, metrics
+
+
+@pytest.fixture
+def outputs(tmp_path):
+    yield tmp_path / 'metrics.prom', tmp_path / 'summary.json'
+    configure_metrics()
+
+
+def test_summary_counts_changes_since_snapshot():
+    recorder = Metrics(buckets=(0.1, 1))
+    recorder.inc('bytes_total', 100, host='example.com')
+    since = recorder.snapshot()
+    recorder.inc('bytes_total', 50, host='example.com')
+    for seconds in (0.05, 0.5, 5):
+        recorder.observe('stage_seconds', seconds, stage='audio')
+
+    summary = recorder.summary(since)
+    assert summary['counters'] == {'bytes_total': {'{host="example.com"}': 50}}
+    histogram = summary['histograms']['stage_seconds']['{stage="audio"}']
+    assert histogram['count'] == 3 and histogram['sum'] == 5.55
+    assert histogram['p50'] == 0.55
+
+
+def test_prometheus_text_format():
+    recorder = Metrics(buckets=(0.1, 1))
+    recorder.inc('cache_requests_total', result='hit')
+    recorder.observe('stage_seconds', 0.5, stage='fetch')
+    recorder.observe('stage_seconds', 2, stage='fetch')
+
+    lines = recorder.prometheus().splitlines()
+    assert '# TYPE overheard_cache_requests_total counter' in lines
+    assert 'overheard_cache_requests_total{result="hit"} 1' in lines
+    # 直方图的分桶是累计的
+    assert 'overheard_stage_seconds_bucket{stage="fetch",le="0.1"} 0' in lines
+    assert 'overheard_stage_seconds_bucket{stage="fetch",le="1"} 1' in lines
+    assert 'overheard_stage_seconds_bucket{stage="fetch",le="+Inf"} 2' in lines
+    assert 'overheard_stage_seconds_count{stage="fetch"} 2' in lines
+
+
+def test_get_files_writes_summary_and_prometheus_files(site, tmp_path, outputs):
+    prometheus_file, summary_file = outputs
+    configure_metrics(prometheus_file=str(prometheus_file), summary_file=str(summary_file))
+    manifest = DownloadManifest(str(tmp_path / 'manifest.json'))
+    get_files(site.episode_info(), manifest=manifest, save_path=str(tmp_path), stages=('text', 'picture'))
+
+    summary = json.loads(summary_file.read_text(encoding='utf-8'))
+    assert summary['episodes'] == summary['completed'] == 2
+    assert summary['episodes_per_minute'] > 0
+    assert summary['counters']['assets_total']['{asset="picture",status="done"}'] == 2
+    assert sum(summary['counters']['bytes_total'].values()) >= 2 * site.picture_size
+    assert {'{stage="fetch"}', '{stage="parse"}', '{stage="picture"}'} <= set(summary['histograms']['stage_seconds'])
+    assert 'overheard_stage_seconds_bucket{stage="picture",le="+Inf"}' in prometheus_file.read_text(encoding='utf-8')
+
+
+def test_get_file_returns_per_asset_result(site, tmp_path):
+    title, url = list(site.episode_info().items())[0]
+    downloader = Downloader(title, url, save_path=str(tmp_path), manifest=None, stages=('text', 'picture'))
+    result = downloader.get_file()
+
+    assert result['status'] == 'complete' and result['url'] == url
+    assert result['assets'] == {'html': 'done', 'text': 'done', 'picture': 'done'}
+    assert result['timings']['picture'] > 0
+
+
+def test_metrics_endpoint(outputs):
+    metrics.inc('episodes_discovered_total', 0)
+    server = configure_metrics(port=0)
+    with urllib.request.urlopen(f'http://127.0.0.1:{server.server_address[1]}/metrics') as response:
+        assert response.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+        assert b'# TYPE overheard_' in response.read()
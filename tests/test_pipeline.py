@@ -0,0 +1,61 @@
+# -*- encoding: utf-8 -*-
+
+import pytest
+
+import browser_natgeo
+import pipeline_natgeo
+from fixture_natgeo import FixtureSite
+from get_all_specific_natgeo import Downloader
+from manifest_natgeo import DownloadManifest
+from pipeline_natgeo import DownloadPipeline
+
+
+class RecordingLogger:
+    def __init__(self, logger):
+        self.logger = logger
+        self.messages = []
+
+    def info(self, msg, *args, **kwargs):
+        self.messages.append(msg)
+        self.logger.info(msg, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.logger, name)
+
+    def count(self, text):
+        return sum(text in msg for msg in self.messages)
+
+
+@pytest.fixture
+def records(monkeypatch):
+    def new_driver():
+        raise AssertionError('这些节目不应该启动浏览器')
+
+    monkeypatch.setattr(browser_natgeo, 'new_driver', new_driver)
+    recording = RecordingLogger(pipeline_natgeo.logger)
+    monkeypatch.setattr(pipeline_natgeo, 'logger', recording)
+    return recording
+
+
+def run_pipeline(tmp_path, stages, episodes=3):
+    manifest = DownloadManifest(str(tmp_path / 'manifest.json'))
+    with FixtureSite(episodes=episodes) as site:
+        DownloadPipeline(manifest=manifest, save_path=str(tmp_path), stages=stages).run(site.episode_info())
+    return manifest
+
+
+def test_end_logged_without_audio_stage(tmp_path, records):
+    run_pipeline(tmp_path, ('text', 'picture'))
+    for num in (1, 2, 3):
+        assert records.count(f'【Episode{num}: START】') == 1
+        assert records.count(f'【Episode{num}: END】') == 1
+
+
+def test_end_logged_when_parse_fails(tmp_path, records, monkeypatch):
+    def parse_page(self):
+        raise RuntimeError('解析失败')
+
+    monkeypatch.setattr(Downloader, 'parse_page', parse_page)
+    run_pipeline(tmp_path, ('text', 'picture', 'audio'))
+    for num in (1, 2, 3):
+        assert records.count(f'【Episode{num}: END】') == 1
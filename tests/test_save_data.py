@@ -0,0 +1,133 @@
+# -*- encoding: utf-8 -*-
+
+import threading
+
+import pymysql
+import pytest
+
+from download_natgeo import create_table_sqls
+from save_natgeo_data import DataProcess, SQLiteDataProcess
+
+
+class FakeConnection:
+    """
+    模拟 pymysql 的连接：记录当前选择的数据库；没有选择数据库时查询数据表会像 MySQL 一样报错
+    """
+    def __init__(self):
+        self.database = None
+        self.alive = True
+        self.closed = False
+        self.queries = []
+
+    def ping(self, reconnect=False):
+        if not self.alive:
+            if reconnect:
+                # 与 pymysql 一样，重新连接后的会话中没有选择数据库
+                self.alive, self.database = True, None
+                return
+            raise pymysql.err.OperationalError(2013, 'Lost connection to MySQL server during query')
+
+    def select_db(self, database):
+        self.database = database
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.rows = []
+
+    def execute(self, sql, args=None):
+        self.conn.queries.append(sql)
+        if 'information_schema' in sql:
+            self.rows = [('overheard',)]
+        elif self.conn.database is None:
+            raise pymysql.err.OperationalError(1046, 'No database selected')
+        else:
+            self.rows = [('https://example.com/episode-1',)]
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def connections(monkeypatch):
+    created = []
+
+    def connect(**kwargs):
+        created.append(FakeConnection())
+        return created[-1]
+
+    monkeypatch.setattr(pymysql, 'connect', connect)
+    return created
+
+
+def test_mysql_connection_is_reused(connections):
+    with DataProcess('user', 'password') as processor:
+        assert processor.known_urls('natgeo', 'overheard') == {'https://example.com/episode-1'}
+        assert processor.known_urls('natgeo', 'overheard') == {'https://example.com/episode-1'}
+    assert len(connections) == 1
+    assert connections[0].closed
+
+
+def test_mysql_database_is_selected_again_after_reconnect(connections):
+    with DataProcess('user', 'password') as processor:
+        assert processor.known_urls('natgeo', 'overheard')
+        # 服务器断开了连接，例如超过了 wait_timeout
+        connections[0].alive = False
+        assert processor.known_urls('natgeo', 'overheard') == {'https://example.com/episode-1'}
+    assert len(connections) == 2
+    assert connections[1].database == 'natgeo'
+    assert all(conn.closed for conn in connections)
+
+
+def test_mysql_latest_issue_is_detected_by_url(connections):
+    data = {'Episode 1: renamed': 'https://example.com/episode-1', 'Episode 2': 'https://example.com/episode-2'}
+    with DataProcess('user', 'password') as processor:
+        latest = processor.check_latest_issue('natgeo', 'overheard', data)
+    # 标题被修改的节目仍然以网址识别为已保存；已有的网址只需要一次查询
+    assert latest == {'Episode 2': 'https://example.com/episode-2'}
+    assert sum('select URL' in sql for conn in connections for sql in conn.queries) == 1
+
+
+@pytest.fixture
+def sqlite_processor(tmp_path):
+    with SQLiteDataProcess(directory=str(tmp_path)) as processor:
+        processor.create_data_table('natgeo', 'overheard', create_table_sqls('overheard', 'sqlite'))
+        processor.insert_episodes('natgeo', 'overheard', {'Episode 1': 'https://example.com/episode-1'})
+        yield processor
+
+
+def test_sqlite_latest_issue_is_detected_by_url(sqlite_processor):
+    data = {'Episode 1: renamed': 'https://example.com/episode-1', 'Episode 2': 'https://example.com/episode-2'}
+    assert sqlite_processor.check_latest_issue('natgeo', 'overheard', data) == {
+        'Episode 2': 'https://example.com/episode-2'}
+
+
+def test_sqlite_delete_database_closes_connections_of_all_threads(sqlite_processor, tmp_path):
+    def worker():
+        assert sqlite_processor.known_urls('natgeo', 'overheard') == {'https://example.com/episode-1'}
+        started.set()
+        deleted.wait(5)
+        # 数据库重新创建后，该线程使用新的连接，而不是已经关闭的旧连接
+        results.append(sqlite_processor.known_urls('natgeo', 'overheard'))
+
+    started, deleted, results = threading.Event(), threading.Event(), []
+    thread = threading.Thread(target=worker)
+    thread.start()
+    started.wait(5)
+
+    assert sqlite_processor.delete_database('natgeo')
+    assert not list(tmp_path.iterdir())
+    sqlite_processor.create_data_table('natgeo', 'overheard', create_table_sqls('overheard', 'sqlite'))
+    deleted.set()
+    thread.join(5)
+    assert results == [set()]
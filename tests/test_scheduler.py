@@ -0,0 +1,116 @@
+# -*- encoding: utf-8 -*-
+
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import transfer_natgeo
+from fixture_natgeo import FixtureSite
+from scheduler_natgeo import AUDIO, PAGE, PICTURE, TransferScheduler, configure_scheduler
+
+
+def test_inflight_cap_holds(tmp_path):
+    audio_size = 400_000
+    cap = 1_000_000
+    # 限速使各个下载在时间上重叠
+    with FixtureSite(episodes=10, audio_size=audio_size, bandwidth=2_000_000) as site:
+        scheduler = configure_scheduler(max_inflight_bytes=cap, estimates={AUDIO: audio_size})
+        urls = [f'{site.base_url}/audio/{number}.mp3' for number in range(1, 11)]
+        with ThreadPoolExecutor(10) as executor:
+            paths = list(executor.map(lambda number: transfer_natgeo.download_file(
+                urls[number - 1], str(tmp_path / f'{number}.mp3')), range(1, 11)))
+
+        for number, path in enumerate(paths, 1):
+            with open(path, 'rb') as f:
+                assert f.read() == site.file_content(number, audio_size)
+
+    stats = scheduler.stats()
+    assert audio_size < stats['peak_inflight_bytes'] <= cap
+    assert stats['inflight_bytes'] == 0
+    assert stats['waiting_transfers'] == 0
+
+
+def test_cap_holds_when_sizes_are_larger_than_estimated():
+    scheduler = TransferScheduler(max_inflight_bytes=1_000_000, estimates={AUDIO: 50_000})
+
+    def download(size):
+        transfer = scheduler.start_transfer('http://example.com/a.mp3')
+        transfer.expect(size)
+        for _ in range(size // 50_000):
+            time.sleep(0.002)
+            transfer.received(50_000)
+        transfer.finish()
+
+    with ThreadPoolExecutor(10) as executor:
+        list(executor.map(download, [300_000, 450_000, 600_000] * 4))
+
+    assert scheduler.stats()['peak_inflight_bytes'] <= 1_000_000
+    assert scheduler.stats()['inflight_bytes'] == 0
+
+
+def test_growing_transfers_do_not_block_each_other():
+    scheduler = TransferScheduler(max_inflight_bytes=100, estimates={AUDIO: 40})
+    transfers = [scheduler.start_transfer('http://example.com/a.mp3'),
+                 scheduler.start_transfer('http://example.com/b.mp3')]
+
+    def grow(transfer):
+        transfer.expect(90)
+        transfer.finish()
+
+    threads = [threading.Thread(target=grow, args=(transfer,)) for transfer in transfers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    assert not any(thread.is_alive() for thread in threads)
+    assert scheduler.stats()['inflight_bytes'] == 0
+
+
+def test_waiting_transfers_start_by_priority():
+    scheduler = TransferScheduler(max_inflight_bytes=100)
+    holder = scheduler.start_transfer('http://example.com/a.mp3', size=100)
+    started = []
+
+    def start(priority):
+        scheduler.start_transfer('http://example.com/b', priority, size=100).finish()
+        started.append(priority)
+
+    threads = []
+    for priority in (AUDIO, PICTURE, PAGE):
+        threads.append(threading.Thread(target=start, args=(priority,)))
+        threads[-1].start()
+        time.sleep(0.05)
+    assert started == []
+
+    holder.finish()
+    for thread in threads:
+        thread.join(5)
+    assert started == [PAGE, PICTURE, AUDIO]
+
+
+def test_async_waits_do_not_use_threads():
+    scheduler = TransferScheduler(default_rate=20, burst=1, max_inflight_bytes=100)
+
+    def executor_threads():
+        # asyncio.to_thread() 使用的默认线程池中的线程
+        return [thread for thread in threading.enumerate() if thread.name.startswith('asyncio_')]
+
+    async def run():
+        start = time.monotonic()
+        await asyncio.gather(*[scheduler.async_acquire_request('http://example.com/') for _ in range(6)])
+        elapsed = time.monotonic() - start
+
+        # 线程中预留的字节数释放后，等待中的协程被唤醒
+        holder = scheduler.start_transfer('http://example.com/a.mp3', size=100)
+        threading.Timer(0.1, holder.finish).start()
+        transfer = await scheduler.async_start_transfer('http://example.com/b.mp3', size=100)
+        transfer.finish()
+        return elapsed, executor_threads()
+
+    elapsed, threads = asyncio.run(run())
+    # 5 个请求需要等待令牌，每秒 20 个
+    assert 0.2 <= elapsed < 1.0
+    assert threads == []
+    assert scheduler.stats()['inflight_bytes'] == 0
@@ -0,0 +1,40 @@
+# -*- encoding: utf-8 -*-
+
+import pytest
+
+import browser_natgeo
+from fixture_natgeo import FixtureSite
+from get_all_specific_natgeo import Downloader, get_files
+from manifest_natgeo import DownloadManifest
+from pipeline_natgeo import DownloadPipeline
+
+
+@pytest.fixture
+def no_browser(monkeypatch):
+    def new_driver():
+        raise AssertionError('只选择了文本时不应该启动浏览器')
+
+    monkeypatch.setattr(browser_natgeo, 'new_driver', new_driver)
+
+
+@pytest.mark.parametrize('stages', [('bogus',), ('text', 'bogus'), ()])
+def test_invalid_stages_are_rejected(stages, no_browser):
+    with pytest.raises(ValueError):
+        Downloader('Episode 1', 'http://127.0.0.1/podcasts/article/episode-1', stages=stages)
+    with pytest.raises(ValueError):
+        DownloadPipeline(stages=stages)
+    assert get_files({'Episode 1': 'http://127.0.0.1/podcasts/article/episode-1'}, manifest=None,
+                     stages=stages) is False
+
+
+@pytest.mark.parametrize('mode', [{}, {'pipeline': True}, {'concurrency': 2}])
+def test_text_only_does_not_touch_audio(mode, tmp_path, no_browser):
+    manifest = DownloadManifest(str(tmp_path / 'manifest.json'))
+    with FixtureSite(episodes=3) as site:
+        info = site.episode_info()
+        completed = get_files(info, manifest=manifest, save_path=str(tmp_path), stages=('text',), **mode)
+
+    assert sorted(completed) == sorted(info.values())
+    for url in info.values():
+        assert manifest.is_done(url, 'text')
+        assert manifest.missing(url, ['picture', 'audio']) == ['picture', 'audio']
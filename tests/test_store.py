@@ -0,0 +1,89 @@
+# -*- encoding: utf-8 -*-
+
+import asyncio
+
+import pytest
+
+import manifest_natgeo
+import store_natgeo
+from get_all_specific_natgeo import Downloader
+from manifest_natgeo import DownloadManifest
+from metrics_natgeo import metrics
+from session_natgeo import load_aiohttp
+from store_natgeo import async_stored_download, configure_store, stored_download
+
+
+@pytest.fixture
+def store(tmp_path):
+    yield configure_store(str(tmp_path / 'blobs'))
+    configure_store(None)
+
+
+def store_results(since):
+    return metrics.summary(since)['counters'].get('store_requests_total', {})
+
+
+def test_unchanged_url_is_linked_without_download(store, site, tmp_path):
+    url = f'{site.base_url}/audio/1.mp3'
+    assert stored_download(url, str(tmp_path / 'first.mp3'))
+
+    since = metrics.snapshot()
+    assert stored_download(url, str(tmp_path / 'second.mp3'))
+    assert store_results(since) == {'{result="hit"}': 1}
+    assert (tmp_path / 'second.mp3').read_bytes() == site.file_content(1, site.audio_size)
+    # 第一次重复使用时补充记录 ETag
+    assert store.lookup(url)['etag'] == '"audio-1"'
+
+
+def test_changed_url_is_downloaded_again(store, site, tmp_path):
+    url = f'{site.base_url}/audio/1.mp3'
+    assert stored_download(url, str(tmp_path / 'first.mp3'))
+    old_digest = store.digest(url)
+
+    # 服务器上的文件已经更新
+    site.audio_size += 1000
+    since = metrics.snapshot()
+    assert stored_download(url, str(tmp_path / 'second.mp3'))
+    assert store_results(since) == {'{result="miss"}': 1}
+    assert (tmp_path / 'second.mp3').read_bytes() == site.file_content(1, site.audio_size)
+    assert store.digest(url) not in (None, old_digest)
+
+
+@pytest.mark.skipif(load_aiohttp() is None, reason='没有安装 aiohttp')
+def test_async_changed_url_is_downloaded_again(store, site, tmp_path):
+    aiohttp = load_aiohttp()
+    url = f'{site.base_url}/audio/1.mp3'
+
+    async def download(name):
+        async with aiohttp.ClientSession() as session:
+            return await async_stored_download(session, url, str(tmp_path / name))
+
+    assert asyncio.run(download('first.mp3'))
+    since = metrics.snapshot()
+    assert asyncio.run(download('second.mp3'))
+    site.audio_size += 1000
+    assert asyncio.run(download('third.mp3'))
+    assert store_results(since) == {'{result="hit"}': 1, '{result="miss"}': 1}
+    assert (tmp_path / 'third.mp3').read_bytes() == site.file_content(1, site.audio_size)
+
+
+def test_manifest_reuses_store_digest(store, site, tmp_path, monkeypatch):
+    calls = []
+
+    def file_digest(path):
+        calls.append(path)
+        return digest(path)
+
+    digest = manifest_natgeo.file_digest
+    monkeypatch.setattr(manifest_natgeo, 'file_digest', file_digest)
+    monkeypatch.setattr(store_natgeo, 'file_digest', file_digest)
+
+    manifest = DownloadManifest(str(tmp_path / 'manifest.json'))
+    title, url = list(site.episode_info().items())[-1]
+    downloader = Downloader(title, url, save_path=str(tmp_path), manifest=manifest)
+    assert downloader.fetch_page()
+    assert downloader.save_audio(f'{site.base_url}/audio/1.mp3')
+
+    # 只在放入仓库时计算一次校验值
+    assert len(calls) == 1
+    assert manifest.asset(url, 'audio')['sha256'] == digest(manifest.asset(url, 'audio')['path'])
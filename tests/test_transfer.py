@@ -0,0 +1,187 @@
+# -*- encoding: utf-8 -*-
+
+import asyncio
+import json
+import threading
+
+import pytest
+
+import transfer_natgeo
+from metrics_natgeo import metrics
+from session_natgeo import load_aiohttp
+
+
+SIZE = 2_000_000
+
+# 部分完成的分段下载进度：[起点, 终点（不含）, 已下载的大小]
+PARTIAL_SEGMENTS = [[0, 500_000, 200_000], [500_000, 1_000_000, 500_000], [1_000_000, 1_500_000, 0],
+                    [1_500_000, 2_000_000, 123]]
+
+
+def audio_url(site):
+    return f'{site.base_url}/audio/1.mp3'
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def write_partial_segments(site, path, etag='"audio-1"', location=None):
+    """
+    Func: 构造一个中断的分段下载：.part 文件中只有各段已下载的部分，.part.json 中保存对应的进度
+    """
+    expected = site.file_content(1, SIZE)
+    data = bytearray(SIZE)
+    for start, _, done in PARTIAL_SEGMENTS:
+        data[start:start + done] = expected[start:start + done]
+    with open(path + '.part', 'wb') as f:
+        f.write(data)
+    state = {'url': audio_url(site), 'etag': etag, 'last_modified': None, 'total': SIZE,
+             'done': sum(done for _, _, done in PARTIAL_SEGMENTS), 'location': location or audio_url(site),
+             'segments': [list(segment) for segment in PARTIAL_SEGMENTS]}
+    with open(path + '.part.json', 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+
+
+def test_segmented_download_matches_single(site, tmp_path):
+    single = transfer_natgeo.download_file(audio_url(site), str(tmp_path / 'single.mp3'))
+
+    transfer_natgeo.configure_segments(4, min_size=500_000)
+    before = metrics.summary()['counters'].get('segmented_downloads_total', {})
+    segmented = transfer_natgeo.download_file(audio_url(site), str(tmp_path / 'segmented.mp3'))
+    after = metrics.summary()['counters']['segmented_downloads_total']
+
+    assert sum(after.values()) == sum(before.values()) + 1
+    assert read(segmented) == read(single) == site.file_content(1, SIZE)
+    assert not (tmp_path / 'segmented.mp3.part').exists()
+    assert not (tmp_path / 'segmented.mp3.part.json').exists()
+
+
+def test_resumed_segmented_download(site, tmp_path):
+    path = str(tmp_path / 'resumed.mp3')
+    write_partial_segments(site, path)
+    transfer_natgeo.configure_segments(4, min_size=500_000)
+
+    assert transfer_natgeo.download_file(audio_url(site), path) == path
+    assert read(path) == site.file_content(1, SIZE)
+
+
+def test_resumed_single_download(site, tmp_path):
+    path = str(tmp_path / 'resumed.mp3')
+    with open(path + '.part', 'wb') as f:
+        f.write(site.file_content(1, SIZE)[:700_000])
+    with open(path + '.part.json', 'w', encoding='utf-8') as f:
+        json.dump({'url': audio_url(site), 'etag': '"audio-1"', 'last_modified': None, 'total': SIZE,
+                   'done': 700_000}, f)
+
+    assert transfer_natgeo.download_file(audio_url(site), path) == path
+    assert read(path) == site.file_content(1, SIZE)
+
+
+def test_dropped_connection_keeps_part_and_resumes(site, tmp_path, monkeypatch):
+    path = str(tmp_path / 'dropped.mp3')
+    chunk_size = 64 * 1024
+    write_chunk = transfer_natgeo._write_chunk
+
+    def dropping_write_chunk(f, part, state, chunk, size):
+        if state['done'] >= 3 * chunk_size:
+            raise ConnectionError('Connection reset by peer')
+        write_chunk(f, part, state, chunk, size)
+
+    monkeypatch.setattr(transfer_natgeo, '_write_chunk', dropping_write_chunk)
+    with pytest.raises(ConnectionError):
+        transfer_natgeo.download_file(audio_url(site), path, chunk_size=chunk_size)
+
+    # 没有完成时不出现目标文件；.part 文件按 Content-Length 预先分配了空间
+    assert not (tmp_path / 'dropped.mp3').exists()
+    assert (tmp_path / 'dropped.mp3.part').stat().st_size == SIZE
+    with open(path + '.part.json', encoding='utf-8') as f:
+        done = json.load(f)['done']
+    assert done == 3 * chunk_size
+
+    # 再次下载时只请求剩余的部分
+    monkeypatch.setattr(transfer_natgeo, '_write_chunk', write_chunk)
+    before = sum(metrics.summary()['counters'].get('bytes_total', {}).values())
+    assert transfer_natgeo.download_file(audio_url(site), path, chunk_size=chunk_size) == path
+    assert sum(metrics.summary()['counters']['bytes_total'].values()) - before == SIZE - done
+    assert read(path) == site.file_content(1, SIZE)
+    assert not (tmp_path / 'dropped.mp3.part').exists()
+
+
+def test_changed_file_falls_back_to_single_stream(site, tmp_path):
+    # 进度中的 ETag 与服务器不一致时，服务器返回完整内容，改为使用单个连接从头下载
+    path = str(tmp_path / 'changed.mp3')
+    write_partial_segments(site, path, etag='"stale"')
+    transfer_natgeo.configure_segments(4, min_size=500_000)
+
+    assert transfer_natgeo.download_file(audio_url(site), path) == path
+    assert read(path) == site.file_content(1, SIZE)
+
+
+def test_async_segmented_and_resumed_downloads(site, tmp_path):
+    aiohttp = load_aiohttp()
+    if aiohttp is None:
+        pytest.skip('没有安装 aiohttp')
+    transfer_natgeo.configure_segments(4, min_size=500_000)
+    resumed = str(tmp_path / 'resumed.mp3')
+    write_partial_segments(site, resumed)
+
+    async def download():
+        async with aiohttp.ClientSession() as session:
+            return (await transfer_natgeo.async_download_file(session, audio_url(site), str(tmp_path / 'seg.mp3')),
+                    await transfer_natgeo.async_download_file(session, audio_url(site), resumed))
+
+    for path in asyncio.run(download()):
+        assert read(path) == site.file_content(1, SIZE)
+
+
+def test_expired_location_restarts_from_original_url(site, tmp_path):
+    # 上次保存的跳转之后的链接（例如有时效的签名链接）已经失效，返回 404
+    path = str(tmp_path / 'expired.mp3')
+    write_partial_segments(site, path, location=f'{site.base_url}/expired/1.mp3')
+    transfer_natgeo.configure_segments(4, min_size=500_000)
+
+    assert transfer_natgeo.download_file(audio_url(site), path) == path
+    assert read(path) == site.file_content(1, SIZE)
+    assert not (tmp_path / 'expired.mp3.part.json').exists()
+
+
+def test_async_expired_location_restarts_from_original_url(site, tmp_path):
+    aiohttp = load_aiohttp()
+    if aiohttp is None:
+        pytest.skip('没有安装 aiohttp')
+    path = str(tmp_path / 'expired.mp3')
+    write_partial_segments(site, path, location=f'{site.base_url}/expired/1.mp3')
+    transfer_natgeo.configure_segments(4, min_size=500_000)
+
+    async def download():
+        async with aiohttp.ClientSession() as session:
+            return await transfer_natgeo.async_download_file(session, audio_url(site), path)
+
+    assert asyncio.run(download()) == path
+    assert read(path) == site.file_content(1, SIZE)
+
+
+@pytest.mark.parametrize('segments', [1, 4])
+def test_async_writes_run_off_the_event_loop(site, tmp_path, monkeypatch, segments):
+    aiohttp = load_aiohttp()
+    if aiohttp is None:
+        pytest.skip('没有安装 aiohttp')
+    on_loop = set()
+    for name in ('_write_segment', '_write_chunk'):
+        func = getattr(transfer_natgeo, name)
+
+        def wrapper(*args, __func=func):
+            on_loop.add(threading.current_thread() is threading.main_thread())
+            return __func(*args)
+        monkeypatch.setattr(transfer_natgeo, name, wrapper)
+    transfer_natgeo.configure_segments(segments, min_size=500_000)
+
+    async def download():
+        async with aiohttp.ClientSession() as session:
+            return await transfer_natgeo.async_download_file(session, audio_url(site), str(tmp_path / 'a.mp3'))
+
+    assert read(asyncio.run(download())) == site.file_content(1, SIZE)
+    # 事件循环运行在主线程中
+    assert on_loop == {False}
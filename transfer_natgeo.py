@@ -0,0 +1,581 @@
+# -*- encoding: utf-8 -*-
+
+import asyncio
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from log_overheard import log_setting
+from metrics_natgeo import host_of, metrics
+from scheduler_natgeo import AUDIO, async_start_transfer, start_transfer
+from session_natgeo import async_http_get, http_get
+
+
+# 每次写入磁盘的数据块大小
+CHUNK_SIZE = 1024 * 1024
+
+# 分段下载的默认设置：每个文件的分段数量（1 表示不分段），以及分段下载的最小文件大小
+SEGMENTS = 1
+SEGMENT_MIN_SIZE = 8 * 1024 * 1024
+
+_segments = SEGMENTS
+_host_segments = {}
+_segment_min_size = SEGMENT_MIN_SIZE
+
+
+class _SegmentError(Exception):
+    """
+    服务器没有按照 Range 请求返回分段（不支持分段请求，或者文件已经发生变化）
+    """
+
+
+class _ExpiredLocation(_SegmentError):
+    """
+    续传时，上次保存的跳转之后的链接返回了 4xx（例如有时效的 CDN 签名链接已经过期）
+    """
+
+
+def _load_state(part):
+    """
+    Func: 读取未完成下载的进度文件（保存在 .part.json 中）
+    :return: 字典，包含链接、ETag、Last-Modified、总大小和已下载的大小；没有进度时返回 None
+    """
+    if not os.path.exists(part):
+        return None
+    try:
+        with open(part + '.json', 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _save_state(part, state):
+    with open(part + '.json', 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+
+
+def _record(f, part, state, size, chunk_size):
+    """
+    Func: 累加已下载的大小；每写入约 chunk_size 字节，刷新文件并保存一次进度
+    """
+    state['done'] += size
+    if state['done'] - state.get('saved', 0) >= chunk_size:
+        f.flush()
+        state['saved'] = state['done']
+        _save_state(part, state)
+
+
+def _clear_state(part):
+    for file in (part, part + '.json'):
+        if os.path.exists(file):
+            os.remove(file)
+
+
+def _resume_headers(url, state):
+    """
+    Func: 根据已有的进度构造断点续传的请求头；资源发生变化时，服务器会通过 If-Range 返回完整内容
+    :return: (请求头, 已下载的大小)
+    """
+    # 分段下载的进度不是连续的，不能用于单个连接的断点续传
+    if not state or state.get('url') != url or not state.get('done') or state.get('segments'):
+        return {}, 0
+
+    headers = {'Range': f'bytes={state["done"]}-'}
+    validator = state.get('etag') or state.get('last_modified')
+    if validator:
+        headers['If-Range'] = validator
+    return headers, state['done']
+
+
+def _remaining_size(state, offset):
+    """
+    Func: 断点续传时根据已有的进度估计剩余的大小，用于开始下载时预留；无法确定时返回 None
+    """
+    if offset and state.get('total'):
+        return state['total'] - offset
+    return None
+
+
+def _total_size(status, headers, offset):
+    """
+    Func: 根据响应头计算文件的总大小；无法确定时返回 None
+    """
+    if status == 206:
+        content_range = headers.get('Content-Range', '')
+        total = content_range.rpartition('/')[2]
+        return int(total) if total.isdigit() else None
+
+    length = headers.get('Content-Length')
+    return int(length) if length and length.isdigit() else None
+
+
+def _open_part(part, offset, total):
+    """
+    Func: 打开 .part 文件；从头下载时按 Content-Length 预先分配磁盘空间
+    """
+    if offset:
+        f = open(part, 'r+b')
+        f.seek(offset)
+        return f
+
+    f = open(part, 'wb')
+    if total:
+        try:
+            os.posix_fallocate(f.fileno(), 0, total)
+        except (AttributeError, OSError):
+            f.truncate(total)
+    return f
+
+
+def _finish(part, path, done, total):
+    """
+    Func: 校验下载的大小，完整时将 .part 文件重命名为目标文件
+    :return: 成功返回目标文件的路径，否则返回 False（保留 .part 文件以便续传）
+    """
+    if total is not None and done != total:
+        logger.error(f'文件【{path}】下载不完整（{done}/{total}字节），下次运行时将继续下载。\n')
+        return False
+
+    os.replace(part, path)
+    if os.path.exists(part + '.json'):
+        os.remove(part + '.json')
+    return path
+
+
+def configure_segments(segments=SEGMENTS, host_segments=None, min_size=SEGMENT_MIN_SIZE):
+    """
+    Func: 配置大文件的分段下载：服务器声明支持 Range 请求（Accept-Ranges: bytes）且文件不小于 min_size 时，
+          将文件平均分成多段，每段使用一个连接同时下载，写入预先分配好的 .part 文件；否则使用单个连接下载
+    :param segments: 默认的分段数量，1 表示不分段（默认）
+    :param host_segments: 字典，各个主机的分段数量，例如 {'audio.example.com': 4}；
+                          按跳转之后的主机查找，找不到时再按原链接的主机查找
+    :param min_size: 分段下载的最小文件大小（字节）
+    """
+    global _segments, _host_segments, _segment_min_size
+    _segments = segments
+    _host_segments = dict(host_segments or {})
+    _segment_min_size = min_size
+    logger.info(f'分段下载配置完成：默认分成【{segments}】段，各主机【{_host_segments}】，'
+                f'最小文件大小【{min_size}】字节。\n')
+
+
+def max_segments():
+    """
+    Func: 配置的最大分段数量，即一个文件最多同时使用的连接数
+    """
+    return max([_segments, *_host_segments.values()])
+
+
+def _segment_plan(url, location, status, headers, total):
+    """
+    Func: 决定是否分段下载：从头下载、服务器声明支持 Range 请求、文件大小已知且不小于分段下载的最小文件大小
+    :param location: 跳转之后的链接
+    :return: [[起点, 终点（不含）, 已下载的大小], ...]；不分段时返回 None
+    """
+    count = _host_segments.get(host_of(location), _host_segments.get(host_of(url), _segments))
+    if count < 2 or status != 200 or not total or total < _segment_min_size:
+        return None
+    if headers.get('Accept-Ranges', '').lower() != 'bytes':
+        return None
+
+    size = -(-total // count)
+    return [[start, min(start + size, total), 0] for start in range(0, total, size)]
+
+
+class _SegmentProgress:
+    def __init__(self, part, state, chunk_size):
+        """
+        Func: 分段下载的进度，各个分段同时更新；每下载约 chunk_size 字节保存一次进度，出错时通知其他分段停止
+        """
+        self.part = part
+        self.state = state
+        self.chunk_size = chunk_size
+        self.stopped = threading.Event()
+        self.__lock = threading.Lock()
+
+    def add(self, segment, size):
+        with self.__lock:
+            segment[2] += size
+            self.state['done'] += size
+            if self.state['done'] - self.state.get('saved', 0) >= self.chunk_size:
+                self.state['saved'] = self.state['done']
+                _save_state(self.part, self.state)
+
+    def save(self):
+        with self.__lock:
+            _save_state(self.part, self.state)
+
+
+def _segment_headers(segment, state):
+    """
+    Func: 请求分段剩余部分的请求头；文件发生变化时，服务器会通过 If-Range 返回完整内容（200）
+    """
+    headers = {'Range': f'bytes={segment[0] + segment[2]}-{segment[1] - 1}'}
+    validator = state.get('etag') or state.get('last_modified')
+    if validator:
+        headers['If-Range'] = validator
+    return headers
+
+
+def _check_location(segment, status, resumed):
+    """
+    Func: 续传时保存的链接返回 4xx，说明链接已经失效，需要从原链接重新开始
+    """
+    if resumed and 400 <= status < 500:
+        raise _ExpiredLocation(f'分段【{segment[0] + segment[2]}-{segment[1] - 1}】的链接返回【{status}】，已经失效')
+
+
+def _check_segment(segment, status, headers):
+    start = segment[0] + segment[2]
+    if status != 206 or not headers.get('Content-Range', '').startswith(f'bytes {start}-'):
+        raise _SegmentError(f'分段【{start}-{segment[1] - 1}】的返回码为【{status}】，'
+                            f'Content-Range 为【{headers.get("Content-Range")}】')
+
+
+def _write_segment(f, segment, chunk, progress):
+    """
+    Func: 将数据写入分段的剩余部分，超出分段的部分丢弃
+    :return: 实际写入的字节数
+    """
+    chunk = chunk[:_segment_left(segment)]
+    if chunk:
+        f.write(chunk)
+        progress.add(segment, len(chunk))
+    return len(chunk)
+
+
+def _segment_left(segment):
+    return segment[1] - segment[0] - segment[2]
+
+
+def _open_segment(part, segment):
+    # 不使用缓冲，写入的数据在保存进度之前已经交给操作系统
+    f = open(part, 'r+b', buffering=0)
+    f.seek(segment[0] + segment[2])
+    return f
+
+
+def _write_chunk(f, part, state, chunk, chunk_size):
+    f.write(chunk)
+    _record(f, part, state, len(chunk), chunk_size)
+
+
+def _read_segment(response, part, segment, progress, transfer, chunk_size):
+    with _open_segment(part, segment) as f:
+        # 第一个分段读取的是完整内容的响应，每次读取的大小不能超过分段，否则要等待下一个分段的数据
+        for chunk in response.iter_content(chunk_size=min(chunk_size, _segment_left(segment))):
+            if progress.stopped.is_set():
+                return
+            transfer.received(_write_segment(f, segment, chunk, progress))
+            if _segment_left(segment) <= 0:
+                return
+
+
+def _fetch_segment(location, part, segment, progress, transfer, chunk_size, priority, response=None, resumed=False):
+    """
+    Func: 下载一个分段的剩余部分；提供 response 时直接读取该响应（从头下载的响应即为第一个分段）
+    :param resumed: 是否在续传上次的分段下载，此时 location 是上次保存的链接，可能已经失效
+    """
+    try:
+        if response is not None:
+            _read_segment(response, part, segment, progress, transfer, chunk_size)
+            # 剩余的内容由其他分段下载，立即关闭连接
+            return response.close()
+        if _segment_left(segment) <= 0:
+            return
+        with http_get(location, headers=_segment_headers(segment, progress.state), stream=True,
+                      priority=priority) as response:
+            _check_location(segment, response.status_code, resumed)
+            response.raise_for_status()
+            _check_segment(segment, response.status_code, response.headers)
+            _read_segment(response, part, segment, progress, transfer, chunk_size)
+    except Exception:
+        progress.stopped.set()
+        raise
+
+
+def _first_error(errors):
+    """
+    Func: 选择需要报告的错误：优先报告链接失效（从原链接重新开始），其次是不支持分段请求（改为单个连接下载）
+    """
+    for kind in (_ExpiredLocation, _SegmentError):
+        for error in errors:
+            if isinstance(error, kind):
+                return error
+    return errors[0]
+
+
+def _download_segments(url, path, part, state, transfer, chunk_size, priority, response=None):
+    """
+    Func: 各个分段在各自的线程中同时下载，写入 .part 文件中各自的位置；全部结束后按 Content-Length 校验大小
+    :param response: 从头下载的响应，第一个分段直接读取该响应，不再单独请求；续传时为 None
+    :return: 成功返回保存的路径，下载不完整时返回 False；服务器不支持分段请求时抛出 _SegmentError
+    """
+    segments = state['segments']
+    progress = _SegmentProgress(part, state, chunk_size)
+    before = state['done']
+    try:
+        with ThreadPoolExecutor(max_workers=len(segments), thread_name_prefix='segment') as executor:
+            futures = [executor.submit(_fetch_segment, state['location'], part, segment, progress, transfer,
+                                       chunk_size, priority, response if index == 0 else None, response is None)
+                       for index, segment in enumerate(segments)]
+        errors = [future.exception() for future in futures if future.exception() is not None]
+        if errors:
+            raise _first_error(errors)
+    finally:
+        progress.save()
+        metrics.inc('bytes_total', state['done'] - before, host=host_of(url))
+
+    return _finish(part, path, state['done'], state['total'])
+
+
+def _start_segments(part, state, response, segments, path):
+    """
+    Func: 开始分段下载：记录跳转之后的链接和各个分段，按 Content-Length 预先分配 .part 文件
+    """
+    state.update(location=str(response.url), segments=segments)
+    _open_part(part, 0, state['total']).close()
+    _save_state(part, state)
+    metrics.inc('segmented_downloads_total', host=host_of(state['location']), result='segmented')
+    logger.info(f'将【{path}】分成【{len(segments)}】段同时下载 ... ')
+
+
+def _resume_segments(url, state):
+    """
+    Func: 是否可以继续之前的分段下载
+    """
+    return bool(state and state.get('segments') and state.get('url') == url and state.get('location'))
+
+
+def _restart(url, path, part, error):
+    logger.warning(f'继续分段下载【{path}】失败：{error}，清除进度后从原链接重新开始 ... ')
+    metrics.inc('segmented_downloads_total', host=host_of(url), result='restart')
+    _clear_state(part)
+
+
+def _fall_back(url, path, part, error):
+    logger.warning(f'分段下载【{path}】失败：{error}，改为使用单个连接下载 ... ')
+    metrics.inc('segmented_downloads_total', host=host_of(url), result='fallback')
+    _clear_state(part)
+
+
+def download_file(url, path, chunk_size=CHUNK_SIZE, priority=AUDIO, segmented=True):
+    """
+    Func: 以流的方式将链接的内容分块写入 path.part，完成后再重命名为 path；
+          中断后再次调用时，使用 HTTP Range 请求从断点继续下载。
+          开启了下载调度时，进行中的字节数达到上限时排队等待，并按全局带宽限速；
+          开启了分段下载（configure_segments）时，大文件分成多段同时下载，服务器不支持时改为单个连接下载
+    :param url: 文件的链接
+    :param path: 保存的路径
+    :param chunk_size: 每次写入磁盘的数据块大小
+    :param priority: 排队时的优先级（scheduler_natgeo.PICTURE/AUDIO）
+    :param segmented: 是否允许分段下载
+    :return: 成功返回保存的路径，失败返回 False
+    """
+    part = path + '.part'
+    try:
+        return _download_file(url, path, part, chunk_size, priority, segmented)
+    except _ExpiredLocation as e:
+        # 进度已经清除，再次下载时从头开始，会重新获取跳转之后的链接
+        _restart(url, path, part, e)
+        return download_file(url, path, chunk_size, priority, segmented)
+    except _SegmentError as e:
+        _fall_back(url, path, part, e)
+        return _download_file(url, path, part, chunk_size, priority, False)
+
+
+def _download_file(url, path, part, chunk_size, priority, segmented):
+    state = _load_state(part)
+    if segmented and _resume_segments(url, state):
+        logger.info(f'从【{state["done"]}/{state["total"]}】字节处继续分段下载【{path}】 ... ')
+        with start_transfer(url, priority, state['total'] - state['done']) as transfer:
+            return _download_segments(url, path, part, state, transfer, chunk_size, priority)
+
+    headers, offset = _resume_headers(url, state)
+    if offset:
+        logger.info(f'从第【{offset}】字节处继续下载【{path}】 ... ')
+
+    with start_transfer(url, priority, _remaining_size(state, offset)) as transfer, \
+            http_get(url, headers=headers, stream=True, priority=priority) as response:
+        # 进度已失效（例如服务器上的文件变小了），删除后从头下载；先释放预留的字节数，重新排队
+        if response.status_code == 416:
+            logger.warning(f'断点续传的范围无效，从头开始下载【{path}】 ... ')
+            _clear_state(part)
+            transfer.finish()
+            return _download_file(url, path, part, chunk_size, priority, segmented)
+
+        response.raise_for_status()
+        if response.status_code != 206:
+            offset = 0
+
+        total = _total_size(response.status_code, response.headers, offset)
+        state = {'url': url, 'etag': response.headers.get('ETag'),
+                 'last_modified': response.headers.get('Last-Modified'), 'total': total, 'done': offset}
+        if total:
+            transfer.expect(total - offset)
+
+        segments = segmented and _segment_plan(url, response.url, response.status_code, response.headers, total)
+        if segments:
+            _start_segments(part, state, response, segments, path)
+            return _download_segments(url, path, part, state, transfer, chunk_size, priority, response)
+
+        with _open_part(part, offset, total) as f:
+            _save_state(part, state)
+            try:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    if chunk:
+                        _write_chunk(f, part, state, chunk, chunk_size)
+                        transfer.received(len(chunk))
+            finally:
+                metrics.inc('bytes_total', state['done'] - offset, host=host_of(url))
+
+    return _finish(part, path, state['done'], total)
+
+
+async def _async_read_segment(response, part, segment, progress, transfer, chunk_size):
+    """
+    Func: _read_segment() 的异步版本。文件操作在线程中执行，不阻塞事件循环；
+          收到的数据先在内存中累积到 chunk_size（或者分段的剩余部分）再写入，减少切换线程的次数
+    """
+    f = await asyncio.to_thread(_open_segment, part, segment)
+    buffer = bytearray()
+    try:
+        async for chunk in response.content.iter_chunked(min(chunk_size, _segment_left(segment))):
+            if progress.stopped.is_set():
+                break
+            chunk = chunk[:_segment_left(segment) - len(buffer)]
+            buffer += chunk
+            await transfer.async_received(len(chunk))
+            if len(buffer) >= min(chunk_size, _segment_left(segment)):
+                await asyncio.to_thread(_write_segment, f, segment, bytes(buffer), progress)
+                buffer.clear()
+                if _segment_left(segment) <= 0:
+                    break
+    finally:
+        try:
+            if buffer:
+                await asyncio.to_thread(_write_segment, f, segment, bytes(buffer), progress)
+        finally:
+            await asyncio.to_thread(f.close)
+
+
+async def _async_fetch_segment(session, location, part, segment, progress, transfer, chunk_size, priority,
+                               response=None, resumed=False):
+    """
+    Func: _fetch_segment() 的异步版本
+    """
+    try:
+        if response is not None:
+            await _async_read_segment(response, part, segment, progress, transfer, chunk_size)
+            # 立即释放连接，避免连接数达到上限时其他分段无法发送请求
+            return response.release()
+        if _segment_left(segment) <= 0:
+            return
+        async with await async_http_get(session, location, headers=_segment_headers(segment, progress.state),
+                                        priority=priority) as response:
+            _check_location(segment, response.status, resumed)
+            response.raise_for_status()
+            _check_segment(segment, response.status, response.headers)
+            await _async_read_segment(response, part, segment, progress, transfer, chunk_size)
+    except Exception:
+        progress.stopped.set()
+        raise
+
+
+async def _async_download_segments(session, url, path, part, state, transfer, chunk_size, priority, response=None):
+    """
+    Func: _download_segments() 的异步版本，各个分段在同一个事件循环中同时下载
+    """
+    segments = state['segments']
+    progress = _SegmentProgress(part, state, chunk_size)
+    before = state['done']
+    try:
+        results = await asyncio.gather(*[
+            _async_fetch_segment(session, state['location'], part, segment, progress, transfer, chunk_size, priority,
+                                 response if index == 0 else None, response is None)
+            for index, segment in enumerate(segments)], return_exceptions=True)
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if errors:
+            raise _first_error(errors)
+    finally:
+        await asyncio.to_thread(progress.save)
+        metrics.inc('bytes_total', state['done'] - before, host=host_of(url))
+
+    return _finish(part, path, state['done'], state['total'])
+
+
+async def async_download_file(session, url, path, chunk_size=CHUNK_SIZE, priority=AUDIO, segmented=True):
+    """
+    Func: download_file() 的异步版本
+    :param session: aiohttp.ClientSession
+    """
+    part = path + '.part'
+    try:
+        return await _async_download_file(session, url, path, part, chunk_size, priority, segmented)
+    except _ExpiredLocation as e:
+        _restart(url, path, part, e)
+        return await async_download_file(session, url, path, chunk_size, priority, segmented)
+    except _SegmentError as e:
+        _fall_back(url, path, part, e)
+        return await _async_download_file(session, url, path, part, chunk_size, priority, False)
+
+
+async def _async_download_file(session, url, path, part, chunk_size, priority, segmented):
+    state = _load_state(part)
+    if segmented and _resume_segments(url, state):
+        logger.info(f'从【{state["done"]}/{state["total"]}】字节处继续分段下载【{path}】 ... ')
+        with await async_start_transfer(url, priority, state['total'] - state['done']) as transfer:
+            return await _async_download_segments(session, url, path, part, state, transfer, chunk_size, priority)
+
+    headers, offset = _resume_headers(url, state)
+    if offset:
+        logger.info(f'从第【{offset}】字节处继续下载【{path}】 ... ')
+
+    with await async_start_transfer(url, priority, _remaining_size(state, offset)) as transfer:
+        async with await async_http_get(session, url, headers=headers, priority=priority) as response:
+            if response.status == 416:
+                logger.warning(f'断点续传的范围无效，从头开始下载【{path}】 ... ')
+                _clear_state(part)
+                transfer.finish()
+                return await _async_download_file(session, url, path, part, chunk_size, priority, segmented)
+
+            response.raise_for_status()
+            if response.status != 206:
+                offset = 0
+
+            total = _total_size(response.status, response.headers, offset)
+            state = {'url': url, 'etag': response.headers.get('ETag'),
+                     'last_modified': response.headers.get('Last-Modified'), 'total': total, 'done': offset}
+            if total:
+                await transfer.async_expect(total - offset)
+
+            segments = segmented and _segment_plan(url, str(response.url), response.status, response.headers, total)
+            # 预先分配磁盘空间、写入文件都在线程中执行，不阻塞事件循环
+            if segments:
+                await asyncio.to_thread(_start_segments, part, state, response, segments, path)
+                return await _async_download_segments(session, url, path, part, state, transfer, chunk_size,
+                                                      priority, response)
+
+            f = await asyncio.to_thread(_open_part, part, offset, total)
+            buffer = bytearray()
+            try:
+                await asyncio.to_thread(_save_state, part, state)
+                async for chunk in response.content.iter_chunked(chunk_size):
+                    buffer += chunk
+                    await transfer.async_received(len(chunk))
+                    if len(buffer) >= chunk_size:
+                        await asyncio.to_thread(_write_chunk, f, part, state, bytes(buffer), chunk_size)
+                        buffer.clear()
+            finally:
+                try:
+                    if buffer:
+                        await asyncio.to_thread(_write_chunk, f, part, state, bytes(buffer), chunk_size)
+                finally:
+                    await asyncio.to_thread(f.close)
+                    metrics.inc('bytes_total', state['done'] - offset, host=host_of(url))
+
+    return _finish(part, path, state['done'], total)
+
+
+logger = log_setting('Overheard_transfer', '../Logs')